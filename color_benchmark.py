@@ -0,0 +1,133 @@
+# This file is part of Firemix.
+#
+# Copyright 2013-2020 Jonathan Evans <jon@craftyjon.com>
+#
+# Firemix is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Firemix is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Firemix.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Measures the color conversions that run on every output frame (and
+rgb_to_hls, for presets driven by images), at several scene sizes.  Each
+conversion writes into preallocated arrays, as it does in
+Networking.write_buffer.
+
+    python color_benchmark.py [--pixels 1000 10000 100000] [--repeat 200]
+                              [--lut-size 128 256 32] [--float32] [--planar]
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from lib import dtypes
+from lib.colors import hls_blend, hls_to_rgb, hls_to_rgb_perceptual, rgb_to_hls, rgb_to_uint8
+from lib.color_lut import ColorLut
+from lib.buffer_utils import PlanarBuffer
+from lib.scratch_arena import ScratchArena
+
+
+def random_hls(pixels, seed=0):
+    rng = np.random.RandomState(seed)
+    buf = np.empty(pixels, dtype=dtypes.hls_color)
+    buf['hue'] = rng.random_sample(pixels)
+    buf['light'] = rng.random_sample(pixels)
+    buf['sat'] = rng.random_sample(pixels)
+    return buf
+
+
+def conversions(pixels, lut, planar=False):
+    """
+    Returns (name, function) pairs that each convert one frame
+    """
+    hls = random_hls(pixels)
+    hls_end = random_hls(pixels, 1)
+    blended = np.empty(pixels, dtype=dtypes.hls_color)
+    if planar:
+        hls = PlanarBuffer.from_struct(hls)
+        hls_end = PlanarBuffer.from_struct(hls_end)
+        blended = PlanarBuffer.from_struct(blended)
+    rgb = np.empty(pixels, dtype=dtypes.rgb_color)
+    rgb8 = np.empty((pixels, 3), dtype=np.uint8)
+    # e.g. an image sampled at the pixel locations
+    image = np.random.RandomState(2).randint(0, 256, (pixels, 3)).astype(np.uint8)
+    residual = np.zeros((pixels, 3), dtype=np.float32)
+    scratch = ScratchArena()
+
+    def perceptual_rgb8():
+        hls_to_rgb_perceptual(hls, rgb, scratch)
+        rgb_to_uint8(rgb, rgb8)
+
+    def perceptual_dithered():
+        hls_to_rgb_perceptual(hls, rgb, scratch)
+        rgb_to_uint8(rgb, rgb8, residual, scratch)
+
+    return [
+        ("hls_to_rgb_perceptual", lambda: hls_to_rgb_perceptual(hls, rgb, scratch)),
+        ("hls_to_rgb", lambda: hls_to_rgb(hls, rgb, scratch)),
+        ("perceptual + rgb_to_uint8", perceptual_rgb8),
+        ("perceptual + dithering", perceptual_dithered),
+        ("ColorLut %dx%dx%d" % lut.size, lambda: lut.lookup(hls, rgb8, scratch)),
+        ("ColorLut, dimmed", lambda: lut.lookup(hls, rgb8, scratch, 0.5)),
+        ("hls_blend", lambda: hls_blend(hls, hls_end, blended, 0.3, 'add', scratch=scratch)),
+        ("rgb_to_hls", lambda: rgb_to_hls(image, blended, scratch)),
+    ]
+
+
+def measure(function, repeat):
+    """
+    Returns the fastest of five runs of `repeat` calls, in seconds per call
+    """
+    function()
+    best = None
+    for run in range(5):
+        start = time.perf_counter()
+        for i in range(repeat):
+            function()
+        elapsed = (time.perf_counter() - start) / repeat
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Color conversion benchmark")
+    parser.add_argument("--pixels", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--repeat", type=int, default=None,
+                        help="Calls per run (default: about 2M pixels per run)")
+    parser.add_argument("--lut-size", type=int, nargs=3, default=ColorLut.DEFAULT_SIZE,
+                        help="Hue, light and sat steps of the lookup table")
+    parser.add_argument("--float32", action="store_true",
+                        help="Use float32 pixel buffers (the mixer's float32 setting)")
+    parser.add_argument("--planar", action="store_true",
+                        help="Convert from planar (structure of arrays) buffers")
+    args = parser.parse_args()
+
+    if args.float32:
+        dtypes.set_float_type(np.float32)
+
+    start = time.perf_counter()
+    lut = ColorLut(hls_to_rgb_perceptual, args.lut_size)
+    print("Built a %d kB lookup table in %.1f ms"
+          % (lut.nbytes() // 1024, 1e3 * (time.perf_counter() - start)))
+
+    for pixels in args.pixels:
+        repeat = args.repeat or max(1, 2000000 // pixels)
+        print("%d pixels:" % pixels)
+        for name, function in conversions(pixels, lut, args.planar):
+            elapsed = measure(function, repeat)
+            print("  %-28s %9.1f us/frame %8.1f Mpixels/s"
+                  % (name, 1e6 * elapsed, pixels / elapsed / 1e6))
+
+
+if __name__ == "__main__":
+    main()
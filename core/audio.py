@@ -16,10 +16,12 @@
 # along with Firemix.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
+import time
 import numpy as np
 from scipy import signal
 
 from lib.color_fade import ColorFade
+from core.audio_events import AudioEventQueue, ONSET, PITCH, FFT
 
 from PyQt5 import QtCore
 
@@ -73,12 +75,27 @@ class Audio(QtCore.QObject):
 
         self._mutex = QtCore.QMutex()
 
+        # Timestamped onsets, pitch updates and FFT frames for the mixer
+        self.events = AudioEventQueue()
+        self._last_onset_time = 0.0
+        self._onset_holdoff = mixer._app.settings.get('mixer')['onset-holdoff']
+
     def fft_data(self):
         locker = QtCore.QMutexLocker(self._mutex)
         return np.multiply(self.fft, self.gain)
 
-    @QtCore.pyqtSlot()
-    def trigger_onset(self):
+    @QtCore.pyqtSlot(float)
+    def trigger_onset(self, timestamp=None):
+        """
+        Queues an onset for the mixer, stamped with the time.perf_counter()
+        time it was detected (default: now).  Onsets closer than the onset
+        holdoff to the previous one are not queued.
+        """
+        if timestamp is None:
+            timestamp = time.perf_counter()
+        if (timestamp - self._last_onset_time) > self._onset_holdoff:
+            self._last_onset_time = timestamp
+            self.events.push(ONSET, timestamp=timestamp)
         self.onset.emit()
 
     @QtCore.pyqtSlot()
@@ -108,13 +125,13 @@ class Audio(QtCore.QObject):
                 self._sim_energy = 0.5
                 hit = np.pad(hit, [0, 246], 'constant', constant_values=0)
                 self._sim_fft = hit * self._sim_energy
-                self.onset.emit()
+                self.trigger_onset()
             elif self._sim_beat == 2 and sim_beat_boundary:
                 # Snare
                 self._sim_energy = 0.4
                 hit = np.pad(hit, [40, 206], 'constant', constant_values=0)
                 self._sim_fft = hit * self._sim_energy
-                self.onset.emit()
+                self.trigger_onset()
             else:
                 self._sim_energy *= 0.9
                 if len(self._sim_fft) == 0:
@@ -140,6 +157,7 @@ class Audio(QtCore.QObject):
     def update_pitch_data(self, pitch, confidence):
         self.pitch = pitch
         self.pitch_confidence = confidence
+        self.events.push(PITCH, (pitch, confidence))
         #if confidence > 0.9:
         #    print "Pitch: %0.1f" % pitch
 
@@ -156,6 +174,7 @@ class Audio(QtCore.QObject):
 
         latest_fft = np.asarray(latest_fft)
         np.minimum(latest_fft, 0.0, latest_fft)
+        self.events.push(FFT, latest_fft)
 
         # noise_threshold = 0.1
         # np.multiply(latest_fft, 1.0 + noise_threshold, latest_fft)
@@ -0,0 +1,65 @@
+# This file is part of Firemix.
+#
+# Copyright 2013-2020 Jonathan Evans <jon@craftyjon.com>
+#
+# Firemix is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Firemix is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Firemix.  If not, see <http://www.gnu.org/licenses/>.
+
+from builtins import object
+import time
+from collections import deque, namedtuple
+
+ONSET = 'onset'
+PITCH = 'pitch'
+FFT = 'fft'
+
+# time is on the time.perf_counter() clock.  value is None for onsets, a
+# (pitch, confidence) tuple for pitch events and the raw spectrum for FFT
+# frames.
+AudioEvent = namedtuple('AudioEvent', ['time', 'kind', 'value'])
+
+
+class AudioEventQueue(object):
+    """
+    Timestamped queue of audio events, filled by the audio side as events
+    arrive and drained by the mixer once per frame.
+
+    It relies on deque.append() and deque.popleft() being atomic, so producers
+    never block the render thread.  If the mixer stops draining (e.g. while
+    frozen), the oldest events are discarded once `maxlen` are queued.
+    """
+
+    def __init__(self, maxlen=1024, clock=time.perf_counter):
+        self._events = deque(maxlen=maxlen)
+        self._clock = clock
+
+    def push(self, kind, value=None, timestamp=None):
+        if timestamp is None:
+            timestamp = self._clock()
+        self._events.append(AudioEvent(timestamp, kind, value))
+
+    def drain(self, until, out):
+        """
+        Moves all events that happened at or before `until` to the list
+        `out`, oldest first.  Returns `out`.
+        """
+        events = self._events
+        while events and events[0].time <= until:
+            out.append(events.popleft())
+        return out
+
+    def clear(self):
+        self._events.clear()
+
+    def __len__(self):
+        return len(self._events)
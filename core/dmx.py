@@ -0,0 +1,152 @@
+# This file is part of Firemix.
+#
+# Copyright 2013-2020 Jonathan Evans <jon@craftyjon.com>
+#
+# Firemix is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Firemix is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Firemix.  If not, see <http://www.gnu.org/licenses/>.
+
+from builtins import range
+from builtins import object
+import struct
+import uuid
+
+import numpy as np
+
+DMX_CHANNELS = 512
+# Pixels are never split across universes
+DEFAULT_UNIVERSE_PIXELS = DMX_CHANNELS // 3
+
+E131_PORT = 5568
+ARTNET_PORT = 6454
+
+# E1.31 identifies each source by a UUID, which should stay the same for as
+# long as the source runs
+SOURCE_CID = uuid.uuid4().bytes
+
+
+def e131_multicast_address(universe):
+    return "239.255.%d.%d" % ((universe >> 8) & 0xFF, universe & 0xFF)
+
+
+def _e131_header(universe, cid, source_name, priority):
+    """
+    Returns the 126 header bytes of an E1.31 data packet carrying a full
+    512-slot DMX universe.  The sequence number (byte 111) is left at 0.
+    """
+    length = 126 + DMX_CHANNELS
+    header = bytearray()
+    # Root layer
+    header += struct.pack("!HH12s", 0x0010, 0x0000, b"ASC-E1.17\x00\x00\x00")
+    header += struct.pack("!HI16s", 0x7000 | (length - 16), 0x00000004, cid)
+    # Framing layer
+    header += struct.pack("!HI64sBHBBH", 0x7000 | (length - 38), 0x00000002,
+                          source_name.encode('utf-8')[:63], priority, 0, 0, 0, universe)
+    # DMP layer
+    header += struct.pack("!HBBHHHB", 0x7000 | (length - 115), 0x02, 0xA1,
+                          0x0000, 0x0001, DMX_CHANNELS + 1, 0x00)
+    return bytes(header)
+
+
+def _artnet_header(universe):
+    """
+    Returns the 18 header bytes of an ArtDmx packet for a 15-bit port
+    address.  The sequence number (byte 12) is left at 0.
+    """
+    return struct.pack("<8sHBBBBBBH", b"Art-Net\x00", 0x5000, 0, 14, 0, 0,
+                       universe & 0xFF, (universe >> 8) & 0x7F,
+                       # Length is big-endian
+                       ((DMX_CHANNELS & 0xFF) << 8) | (DMX_CHANNELS >> 8))
+
+
+class DmxLayout(object):
+    """
+    Packet templates for sending the pixels of a frame as E1.31 (sACN) or
+    Art-Net DMX universes.
+
+    All the packets of a frame are rows of one 2-D buffer, with every header
+    filled in up front.  Each frame, the pixel data is copied into the DMX
+    slots (one vectorized copy per run of whole universes) and the sequence
+    numbers of all packets are set with one strided assignment.  The sequence
+    number is passed in, so that it carries on when the layout is rebuilt.
+
+    `runs` is a list of (start, end) pixel ranges, packed into consecutive
+    universes starting from `first_universe`.  With `universe_per_run`, each
+    run starts on a new universe (e.g. one per strand).
+    """
+
+    PROTOCOLS = {
+        'E1.31': (126, 111),
+        'Art-Net': (18, 12),
+    }
+
+    def __init__(self, protocol, runs, first_universe, universe_pixels=DEFAULT_UNIVERSE_PIXELS,
+                 universe_per_run=False, source_name="FireMix", priority=100):
+        self.protocol = protocol
+        header_size, sequence_offset = self.PROTOCOLS[protocol]
+        universe_pixels = max(1, min(universe_pixels, DEFAULT_UNIVERSE_PIXELS))
+
+        # Assign pixel runs to (universe index, first pixel slot) positions
+        placements = []
+        universe, slot = 0, 0
+        for start, end in runs:
+            if universe_per_run and slot > 0:
+                universe, slot = universe + 1, 0
+            placements.append((start, end, universe, slot))
+            universe += (slot + end - start) // universe_pixels
+            slot = (slot + end - start) % universe_pixels
+        count = universe + (1 if slot > 0 else 0)
+
+        self.universes = [first_universe + i for i in range(count)]
+        self.buffer = np.zeros((count, header_size + DMX_CHANNELS), dtype=np.int8)
+        raw = self.buffer.view(np.uint8)
+        for i, universe in enumerate(self.universes):
+            if protocol == 'E1.31':
+                header = _e131_header(universe, SOURCE_CID, source_name, priority)
+            else:
+                header = _artnet_header(universe)
+            raw[i, :header_size] = np.frombuffer(header, dtype=np.uint8)
+        self.packets = [self.buffer[i] for i in range(count)]
+        self._sequence = raw[:, sequence_offset]
+
+        # (destination view, source byte offset, source byte end)
+        self.copies = []
+        data = self.buffer[:, header_size:header_size + 3 * universe_pixels]
+        for start, end, universe, slot in placements:
+            pixels = end - start
+            # Finish the universe the run starts in
+            head = min(pixels, universe_pixels - slot) if slot else 0
+            if head:
+                self.copies.append((data[universe, 3 * slot:3 * (slot + head)],
+                                    3 * start, 3 * (start + head)))
+                start += head
+                pixels -= head
+                universe += 1
+            # Whole universes in one copy
+            whole = pixels // universe_pixels
+            if whole:
+                self.copies.append((data[universe:universe + whole],
+                                    3 * start, 3 * (start + whole * universe_pixels)))
+                start += whole * universe_pixels
+                pixels -= whole * universe_pixels
+                universe += whole
+            if pixels:
+                self.copies.append((data[universe, :3 * pixels], 3 * start, 3 * (start + pixels)))
+
+    def fill(self, buf, sequence):
+        """
+        Copies a frame (flat RGB8 bytes) into the packets and sets their
+        sequence number (1-255; Art-Net treats 0 as "not sequenced")
+        """
+        for dst, start, end in self.copies:
+            np.copyto(dst, buf[start:end].reshape(dst.shape))
+        self._sequence[:] = sequence
@@ -0,0 +1,150 @@
+# This file is part of Firemix.
+#
+# Copyright 2013-2020 Jonathan Evans <jon@craftyjon.com>
+#
+# Firemix is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Firemix is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Firemix.  If not, see <http://www.gnu.org/licenses/>.
+
+from builtins import object
+import logging
+import math
+import time
+from collections import deque
+
+log = logging.getLogger("firemix.core.frame_scheduler")
+
+
+class FrameScheduler(object):
+    """
+    Fixed-timestep frame scheduler.
+
+    Frames are scheduled against absolute deadlines (start + n * period) on the
+    perf_counter clock, so sleep inaccuracy never accumulates into drift.  Each
+    call to wait() blocks until the next deadline and returns the measured time
+    since the previous frame, which is what should be handed to presets.
+
+    When a frame overruns its deadline by more than one period, the scheduler
+    either skips the missed deadlines (skip_frames=True, keeps the frame grid
+    phase-locked) or renders the late frames back-to-back until it has caught
+    up (skip_frames=False).  In the latter case, a backlog of more than
+    max_catchup frames is dropped so that a long stall can't cause a burst.
+    """
+
+    def __init__(self, tick_rate, skip_frames=True, max_catchup=4,
+                 spin_time=0.001, stats_window=256,
+                 clock=time.perf_counter, sleep=time.sleep):
+        self._clock = clock
+        self._sleep = sleep
+        self.skip_frames = skip_frames
+        self.max_catchup = max_catchup
+        self.spin_time = spin_time
+        self._lateness = deque(maxlen=stats_window)
+        self._intervals = deque(maxlen=stats_window)
+        self.set_tick_rate(tick_rate)
+        self.reset()
+
+    def set_tick_rate(self, tick_rate):
+        self.tick_rate = float(tick_rate)
+        self.period = 1.0 / self.tick_rate
+
+    def reset(self):
+        """
+        Restarts the frame grid at the current time.
+        """
+        now = self._clock()
+        self._next_deadline = now
+        self._last_frame = None
+        self.frames = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.max_lateness = 0.0
+        self._lateness.clear()
+        self._intervals.clear()
+
+    def wait(self):
+        """
+        Blocks until the next frame deadline.  Returns the measured time (in
+        seconds) since the previous call, or one period for the first frame.
+        """
+        deadline = self._next_deadline
+        remaining = deadline - self._clock()
+
+        # time.sleep() may overshoot by a scheduler quantum, so sleep until
+        # slightly before the deadline and spin for the remainder.
+        if remaining > self.spin_time:
+            self._sleep(remaining - self.spin_time)
+        now = self._clock()
+        while now < deadline:
+            now = self._clock()
+
+        lateness = now - deadline
+        self._lateness.append(lateness)
+        if lateness > self.max_lateness:
+            self.max_lateness = lateness
+
+        if self._last_frame is None:
+            dt = self.period
+        else:
+            dt = now - self._last_frame
+            self._intervals.append(dt)
+        self._last_frame = now
+        self.frames += 1
+
+        self._schedule_next(now)
+        return dt
+
+    def _schedule_next(self, now):
+        self._next_deadline += self.period
+        behind = now - self._next_deadline
+        if behind < 0:
+            return
+
+        # This frame started after the next frame's deadline had passed.
+        self.overruns += 1
+        missed = int(math.floor(behind / self.period)) + 1
+        if self.skip_frames:
+            self._next_deadline += missed * self.period
+            self.skipped += missed
+        elif missed > self.max_catchup:
+            dropped = missed - self.max_catchup
+            self._next_deadline += dropped * self.period
+            self.skipped += dropped
+
+    def stats(self):
+        """
+        Returns a dict of scheduling statistics over the recent frame window.
+        Lateness is how long after its deadline a frame started; jitter is the
+        standard deviation of the interval between frames.
+        """
+        lateness = list(self._lateness)
+        intervals = list(self._intervals)
+
+        mean_lateness = sum(lateness) / len(lateness) if lateness else 0.0
+        if intervals:
+            mean_interval = sum(intervals) / len(intervals)
+            variance = sum((i - mean_interval) ** 2 for i in intervals) / len(intervals)
+            jitter = math.sqrt(variance)
+        else:
+            mean_interval = self.period
+            jitter = 0.0
+
+        return {
+            'tick-rate': self.tick_rate,
+            'frames': self.frames,
+            'overruns': self.overruns,
+            'skipped': self.skipped,
+            'mean-lateness': mean_lateness,
+            'max-lateness': self.max_lateness,
+            'mean-interval': mean_interval,
+            'jitter': jitter,
+        }
@@ -28,8 +28,15 @@ from PyQt5 import QtCore
 from lib.pattern import Pattern
 from lib.buffer_utils import BufferUtils, struct_flat
 from core.audio import Audio
+from core import audio_events
+from core.frame_scheduler import FrameScheduler
+from core.output_pipeline import OutputPipeline
+from core.preset_workers import PresetWorkerPool, fork_available
+from core.tick_profiler import TickProfiler
+from core.quality_governor import QualityGovernor
 from lib.aubio_connector import AubioConnector
 from lib.colors import clip
+from lib.scratch_arena import ScratchArena
 
 
 log = logging.getLogger("firemix.core.mixer")
@@ -56,6 +63,19 @@ class Mixer(QtCore.QObject):
         self._transition_duration = self._app.settings.get('mixer')['transition-duration']
         self._transition_slop = self._app.settings.get('mixer')['transition-slop']
         self._render_thread = None
+        self._scheduler = None
+        self._governor = None
+        self._quality = 0
+        self._output_pipeline = None
+        self._use_pipeline = self._app.settings.get('mixer').get('pipeline', False)
+        self._preset_pool = None
+        self._use_render_processes = self._app.settings.get('mixer').get('render-processes', False)
+        if self._use_render_processes and not fork_available():
+            log.warn("Rendering presets in worker processes requires fork(); disabling.")
+            self._use_render_processes = False
+        # Only convert and send the strands that presets report as changed
+        self._dirty_tracking = self._app.settings.get('mixer').get('dirty-tracking', False)
+        self._last_rendered_preset = None
         self._duration = self._app.settings.get('mixer')['preset-duration']
         self._elapsed = 0.0
         self.running = False
@@ -67,12 +87,12 @@ class Mixer(QtCore.QObject):
         self._stop_time = 0.0
         self._strand_keys = list()
         self._enable_profiling = self._app.args.profile
+        self.profiler = TickProfiler(enabled=self._enable_profiling)
         self._paused = self._app.settings.get('mixer').get('paused', False)
         self._frozen = False
-        self._last_onset_time = 0.0
-        self._onset_holdoff = self._app.settings.get('mixer')['onset-holdoff']
-        self._onset = False
-        self._reset_onset = False
+        self._frame_time = time.perf_counter()
+        self._frame_events = []
+        self._frame_onset = False
         self.global_dimmer = 1.0
         self.global_speed = 1.0
         self._render_in_progress = False
@@ -91,7 +111,6 @@ class Mixer(QtCore.QObject):
         self._audio_thread.start()
         self.aubio_connector = AubioConnector()
         self.audio = Audio(self)
-        self.audio.onset.connect(self.onset_detected)
         self.aubio_connector.onset_detected.connect(self.audio.trigger_onset)
         self.aubio_connector.fft_data.connect(self.audio.fft_data_from_network)
         self.aubio_connector.pitch_data.connect(self.audio.update_pitch_data)
@@ -116,8 +135,16 @@ class Mixer(QtCore.QObject):
         self._output_buffer = BufferUtils.create_buffer()
         self._max_pixels = maxp
 
+        # Work arrays for the render thread
+        self.scratch = ScratchArena()
+        self._nan_check_buf = self.scratch.get('nan_check', BufferUtils.get_buffer_size() * 3, bool)
+
     @QtCore.pyqtSlot()
-    def start(self):
+    def start(self, threaded=True):
+        """
+        Starts the mixer.  With threaded=False no render thread is started, and
+        the caller drives the mixer by calling run_frame() directly.
+        """
         assert self._render_thread is None, "Cannot start render thread more than once"
         self._tick_rate = self._app.settings.get('mixer')['tick-rate']
         self._last_tick_time = 1.0 / self._tick_rate
@@ -127,25 +154,50 @@ class Mixer(QtCore.QObject):
         self.reset_output_buffers()
         self.running = True
 
+        if self._use_pipeline and self._net is not None:
+            self._output_pipeline = OutputPipeline(self._net.write_buffer)
+            self._output_pipeline.start()
+
+        if self._use_render_processes:
+            self._preset_pool = PresetWorkerPool(self)
+
+        if not threaded:
+            return
+
         self._render_thread = threading.Thread(target=self._render_loop,
                                                name="Firemix-render-thread")
         self._render_thread.start()
 
     def _render_loop(self):
-        delay = 0.0
+        mixer_settings = self._app.settings.get('mixer')
+        self._scheduler = FrameScheduler(self._tick_rate,
+                                         skip_frames=mixer_settings.get('frame-skip', True),
+                                         max_catchup=mixer_settings.get('max-catchup-frames', 4))
+        # Only the real-time loop is governed, so offline renders stay at
+        # full quality and reproducible.
+        if mixer_settings.get('quality-governor', False):
+            self._governor = QualityGovernor(self._tick_rate)
         while self.running:
-            time.sleep(delay)
+            dt = self._scheduler.wait()
             if self._frozen:
-                delay = 1.0 / self._tick_rate
-            else:
-                start = time.time()
-                self._render_in_progress = True
-                self.tick(self._last_tick_time)
-                self._render_in_progress = False
-                dt = (time.time() - start)
-                delay = max(0, 1.0 / self._tick_rate - dt)
-                if not self._paused:
-                    self._elapsed += dt + delay
+                continue
+            self._render_in_progress = True
+            start = time.perf_counter()
+            self.run_frame(dt)
+            if self._governor is not None:
+                self._quality = self._governor.update(time.perf_counter() - start)
+            self._render_in_progress = False
+        self._governor = None
+        self._quality = 0
+
+    def run_frame(self, dt):
+        """
+        Renders one frame, advancing the mixer clock by dt seconds
+        """
+        self._last_tick_time = dt
+        self.tick(dt)
+        if not self._paused:
+            self._elapsed += dt
 
     @QtCore.pyqtSlot()
     def restart(self):
@@ -160,10 +212,29 @@ class Mixer(QtCore.QObject):
             self._render_thread.join()
             self._render_thread = None
 
+        if self._output_pipeline is not None:
+            self._output_pipeline.stop()
+            self._output_pipeline = None
+
+        if self._net is not None:
+            self._net.stop()
+
+        if self._preset_pool is not None:
+            self._preset_pool.stop()
+            self._preset_pool = None
+
         # TODO: Should we restart the audio thread on mixer restart?
         #self._audio_thread.quit()
         #self._audio_thread = None
 
+    def shutdown(self):
+        """
+        Stops the audio thread.  Only needed when the mixer is used without a
+        running Qt application (e.g. offline rendering).
+        """
+        self._audio_thread.quit()
+        self._audio_thread.wait()
+
     def pause(self, pause=True):
         self._paused = pause
         self._app.settings.get('mixer')['paused'] = pause
@@ -171,6 +242,26 @@ class Mixer(QtCore.QObject):
     def is_paused(self):
         return self._paused
 
+    def quality_level(self):
+        """
+        Returns the render quality level chosen by the quality governor
+        (0 is full quality)
+        """
+        return self._quality
+
+    def _apply_quality(self, preset):
+        if preset.quality != self._quality:
+            preset.set_quality(self._quality)
+
+    def frame_stats(self):
+        """
+        Returns the render thread's frame scheduling statistics
+        (see FrameScheduler.stats), or None if the mixer hasn't started.
+        """
+        if self._scheduler is None:
+            return None
+        return self._scheduler.stats()
+
     def fps(self):
         if self.running and self._num_frames > self._fps_frames:
             delta_t = time.time() - self._fps_time
@@ -186,10 +277,10 @@ class Mixer(QtCore.QObject):
 
     @QtCore.pyqtSlot()
     def onset_detected(self):
-        t = time.time()
-        if (t - self._last_onset_time) > self._onset_holdoff:
-            self._last_onset_time = t
-            self._onset = True
+        """
+        Triggers an onset now, e.g. from the GUI
+        """
+        self.audio.trigger_onset()
 
     def get_transition_by_name(self, name):
         if not name or name == "Cut":
@@ -258,6 +349,14 @@ class Mixer(QtCore.QObject):
         self._app.playlist.add_preset(classname, classname)
         self._paused = True
 
+    def reset_preset(self, preset):
+        """
+        Resets a preset, including its copy in a worker process if it has one
+        """
+        preset._reset()
+        if self._preset_pool is not None:
+            self._preset_pool.reset(preset)
+
     def set_playlist(self, playlist):
         """
         Assigns a Playlist object to the mixer
@@ -269,12 +368,33 @@ class Mixer(QtCore.QObject):
 
     def is_onset(self):
         """
-        Called by presets; resets after tick if called during tick
+        Called by presets; True if an onset was detected since the previous
+        frame.  Every preset rendered in the same frame gets the same answer.
         """
-        if self._onset:
-            self._reset_onset = True
-            return True
-        return False
+        return self._frame_onset
+
+    def frame_time(self):
+        """
+        Returns the time (on the time.perf_counter() clock) that the current
+        frame represents.  Subtract an audio event's time from this to find
+        how long before the frame it happened.
+        """
+        return self._frame_time
+
+    def frame_events(self, kind=None):
+        """
+        Returns the audio events (see core.audio_events) that arrived since the
+        previous frame, oldest first, optionally only those of one kind.
+        """
+        if kind is None:
+            return self._frame_events
+        return [e for e in self._frame_events if e.kind == kind]
+
+    def _collect_audio_events(self):
+        self._frame_time = time.perf_counter()
+        del self._frame_events[:]
+        self.audio.events.drain(self._frame_time, self._frame_events)
+        self._frame_onset = any(e.kind == audio_events.ONSET for e in self._frame_events)
 
     def __next__(self):
         #TODO: Fix this after the Playlist merge
@@ -325,6 +445,7 @@ class Mixer(QtCore.QObject):
 
     def tick(self, dt):
         self._num_frames += 1
+        self._collect_audio_events()
 
         dt *= self.global_speed
 
@@ -336,12 +457,19 @@ class Mixer(QtCore.QObject):
             if active_preset is None:
                 return
 
-            try:
-                active_preset.tick(dt)
-            except:
-                log.error("Exception raised in preset %s" % active_preset.name())
-                self.playlist.disable_presets_by_class(active_preset.__class__.__name__)
-                raise
+            self._apply_quality(active_preset)
+            # NaN checks are the first thing to go when over budget
+            check_for_nan = self._enable_profiling and self._quality == 0
+
+            # Presets rendered in worker processes are ticked there
+            if self._preset_pool is None:
+                try:
+                    with self.profiler.span('preset-tick', active_preset.__class__.__name__):
+                        active_preset.tick(dt)
+                except:
+                    log.error("Exception raised in preset %s" % active_preset.name())
+                    self.playlist.disable_presets_by_class(active_preset.__class__.__name__)
+                    raise
 
             # Handle transition by rendering both the active and the next
             # preset, and blending them together
@@ -352,7 +480,7 @@ class Mixer(QtCore.QObject):
                         self.get_next_transition()
                     if self._transition:
                         self._transition.reset()
-                    next_preset._reset()
+                    self.reset_preset(next_preset)
 
                 if self._transition_duration > 0.0 and self._transition is not None:
                     if not self._paused and not self._transition_scrubbing:
@@ -363,7 +491,10 @@ class Mixer(QtCore.QObject):
                     if not self._transition_scrubbing:
                         self.transition_progress = 1.0
 
-                next_preset.tick(dt)
+                self._apply_quality(next_preset)
+                if self._preset_pool is None:
+                    with self.profiler.span('preset-tick', next_preset.__class__.__name__):
+                        next_preset.tick(dt)
 
             # If the scene tree is available, we can do efficient mixing of presets.
             # If not, a tree would need to be constructed on-the-fly.
@@ -373,27 +504,42 @@ class Mixer(QtCore.QObject):
                 self.render_presets(active_preset, next_preset,
                                     self._transition,
                                     self.transition_progress,
-                                    check_for_nan=self._enable_profiling)
+                                    check_for_nan=check_for_nan,
+                                    dt=dt)
             else:
                 self.render_presets(active_preset,
-                                    check_for_nan=self._enable_profiling)
+                                    check_for_nan=check_for_nan,
+                                    dt=dt)
 
 
+            dirty = self._take_dirty_strands(active_preset)
+
             # Mod hue by 1 (to allow wrap-around) and clamp lightness and
             # saturation to [0, 1].
-            np.mod(self._output_buffer['hue'], 1.0, self._output_buffer['hue'])
-            np.clip(self._output_buffer['light'], 0.0, 1.0, self._output_buffer['light'])
-            np.clip(self._output_buffer['sat'], 0.0, 1.0, self._output_buffer['sat'])
-
-            # Write this buffer to enabled clients.
-            if self._net is not None:
-                self._net.write_buffer(self._output_buffer)
+            if dirty is None:
+                self._clamp_output(self._output_buffer)
+            else:
+                for strand in np.flatnonzero(dirty):
+                    start, end = BufferUtils.get_strand_extents(strand)
+                    self._clamp_output(self._output_buffer[start:end])
+
+            # Write this buffer to enabled clients, either directly or by
+            # handing it off to the output thread.
+            if self._output_pipeline is not None:
+                self._output_pipeline.submit(self._output_buffer, dirty)
+            elif self._net is not None:
+                self._net.write_buffer(self._output_buffer, dirty)
+
+            if self._preset_pool is not None:
+                can_transition = self._preset_pool.can_transition(active_preset)
+            else:
+                can_transition = active_preset.can_transition()
 
             if (not self._paused and (self._elapsed >= self._duration)
-                and active_preset.can_transition()
+                and can_transition
                 and not self._in_transition):
 
-                if (self._elapsed >= (self._duration + self._transition_slop)) or self._onset:
+                if (self._elapsed >= (self._duration + self._transition_slop)) or self._frame_onset:
                     if len(self.playlist) > 1:
                         self.start_transition()
                     self._elapsed = 0.0
@@ -406,10 +552,6 @@ class Mixer(QtCore.QObject):
                     self._elapsed = 0.0
                     self.playlist.advance()
 
-        if self._reset_onset:
-            self._onset = False
-            self._reset_onset = False
-
         if self._enable_profiling:
             tick_time = (time.time() - self._last_frame_time)
             self._last_frame_time = time.time()
@@ -417,18 +559,53 @@ class Mixer(QtCore.QObject):
                 index = int(1.0 / tick_time)
                 self._tick_time_data[index] = self._tick_time_data.get(index, 0) + 1
 
+    def _clamp_output(self, buf):
+        np.mod(buf['hue'], 1.0, buf['hue'])
+        np.clip(buf['light'], 0.0, 1.0, buf['light'])
+        np.clip(buf['sat'], 0.0, 1.0, buf['sat'])
+
+    def _take_dirty_strands(self, active_preset):
+        """
+        Returns a boolean mask of the strands that changed in the frame just
+        rendered, or None if the whole frame has to be treated as changed.
+        Partial frames are only possible when dirty tracking is enabled and
+        the same preset rendered the previous frame on its own.
+        """
+        if self._preset_pool is not None:
+            dirty = self._preset_pool.dirty_strands(active_preset)
+        else:
+            dirty = active_preset.take_dirty_strands()
+
+        same_preset = active_preset is self._last_rendered_preset
+        self._last_rendered_preset = None if self._in_transition else active_preset
+        if not self._dirty_tracking or self._in_transition or not same_preset:
+            return None
+        return dirty
+
     def scene(self):
         return self._scene
 
+    def output_buffer(self):
+        """
+        Returns the buffer holding the most recently rendered frame
+        """
+        return self._output_buffer
+
     def render_presets(self, first_preset, second_preset=None,
                        transition=None, transition_progress=0.0,
-                       check_for_nan=False):
+                       check_for_nan=False, dt=0.0):
         """
         Generates the final output buffer from either a single preset or two
         presets and a Transition.
         """
+        if self._preset_pool is not None:
+            self._render_presets_in_workers(first_preset, second_preset,
+                                            transition, transition_progress,
+                                            check_for_nan, dt)
+            return
 
-        first_preset.render(self._buffer_a)
+        with self.profiler.span('preset-render', first_preset.__class__.__name__):
+            first_preset.render(self._buffer_a)
         if check_for_nan:
             self._validate_buffer(self._buffer_a)
 
@@ -438,12 +615,45 @@ class Mixer(QtCore.QObject):
             return
 
         # Two presets
-        second_preset.render(self._buffer_b)
+        with self.profiler.span('preset-render', second_preset.__class__.__name__):
+            second_preset.render(self._buffer_b)
         if check_for_nan:
             self._validate_buffer(self._buffer_b)
 
-        transition.render(self._buffer_a, self._buffer_b,
-                          transition_progress, self._output_buffer)
+        with self.profiler.span('transition-render', transition.__class__.__name__):
+            transition.render(self._buffer_a, self._buffer_b,
+                              transition_progress, self._output_buffer)
+        if check_for_nan:
+            self._validate_buffer(self._output_buffer)
+
+    def _render_presets_in_workers(self, first_preset, second_preset,
+                                   transition, transition_progress,
+                                   check_for_nan, dt):
+        """
+        Ticks and renders the playing presets in their worker processes, then
+        blends the shared-memory buffers they rendered into.
+        """
+        playing = [first_preset] if transition is None else [first_preset, second_preset]
+        # Ticks and renders run concurrently in the workers, so only the
+        # whole round trip can be timed here.
+        with self.profiler.span('preset-render', 'worker-pool'):
+            results = self._preset_pool.render(playing, dt, self._frame_time,
+                                               self._frame_events)
+
+        for preset, (buf, error) in zip(playing, results):
+            if error is not None:
+                log.error("Exception raised in preset %s:\n%s" % (preset.name(), error))
+                self.playlist.disable_presets_by_class(preset.__class__.__name__)
+            if check_for_nan:
+                self._validate_buffer(buf)
+
+        if transition is None:
+            np.copyto(self._output_buffer, results[0][0])
+            return
+
+        with self.profiler.span('transition-render', transition.__class__.__name__):
+            transition.render(results[0][0], results[1][0],
+                              transition_progress, self._output_buffer)
         if check_for_nan:
             self._validate_buffer(self._output_buffer)
 
@@ -454,6 +664,7 @@ class Mixer(QtCore.QObject):
         self._buffer_a = BufferUtils.create_buffer()
         self._buffer_b = BufferUtils.create_buffer()
         self._output_buffer = BufferUtils.create_buffer()
+        self._last_rendered_preset = None
 
     def _validate_buffer(self, buf):
         np.isnan(struct_flat(buf), self._nan_check_buf)
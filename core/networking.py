@@ -18,33 +18,411 @@
 
 from builtins import range
 from builtins import object
-import sys
 import numpy as np
 import socket
-import array
-import struct
-import time
+import json
+import logging
+import zlib
 
-from copy import deepcopy
 from collections import defaultdict
 
+import lib.dtypes as dtypes
 from lib.colors import hls_to_rgb
 from lib.colors import hls_to_rgb_perceptual
+from lib.colors import rgb_to_hls
+from lib.colors import rgb_to_uint8
 from lib.buffer_utils import BufferUtils, struct_flat
+from lib.scratch_arena import ScratchArena
+from lib.color_lut import ColorLut
+from lib import color_modes
+from core.udp_batch import UdpBatchSender
+from core.output_service import OutputService
+from core.opc_client import OpcClient
+from core.dmx import DmxLayout, DEFAULT_UNIVERSE_PIXELS, e131_multicast_address
 
 USE_OPC = True
 
+log = logging.getLogger("firemix.core.networking")
+
+
+class OpcLayout(object):
+    """
+    The OPC messages sent to one client.  Each message is a channel and the
+    list of (start, end) pixel ranges whose data it carries.  The messages are
+    laid out back to back in one buffer, so a frame can be written to a TCP
+    connection in one go, or sent as one datagram per message.
+    """
+
+    # The length field is 16 bits
+    MAX_PIXELS = 0xFFFF // 3
+
+    def __init__(self, messages):
+        ranges_by_message = []
+        for channel, ranges in messages:
+            allowed = self.MAX_PIXELS
+            kept = []
+            for start, end in ranges:
+                end = min(end, start + allowed)
+                if end > start:
+                    kept.append((start, end))
+                    allowed -= end - start
+            if kept != list(ranges):
+                log.warning("OPC channel %d has more than %d pixels; the rest are not sent"
+                            % (channel, self.MAX_PIXELS))
+            ranges_by_message.append((channel, kept))
+
+        total = sum(4 + 3 * sum(end - start for start, end in ranges)
+                    for channel, ranges in ranges_by_message)
+        # OPC happens to look a lot like our existing protocol.
+        # Byte 0 is channel (aka strand).  0 is broadcast address, indexing starts at 1.
+        # Byte 1 is command, always 0 for "set pixel colors"
+        # Bytes 2 and 3 are big-endian length of the data block.
+        self.buffer = np.zeros(total, dtype=np.int8)
+        self.messages = []
+        # (destination view, source byte offset, source byte end)
+        self.copies = []
+
+        offset = 0
+        for channel, ranges in ranges_by_message:
+            length = 3 * sum(end - start for start, end in ranges)
+            message = self.buffer[offset:offset + 4 + length]
+            message[0] = channel
+            message[1] = 0
+            message[2] = (length & 0xFF00) >> 8
+            message[3] = (length & 0xFF)
+            position = 4
+            for start, end in ranges:
+                size = 3 * (end - start)
+                self.copies.append((message[position:position + size], 3 * start, 3 * end))
+                position += size
+            self.messages.append(message)
+            offset += 4 + length
+
+    def fill(self, buf):
+        for dst, start, end in self.copies:
+            np.copyto(dst, buf[start:end])
+
+
+def _opc_messages(client, strand_extents, enabled_strands):
+    """
+    Works out the OPC messages for a client from its "opc-map" setting:
+
+    - absent: the whole frame on channel 0
+    - "strands": each enabled strand on its own channel, numbered from 1
+    - a list of {"channel": n, "strands": [...]} and/or
+      {"channel": n, "pixels": [start, end]} entries
+    """
+    opc_map = client.get("opc-map", None)
+    if opc_map is None:
+        return [(0, [(0, BufferUtils.get_buffer_size())])]
+    if opc_map == "strands":
+        return [(strand + 1, [strand_extents[strand]]) for strand in enabled_strands]
+
+    messages = []
+    for entry in opc_map:
+        channel = entry.get("channel", 0)
+        if "strands" in entry:
+            strands = [s for s in entry["strands"] if 0 <= s < len(strand_extents)]
+            if len(strands) != len(entry["strands"]):
+                log.warning("Ignoring unknown strands in OPC map of %s:%d"
+                            % (client["host"], client["port"]))
+            messages.append((channel, [strand_extents[s] for s in strands]))
+        elif "pixels" in entry:
+            start, end = entry["pixels"]
+            end = min(end, BufferUtils.get_buffer_size())
+            messages.append((channel, [(start, end)] if end > start else []))
+    return messages
+
+
+def _dmx_layout(client, strand_extents, enabled_strands):
+    """
+    Builds the E1.31 or Art-Net packets for a client from its settings:
+    "universe" (the first universe, default 1 for E1.31 and 0 for Art-Net),
+    "universe-size" (pixels per universe, at most 170), "universe-per-strand"
+    (start each strand on a new universe) and, for E1.31, "priority".
+    """
+    protocol = client["protocol"]
+    return DmxLayout(protocol,
+                     [strand_extents[strand] for strand in enabled_strands],
+                     client.get("universe", 1 if protocol == "E1.31" else 0),
+                     client.get("universe-size", DEFAULT_UNIVERSE_PIXELS),
+                     client.get("universe-per-strand", False),
+                     priority=max(0, min(200, client.get("priority", 100))))
+
+
+def _color_lut_size(setting):
+    """
+    Reads the "color-lut" networking setting: false for none, true for the
+    default size, or a [hue, light, sat] list.  Returns the table size or
+    None.
+    """
+    if not setting:
+        return None
+    size = ColorLut.DEFAULT_SIZE if setting is True else tuple(int(x) for x in setting)
+    if len(size) != 3 or size[0] < 1 or size[0] & (size[0] - 1) or min(size[1:]) < 2:
+        log.warning("Invalid color-lut size %r (hue steps must be a power of two, light and "
+                    "sat steps at least 2), converting every pixel instead" % (setting,))
+        return None
+    return size
+
+
+def hls_to_rgb8(arr, out, convert, gamma=1.0, residual=None, scratch=None):
+    """
+    Converts the HLS array `arr` with `convert` (hls_to_rgb or
+    hls_to_rgb_perceptual), raises it to `gamma` and rounds it into `out`, a
+    uint8 array of shape arr.shape + (3,), with an optional dithering
+    `residual` (see rgb_to_uint8).
+    """
+    if scratch is None:
+        scratch = ScratchArena()
+    buffer_rgb = scratch.like('rgb', arr, dtypes.rgb_color)
+    convert(arr, buffer_rgb, scratch)
+    if gamma != 1.0:
+        np.power(struct_flat(buffer_rgb), gamma, struct_flat(buffer_rgb))
+    return rgb_to_uint8(buffer_rgb, out, residual, scratch)
+
+
+class Rgb8Encoder(object):
+    """
+    Converts frames to RGB8 with the gamma, lookup table and dithering
+    settings of the "networking" section, exactly as they are sent to
+    clients, for frames that don't go through Networking (offline renders and
+    show crossfades).
+    """
+
+    def __init__(self, settings):
+        self.gamma = float(settings.get('gamma', 1.0))
+        self.dithering = settings.get('dithering', False)
+        # As in OutputPlan, dithering needs the unrounded colors
+        self.color_lut = (None if self.dithering
+                          else _color_lut_size(settings.get('color-lut', False)))
+        self._luts = {}
+        self._residual = None
+        self._scratch = ScratchArena()
+
+    def encode(self, arr, out, convert):
+        """
+        Converts the HLS array `arr` with `convert` into `out`, a contiguous
+        uint8 array of shape arr.shape + (3,)
+        """
+        if self.color_lut is not None:
+            lut = self._luts.get(convert, None)
+            if lut is None:
+                lut = ColorLut(convert, self.color_lut, self.gamma)
+                self._luts[convert] = lut
+            return lut.lookup(arr, out, self._scratch)
+
+        residual = None
+        if self.dithering:
+            if self._residual is None or self._residual.shape != out.shape:
+                self._residual = np.zeros(out.shape, dtype=np.float32)
+            residual = self._residual
+        return hls_to_rgb8(arr, out, convert, self.gamma, residual, self._scratch)
+
+
+class LegacyLayout(object):
+    """
+    The Legacy packets of a frame in one color mode: the begin marker, one
+    packet per enabled strand and the end marker, laid out in one contiguous
+    buffer with the headers filled in.
+    """
+
+    def __init__(self, mode, strand_extents, enabled_strands):
+        self.mode = mode
+        size = color_modes.bytes_per_pixel[mode]
+        total = sum(4 + size * (strand_extents[strand][1] - strand_extents[strand][0])
+                    for strand in enabled_strands)
+        self.datagrams = np.zeros(total + 2, dtype=np.int8)
+        self.begin = self.datagrams[:1]
+        self.begin[0] = ord('B')
+        self.end = self.datagrams[-1:]
+        self.end[0] = ord('E')
+
+        # (strand, byte offset, byte end, packet, packet payload) for each
+        # enabled strand
+        self.packets = []
+        offset = 1
+        for strand in enabled_strands:
+            start, end = strand_extents[strand]
+            start *= size
+            end *= size
+            length = end - start
+            packet = self.datagrams[offset:offset + length + 4]
+            offset += length + 4
+            packet[0] = ord('S')
+            packet[1] = strand
+            packet[2] = length & 0x00FF
+            packet[3] = (length & 0xFF00) >> 8
+            self.packets.append((strand, start, end, packet, packet[4:]))
+
+
+class OutputPlan(object):
+    """
+    Everything the output path needs to know about the enabled clients and
+    strands, worked out once from the settings and scene: client addresses
+    grouped by protocol, the pixel extents of each strand, the wire formats
+    (color mode, dimmed or not) that have to be encoded each frame, and the
+    packet buffers (with headers already filled in) that each frame is copied
+    into.
+
+    A plan is rebuilt whenever Networking.invalidate_plan() is called, so the
+    per-frame path only has to fill in pixel data and send.
+    """
+
+    def __init__(self, version, clients, strand_settings, async_output=False, dedup=False,
+                 dithering=False, color_lut=None, gamma=1.0):
+        self.version = version
+        self.async_output = async_output
+        self.dedup = dedup
+        self.dithering = dithering
+        # The (hue, light, sat) size of the RGB8 lookup table, or None to
+        # convert every pixel.  Dithering needs the unrounded colors, so it
+        # always converts.
+        self.color_lut = None if dithering else color_lut
+        self.gamma = gamma
+
+        enabled = [c for c in clients if c["enabled"]]
+
+        self.strand_extents = [BufferUtils.get_strand_extents(strand)
+                               for strand in range(BufferUtils.num_strands)]
+
+        enabled_strands = [strand for strand in range(len(strand_settings))
+                           if strand_settings[strand]["enabled"]]
+
+        # RGB8 frames are encoded with each strand's channel order, so every
+        # protocol sends them as is.  (start, end, swizzle) regions covering
+        # the frame, and the region of each strand.
+        self.strand_regions = [(start, end, strand_settings[strand].get("color-mode") == "BGR8")
+                               if strand < len(strand_settings) else (start, end, False)
+                               for strand, (start, end) in enumerate(self.strand_extents)]
+        self.swizzled = any(swizzle for start, end, swizzle in self.strand_regions)
+        if self.swizzled:
+            self.frame_regions = self.strand_regions
+        else:
+            self.frame_regions = [(0, BufferUtils.get_buffer_size(), False)]
+
+        # Legacy clients by (color mode, dimmed), and a packet layout for
+        # each color mode.  Clients with "delta" set are kept apart, as they
+        # only get the changed pixels of each strand between keyframes.
+        self.legacy = {}
+        self.legacy_delta = {}
+        self.legacy_layouts = {}
+        for c in enabled:
+            if c.get("protocol", "Legacy") != "Legacy":
+                continue
+            mode = c.get("color-mode", "RGB8")
+            if mode not in color_modes.modes:
+                log.warning("Unknown color mode %s for %s:%d, sending RGB8"
+                            % (mode, c["host"], c["port"]))
+                mode = "RGB8"
+            key = (mode, not c.get('ignore-dimming'))
+            target = self.legacy_delta if c.get("delta") else self.legacy
+            target.setdefault(key, []).append((c["host"], c["port"]))
+            if mode not in self.legacy_layouts:
+                self.legacy_layouts[mode] = LegacyLayout(mode, self.strand_extents,
+                                                         enabled_strands)
+
+        # OPC is spoken over TCP; OPC-UDP sends the same messages as datagrams.
+        # Each is a list of (address, layout); clients with the same OPC map
+        # share a layout, so it is only filled once per frame.
+        self.opc_layouts = {}
+        self.opc = []
+        self.opc_udp = []
+        for c in enabled:
+            protocol = c.get("protocol")
+            if protocol not in ("OPC", "OPC-UDP"):
+                continue
+            key = json.dumps(c.get("opc-map", None), sort_keys=True)
+            layout = self.opc_layouts.get(key, None)
+            if layout is None:
+                layout = OpcLayout(_opc_messages(c, self.strand_extents, enabled_strands))
+                self.opc_layouts[key] = layout
+            target = self.opc if protocol == "OPC" else self.opc_udp
+            target.append(((c["host"], c["port"]), layout))
+
+        # E1.31 and Art-Net: a list of (layout, datagrams, ignore dimming),
+        # where datagrams is a list of (packet, address) for every client
+        # sharing the layout.  E1.31 clients may send each universe to its
+        # own multicast group instead of their host.
+        dmx_layouts = {}
+        self.dmx = []
+        for c in enabled:
+            protocol = c.get("protocol")
+            if protocol not in ("E1.31", "Art-Net"):
+                continue
+            ignore_dimming = bool(c.get('ignore-dimming'))
+            key = json.dumps([protocol, ignore_dimming, c.get("universe"), c.get("universe-size"),
+                              c.get("universe-per-strand"), c.get("priority")])
+            if key not in dmx_layouts:
+                dmx_layouts[key] = len(self.dmx)
+                self.dmx.append((_dmx_layout(c, self.strand_extents, enabled_strands),
+                                 [], ignore_dimming))
+            layout, datagrams, _ = self.dmx[dmx_layouts[key]]
+            for packet, universe in zip(layout.packets, layout.universes):
+                if protocol == "E1.31" and c.get("multicast"):
+                    datagrams.append((packet, (e131_multicast_address(universe), c["port"])))
+                else:
+                    datagrams.append((packet, (c["host"], c["port"])))
+
+        # Each wire format that some client needs is encoded once per frame,
+        # undimmed ones first.  OPC, E1.31 and Art-Net are always RGB8.
+        encodings = set(self.legacy) | set(self.legacy_delta)
+        if self.opc or self.opc_udp or any(not ignore for _, _, ignore in self.dmx):
+            encodings.add(("RGB8", True))
+        if any(ignore for _, _, ignore in self.dmx):
+            encodings.add(("RGB8", False))
+        self.encodings = sorted(encodings, key=lambda e: (e[1], color_modes.modes.index(e[0])))
+
+        self.addresses = ([address for key in self.legacy for address in self.legacy[key]]
+                          + [address for key in self.legacy_delta
+                             for address in self.legacy_delta[key]]
+                          + [address for address, layout in self.opc_udp]
+                          + [address for _, datagrams, _ in self.dmx
+                             for _, address in datagrams])
+
+        # Prepared full-frame batches, by destination list
+        self.batches = {}
+
 
 class Networking(object):
 
+    # When only changed strands are being sent, a full frame still goes out
+    # this often (in frames), to recover from dropped packets.
+    KEYFRAME_INTERVAL = 30
+
     def __init__(self, app):
         self.socket = None
         self.context = None
         self._app = app
         self.running = True
         self.open_socket()
-        # Maps client type to list of packet buffers
-        self._packet_cache = {}
+        self._sender = UdpBatchSender(self.socket)
+        # Asynchronous per-client output, if enabled in the settings
+        self._service = None
+        # Maps (host, port) to the connection to that OPC server
+        self._opc_clients = {}
+        # The output plan is rebuilt when its version falls behind
+        self._plan = None
+        self._plan_version = 0
+        # Conversion buffers.  write_buffer() may run on the output thread, so
+        # this is separate from the mixer's arena.
+        self._scratch = ScratchArena()
+        # Encoded frames from the last write by (color mode, dimmed), kept
+        # for partial updates
+        self._frames = {}
+        self._converted = set()
+        self._output_state = None
+        self._frames_since_keyframe = 0
+        self._dmx_sequence = 0
+        # With dedup, a hash of each strand's bytes by (color mode, dimmed)
+        self._strand_hashes = {}
+        # The frames last sent to delta clients, by (color mode, dimmed)
+        self._delta_frames = {}
+        # With dithering, the rounding error of each RGB8 channel carried
+        # over to the next frame, by (color mode, dimmed)
+        self._residuals = {}
+        # RGB8 lookup tables by conversion, built when first needed
+        self._color_luts = {}
         self.port = 3020
         self.opc_port = 7890
 
@@ -52,115 +430,430 @@ class Networking(object):
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
 
-    def write_buffer(self, buffer):
+    def invalidate_plan(self):
         """
-        Performs a bulk strand write.
-        Decodes the HLS-Float data according to client settings
+        Must be called after the networking clients or the strand settings
+        change.  The new settings take effect from the next frame written.
         """
-        strand_settings = self._app.scene.get_strand_settings()
-        clients = [client for client in self._app.settings['networking']['clients'] if client["enabled"]]
-
-        clients_by_type = defaultdict(list)
-        have_non_dimmed = False
-        for c in clients:
-            clients_by_type[c.get("protocol", "Legacy")].append(c)
-
-        dimmed_legacy_clients = [c for c in clients_by_type["Legacy"] if not c.get('ignore-dimming')]
-        undimmed_legacy_clients = [c for c in clients_by_type["Legacy"] if c.get('ignore-dimming')]
-        opc_clients = clients_by_type["OPC"]
-
-        if undimmed_legacy_clients:
-            # Protect against presets or transitions that write float data.
-            buffer_rgb = hls_to_rgb_perceptual(buffer)
-            buffer_rgb_int = np.int8(struct_flat(buffer_rgb) * 255)
+        self._plan_version += 1
+
+    def _get_plan(self):
+        plan = self._plan
+        version = self._plan_version
+        if plan is None or plan.version != version:
+            settings = self._app.settings['networking']
+            plan = OutputPlan(version, settings['clients'],
+                              self._app.scene.get_strand_settings(),
+                              settings.get('async-output', False),
+                              settings.get('dedup', False),
+                              settings.get('dithering', False),
+                              _color_lut_size(settings.get('color-lut', False)),
+                              float(settings.get('gamma', 1.0)))
+            self._plan = plan
+            self._update_clients(plan)
+        return plan
+
+    def _update_clients(self, plan):
+        if plan.async_output:
+            if self._service is None:
+                self._service = OutputService()
+                self._service.start()
+            self._service.retain(plan.addresses)
+        elif self._service is not None:
+            self._service.stop()
+            self._service = None
+
+        opc_addresses = [address for address, layout in plan.opc]
+        for address in list(self._opc_clients):
+            if address not in opc_addresses:
+                self._opc_clients.pop(address).close()
+        for address in opc_addresses:
+            if address not in self._opc_clients:
+                self._opc_clients[address] = OpcClient(address)
+
+    def stop(self):
+        """
+        Stops the output service, if running, and closes all OPC connections.
+        They are restarted by the next write.
+        """
+        if self._service is not None:
+            self._service.stop()
+            self._service = None
+        for client in self._opc_clients.values():
+            client.close()
+        self._opc_clients = {}
+        self._plan = None
+
+    def output_stats(self):
+        """
+        Returns the send statistics of each client connection, keyed by
+        "host:port"
+        """
+        stats = {} if self._service is None else self._service.stats()
+        for client in list(self._opc_clients.values()):
+            stats["%s:%d" % client.address] = dict(client.stats)
+        return stats
 
-            self._write_legacy(buffer_rgb_int, strand_settings, undimmed_legacy_clients)
+    def write_buffer(self, buffer, dirty_strands=None):
+        """
+        Performs a bulk strand write.
+        Decodes the HLS-Float data according to client settings
 
-        # Now that we've written to clients that don't want dimmed data, apply
-        # the global dimmer from the mixer and re-convert to RGB
-        if self._app.mixer.global_dimmer < 1.0:
-            buffer['light'] *= self._app.mixer.global_dimmer
-        if self._app.mixer.useColorCorrections:
-            buffer_rgb = hls_to_rgb_perceptual(buffer)
+        dirty_strands is an optional boolean mask of the strands that changed
+        since the previous call.  When given, only those strands are converted
+        and sent to Legacy clients; the rest of each RGB frame is kept from
+        the previous call.
+        """
+        previous_plan = self._plan
+        plan = self._get_plan()
+
+        profiler = self._app.mixer.profiler
+        dimmer = self._app.mixer.global_dimmer
+        corrections = self._app.mixer.useColorCorrections
+
+        # Send a full frame whenever the clients or conversion settings
+        # change, and every so often anyway so that strands recover from lost
+        # packets.  Without dedup, any frame that is converted in full is
+        # also sent in full, so it counts as a keyframe.
+        self._frames_since_keyframe += 1
+        keyframe = (plan is not previous_plan
+                    or self._frames_since_keyframe >= self.KEYFRAME_INTERVAL
+                    or self._output_state != (dimmer, corrections))
+        if keyframe:
+            dirty_strands = None
+        if dirty_strands is None and not plan.dedup:
+            keyframe = True
+        if keyframe:
+            self._frames_since_keyframe = 0
+        self._output_state = (dimmer, corrections)
+
+        frames = {}
+        for key in plan.encodings:
+            mode, dimmed = key
+            # Undimmed frames are always colour corrected, to protect against
+            # presets or transitions that write float data.  Dimmed frames
+            # are a copy, so the mixer's buffer is left untouched.
+            lut = None
+            if mode != "RGB8":
+                conversion = mode
+            else:
+                conversion = 'perceptual' if corrections or not dimmed else 'linear'
+                if plan.color_lut is not None:
+                    lut = self._color_lut(conversion, plan)
+            label = conversion if lut is None else conversion + '-lut'
+            with profiler.span('colour-conversion', label):
+                frame, sent = self._encode(mode, dimmed, buffer, plan, dirty_strands,
+                                           hls_to_rgb if conversion == 'linear'
+                                           else hls_to_rgb_perceptual,
+                                           dimmer if dimmed else 1.0, lut)
+                if plan.dedup:
+                    sent = self._dedup(key, frame, plan, sent, keyframe)
+            # Whole-frame protocols skip frames where no strand changed
+            frames[key] = None if sent is not None and not sent.any() else frame
+
+            clients = plan.legacy.get(key, None)
+            if clients:
+                with profiler.span('network-send', 'Legacy'):
+                    self._write_legacy(frame, plan, plan.legacy_layouts[mode], clients, sent)
+
+            clients = plan.legacy_delta.get(key, None)
+            if clients:
+                with profiler.span('network-send', 'Legacy'):
+                    self._write_legacy_delta(key, frame, plan, clients, sent, keyframe)
+
+        if (plan.opc or plan.opc_udp) and frames[("RGB8", True)] is not None:
+            with profiler.span('network-send', 'OPC'):
+                self._write_opc(frames[("RGB8", True)], plan)
+
+        if plan.dmx:
+            with profiler.span('network-send', 'DMX'):
+                self._write_dmx(frames.get(("RGB8", True), None),
+                                frames.get(("RGB8", False), None), plan)
+
+        self._converted = set(frames)
+
+    def _dedup(self, key, frame, plan, sent, keyframe):
+        """
+        Hashes the encoded bytes of each strand in the mask `sent` (all
+        strands if None) and returns the mask of strands whose bytes changed
+        since they were last hashed.  On a keyframe, every strand is sent
+        anyway, so this returns None once the hashes are up to date.
+        """
+        size = color_modes.bytes_per_pixel[key[0]]
+        hashes = self._strand_hashes.get(key, None)
+        if hashes is None or len(hashes) != len(plan.strand_extents):
+            # crc32 is unsigned, so -1 never matches
+            hashes = np.full(len(plan.strand_extents), -1, dtype=np.int64)
+            self._strand_hashes[key] = hashes
+            keyframe = True
+
+        changed = np.zeros(len(plan.strand_extents), dtype=bool)
+        strands = range(len(plan.strand_extents)) if sent is None else np.flatnonzero(sent)
+        for strand in strands:
+            start, end = plan.strand_extents[strand]
+            crc = zlib.crc32(frame[size * start:size * end])
+            if crc != hashes[strand]:
+                hashes[strand] = crc
+                changed[strand] = True
+
+        return None if keyframe else changed
+
+    def _color_lut(self, conversion, plan):
+        """
+        Returns the RGB8 lookup table for `conversion` ('perceptual' or
+        'linear'), building it if the plan's table settings have changed
+        """
+        lut = self._color_luts.get(conversion, None)
+        if lut is None or lut.size != plan.color_lut or lut.gamma != plan.gamma:
+            lut = ColorLut(hls_to_rgb if conversion == 'linear' else hls_to_rgb_perceptual,
+                           plan.color_lut, plan.gamma)
+            self._color_luts[conversion] = lut
+        return lut
+
+    def _encode(self, mode, dimmed, buffer, plan, dirty_strands, convert, dimmer=1.0, lut=None):
+        """
+        Encodes `buffer` in the wire format of color mode `mode` into the
+        persistent frame for (mode, dimmed), which all clients that want that
+        format share.  RGB8 is converted with `convert` (or looked up in
+        `lut`) and written in each strand's channel order: the conversion
+        writes BGR8 strands through a reversed view, so swapping channels
+        costs no extra copy.
+
+        If `dirty_strands` is given, only those strands are encoded and the
+        rest of the frame is left as it was.  Returns the frame (as bytes)
+        and the mask of strands that were encoded (None for all of them).
+        """
+        key = (mode, dimmed)
+        size = color_modes.bytes_per_pixel[mode]
+        frame = self._frames.get(key, None)
+        if frame is None or len(frame) != size * len(buffer):
+            frame = np.zeros(size * len(buffer), dtype=np.int8)
+            self._frames[key] = frame
+            self._residuals.pop(key, None)
+            dirty_strands = None
+        elif key not in self._converted:
+            # Not encoded last frame, so the whole frame is stale
+            dirty_strands = None
+
+        if dirty_strands is None:
+            regions = plan.frame_regions
         else:
-            buffer_rgb = hls_to_rgb(buffer)
-
-        buffer_rgb_int = np.int8(struct_flat(buffer_rgb) * 255)
-
-        if dimmed_legacy_clients:
-            self._write_legacy(buffer_rgb_int, strand_settings, dimmed_legacy_clients)
-
-        if opc_clients:
-            self._write_opc(buffer_rgb_int, strand_settings, opc_clients)
-
-    def _write_legacy(self, buf, strand_settings, clients):
-        packets = []
-
-        if 'legacy' not in self._packet_cache:
-            self._packet_cache['legacy'] = [None] * len(strand_settings)
-
-        for strand in range(len(strand_settings)):
-            if not strand_settings[strand]["enabled"]:
+            regions = [plan.strand_regions[strand] for strand in np.flatnonzero(dirty_strands)]
+
+        residual = None
+        if plan.dithering and mode == "RGB8":
+            residual = self._residuals.get(key, None)
+            if residual is None:
+                residual = np.zeros((len(buffer), 3), dtype=np.float32)
+                self._residuals[key] = residual
+
+        for start, end, swizzle in regions:
+            src = buffer[start:end]
+            if lut is not None:
+                out = frame[3 * start:3 * end].view(np.uint8).reshape((-1, 3))
+                lut.lookup(src, out, self._scratch, dimmer, swizzle)
                 continue
+            if dimmer < 1.0:
+                # Copying the flat view is much faster than a structured copy
+                dimmed_src = self._scratch.like('dimmed', src)
+                np.copyto(struct_flat(dimmed_src), struct_flat(src))
+                np.multiply(dimmed_src['light'], dimmer, dimmed_src['light'])
+                src = dimmed_src
+            if mode == "RGB8":
+                out = frame[3 * start:3 * end].view(np.uint8).reshape((-1, 3))
+                hls_to_rgb8(src, out[:, ::-1] if swizzle else out, convert, plan.gamma,
+                            None if residual is None else residual[start:end], self._scratch)
+            else:
+                out = frame[size * start:size * end].view(np.float32).reshape((-1, 3))
+                color_modes.float_encoders[mode](src, out, self._scratch)
+
+        return frame, dirty_strands
+
+    def write_rgb8(self, buffer_rgb_int):
+        """
+        Writes a frame that is already in RGB8 wire format (a flat array of
+        pixels * 3 bytes, e.g. from a pre-rendered show) to all enabled
+        clients.  No colour conversion or dimming is applied, apart from
+        each strand's channel order and the float color modes of Legacy
+        clients.
+        """
+        plan = self._get_plan()
+
+        frame = buffer_rgb_int
+        if plan.swizzled:
+            frame = self._scratch.get('show.rgb8', buffer_rgb_int.shape, np.int8)
+            for start, end, swizzle in plan.frame_regions:
+                src = buffer_rgb_int[3 * start:3 * end].reshape((-1, 3))
+                np.copyto(frame[3 * start:3 * end].reshape((-1, 3)),
+                          src[:, ::-1] if swizzle else src)
+
+        buffer_hls = None
+        for mode, layout in plan.legacy_layouts.items():
+            clients = [address for key in ((mode, False), (mode, True))
+                       for address in plan.legacy.get(key, []) + plan.legacy_delta.get(key, [])]
+            encoded = frame
+            if mode != "RGB8":
+                if buffer_hls is None:
+                    pixels = buffer_rgb_int.view(np.uint8).reshape((-1, 3))
+                    buffer_hls = rgb_to_hls(pixels,
+                                            self._scratch.get('show.hls', len(pixels),
+                                                              dtypes.hls_color),
+                                            self._scratch)
+                encoded = self._scratch.get('show.' + mode,
+                                            color_modes.bytes_per_pixel[mode] * len(buffer_hls),
+                                            np.int8)
+                color_modes.float_encoders[mode](
+                    buffer_hls, encoded.view(np.float32).reshape((-1, 3)), self._scratch)
+            self._write_legacy(encoded, plan, layout, clients)
+
+        if plan.opc or plan.opc_udp:
+            self._write_opc(frame, plan)
+
+        if plan.dmx:
+            self._write_dmx(frame, frame, plan)
+
+    def _write_legacy(self, buf, plan, layout, clients, dirty_strands=None):
+        """
+        Sends one packet per enabled strand, or only for the strands set in
+        `dirty_strands` if given.  The whole frame goes out as one batch.
+        """
+        if dirty_strands is not None and not dirty_strands.any():
+            return
+
+        if plan.async_output:
+            datagrams = []
+            for strand, start, end, packet, payload in layout.packets:
+                if dirty_strands is not None and not dirty_strands[strand]:
+                    continue
+                np.copyto(payload, buf[start:end])
+                datagrams.append((strand, packet.tobytes()))
+            self._service.send(clients, datagrams, dirty_strands is None,
+                               header=(b'B',), footer=(b'E',))
+            return
+
+        packets = [layout.begin]
+        for strand, start, end, packet, payload in layout.packets:
+            if dirty_strands is not None and not dirty_strands[strand]:
+                continue
+            np.copyto(payload, buf[start:end])
+            packets.append(packet)
+        packets.append(layout.end)
+
+        if dirty_strands is None:
+            key = ('Legacy', layout.mode, tuple(clients))
+            batch = plan.batches.get(key, None)
+            if batch is None:
+                batch = self._sender.prepare(packets, clients)
+                plan.batches[key] = batch
+        else:
+            batch = self._sender.prepare(packets, clients)
+        self._sender.send(batch)
 
-            start, end = BufferUtils.get_strand_extents(strand)
-            start *= 3
-            end *= 3
-
-            packet_header_size = 4
-            packet_size = (end-start) + packet_header_size
-
-            packet = self._packet_cache['legacy'][strand]
-            if packet is None:
-                packet = np.zeros(packet_size, dtype=np.int8)
-                self._packet_cache['legacy'][strand] = packet
-
-            length = packet_size - packet_header_size
-
-            packet[0] = ord('S')
-            packet[1] = strand
-            packet[2] = length & 0x00FF
-            packet[3] = (length & 0xFF00) >> 8
+    def _write_legacy_delta(self, key, frame, plan, clients, sent, keyframe):
+        """
+        Sends delta clients only the pixels that changed since the frame last
+        sent to them.  Each strand in `sent` (all strands if None) with any
+        changed pixels gets one packet covering its first to last changed
+        pixel:
 
-            np.copyto(packet[packet_header_size:], buf[start:end])
-            packets.append(packet)
+            'D', strand, offset (pixels, 16-bit LE), length (bytes, 16-bit LE), data
 
-        for client in clients:
-            try:
-                self.socket.sendto(array.array('B', [ord('B')]), (client["host"], client["port"]))
-                for packet in packets:
-                    self.socket.sendto(packet, (client["host"], client["port"]))
-                self.socket.sendto(array.array('B', [ord('E')]), (client["host"], client["port"]))
-            except socket.gaierror:
-                print("Bad hostname: ", client["host"])
+        Keyframes are sent as usual.  With async output, a frame may replace
+        one that was never sent, so delta clients get the changed strands as
+        normal packets instead.
+        """
+        layout = plan.legacy_layouts[key[0]]
+        previous = self._delta_frames.get(key, None)
+        if keyframe or previous is None or len(previous) != len(frame):
+            self._write_legacy(frame, plan, layout, clients)
+            self._delta_frames[key] = frame.copy()
+            return
+        if plan.async_output:
+            self._write_legacy(frame, plan, layout, clients, sent)
+            np.copyto(previous, frame)
+            return
+
+        size = color_modes.bytes_per_pixel[key[0]]
+        data = self._scratch.get('delta', len(layout.datagrams) + 2 * len(layout.packets), np.int8)
+        packets = [layout.begin]
+        offset = 0
+        for strand, start, end, packet, payload in layout.packets:
+            if sent is not None and not sent[strand]:
                 continue
-            except:
+            current = frame[start:end].reshape((-1, size))
+            last = previous[start:end].reshape((-1, size))
+            changed = np.flatnonzero((current != last).any(axis=1))
+            if len(changed) == 0:
+                continue
+            first, stop = changed[0], changed[-1] + 1
+            length = size * (stop - first)
+            delta = data[offset:offset + 6 + length]
+            offset += 6 + length
+            delta[0] = ord('D')
+            delta[1] = strand
+            delta[2] = first & 0x00FF
+            delta[3] = (first & 0xFF00) >> 8
+            delta[4] = length & 0x00FF
+            delta[5] = (length & 0xFF00) >> 8
+            np.copyto(delta[6:].reshape((-1, size)), current[first:stop])
+            np.copyto(last[first:stop], current[first:stop])
+            packets.append(delta)
+
+        if len(packets) > 1:
+            packets.append(layout.end)
+            self._sender.send(self._sender.prepare(packets, clients))
+
+    def _write_opc(self, buf, plan):
+        for layout in plan.opc_layouts.values():
+            layout.fill(buf)
+
+        # Connections send all of their messages straight from the layout
+        # buffer, which clients with the same map share
+        for address, layout in plan.opc:
+            self._opc_clients[address].send(layout.buffer)
+
+        # Over UDP each message is a datagram of its own
+        datagrams = {}
+        for address, layout in plan.opc_udp:
+            if plan.async_output:
+                if layout not in datagrams:
+                    datagrams[layout] = [(i, message.tobytes())
+                                         for i, message in enumerate(layout.messages)]
+                self._service.send([address], datagrams[layout])
+            else:
+                try:
+                    for message in layout.messages:
+                        self.socket.sendto(message, address)
+                except socket.gaierror:
+                    print("Bad hostname: ", address[0])
+                except OSError:
+                    continue
+
+    def _write_dmx(self, dimmed, undimmed, plan):
+        """
+        Sends every universe of every E1.31 and Art-Net client.  These
+        protocols always get the full frame, unless a frame is None because
+        nothing in it changed.
+        """
+        self._dmx_sequence = self._dmx_sequence % 255 + 1
+        for i, (layout, datagrams, ignore_dimming) in enumerate(plan.dmx):
+            frame = undimmed if ignore_dimming else dimmed
+            if frame is None:
+                # Unchanged since the last frame sent
+                continue
+            layout.fill(frame, self._dmx_sequence)
+
+            if plan.async_output:
+                by_address = defaultdict(list)
+                for universe, (packet, address) in enumerate(datagrams):
+                    by_address[address].append((universe, packet.tobytes()))
+                for address, universe_data in by_address.items():
+                    self._service.send([address], universe_data)
                 continue
 
-
-    def _write_opc(self, buf, strand_settings, clients):
-        packet_data_len = len(buf)
-        packet_size = packet_data_len + 4
-
-        if 'opc' not in self._packet_cache:
-            self._packet_cache['opc'] = [np.empty(packet_size, dtype=np.int8)]
-
-        packet = self._packet_cache['opc'][0]
-
-        # OPC happens to look a lot like our existing protocol.
-        # Byte 0 is channel (aka strand).  0 is broadcast address, indexing starts at 1.
-        # Byte 1 is command, always 0 for "set pixel colors"
-        # Bytes 2 and 3 are big-endian length of the data block.
-        #
-        # Both LEDScape and the OPC reference implementation actually seem to
-        # ignore the strand address and just assume that the data for all
-        # strands is sent in a single broadcast packet. So, we do that here.
-
-        packet[0] = 0
-        packet[1] = 0
-        packet[2] = (packet_data_len & 0xFF00) >> 8
-        packet[3] = (packet_data_len & 0xFF)
-        np.copyto(packet[4:], buf)
-
-        for client in clients:
-            self.socket.sendto(packet, (client["host"], client["port"]))
+            key = ('DMX', i)
+            batch = plan.batches.get(key, None)
+            if batch is None:
+                batch = self._sender.prepare_datagrams(datagrams)
+                plan.batches[key] = batch
+            self._sender.send(batch)
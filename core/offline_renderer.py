@@ -0,0 +1,111 @@
+# This file is part of Firemix.
+#
+# Copyright 2013-2020 Jonathan Evans <jon@craftyjon.com>
+#
+# Firemix is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Firemix is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Firemix.  If not, see <http://www.gnu.org/licenses/>.
+
+from builtins import range
+from builtins import object
+import logging
+import time
+
+import numpy as np
+
+import lib.dtypes as dtypes
+from core.networking import Rgb8Encoder
+from lib.buffer_utils import BufferUtils
+from lib.colors import hls_to_rgb, hls_to_rgb_perceptual
+
+log = logging.getLogger("firemix.core.offline_renderer")
+
+
+def open_frame_file(path, dtype, shape, mode='w+'):
+    """
+    Memory-maps a frame file.  Files ending in .npy get a numpy header so they
+    can be loaded with np.load(); anything else is treated as raw frame data.
+    """
+    if path.endswith(".npy"):
+        if mode == 'w+':
+            return np.lib.format.open_memmap(path, mode=mode, dtype=dtype, shape=shape)
+        return np.load(path, mmap_mode=mode)
+    return np.memmap(path, dtype=dtype, mode=mode, shape=shape)
+
+
+class OfflineRenderer(object):
+    """
+    Renders the mixer output as fast as possible in simulated time, without
+    the render thread, the Qt event loop or network output.  Every frame is
+    written to a memory-mapped file, either as HLS floats (dtypes.pixel_color)
+    or as RGB8 in the same form that is sent to network clients, including
+    the gamma, lookup table and dithering settings.
+    """
+
+    FORMATS = ["hls", "rgb8"]
+
+    def __init__(self, app, tick_rate, frame_format="rgb8"):
+        if frame_format not in self.FORMATS:
+            raise ValueError("Unknown frame format %s" % frame_format)
+        self._app = app
+        self._mixer = app.mixer
+        self._dt = 1.0 / tick_rate
+        self._format = frame_format
+        self._encoder = Rgb8Encoder(app.settings['networking'])
+
+    def frame_shape(self):
+        if self._format == "hls":
+            return (BufferUtils.get_buffer_size(),)
+        return (BufferUtils.get_buffer_size(), 3)
+
+    def frame_dtype(self):
+        if self._format == "hls":
+            return dtypes.pixel_color
+        return np.uint8
+
+    def render(self, path, duration):
+        """
+        Renders `duration` seconds of simulated time to `path`.
+        Returns the number of frames written.
+        """
+        num_frames = int(round(duration / self._dt))
+        frames = open_frame_file(path, self.frame_dtype(),
+                                 (num_frames,) + self.frame_shape())
+
+        log.info("Rendering %d frames to %s" % (num_frames, path))
+        self._mixer.start(threaded=False)
+        start = time.time()
+        try:
+            for i in range(num_frames):
+                self._mixer.run_frame(self._dt)
+                self._store_frame(frames[i], self._mixer.output_buffer())
+        finally:
+            self._mixer.stop()
+            frames.flush()
+
+        elapsed = time.time() - start
+        if elapsed > 0:
+            log.info("Rendered %d frames in %0.2f seconds (%0.2f FPS)"
+                     % (num_frames, elapsed, num_frames / elapsed))
+        return num_frames
+
+    def _store_frame(self, frame, buffer):
+        if self._format == "hls":
+            np.copyto(frame, buffer)
+            return
+
+        conversion = 'perceptual' if self._mixer.useColorCorrections else 'linear'
+        label = conversion if self._encoder.color_lut is None else conversion + '-lut'
+        with self._mixer.profiler.span('colour-conversion', label):
+            self._encoder.encode(buffer, frame,
+                                 hls_to_rgb_perceptual if self._mixer.useColorCorrections
+                                 else hls_to_rgb)
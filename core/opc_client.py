@@ -0,0 +1,198 @@
+# This file is part of Firemix.
+#
+# Copyright 2013-2020 Jonathan Evans <jon@craftyjon.com>
+#
+# Firemix is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Firemix is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Firemix.  If not, see <http://www.gnu.org/licenses/>.
+
+from builtins import object
+import errno
+import logging
+import socket
+import threading
+import time
+
+log = logging.getLogger("firemix.core.opc_client")
+
+
+class OpcClient(object):
+    """
+    A persistent Open Pixel Control connection to one server (fcserver,
+    LEDscape, gl_server, ...).
+
+    The connection is opened on first use and reopened with exponential
+    backoff whenever it fails.  Nothing in here blocks: host names are looked
+    up on a background thread, and connecting and writing use a non-blocking
+    socket.  If the server can't keep up, new frames are
+    dropped rather than queued, so it always receives a recent frame.
+
+    Frames are sent straight from the caller's buffer.  Only when the kernel
+    accepts part of a frame is the rest copied, because the caller will reuse
+    its buffer for the next frame while the rest is still waiting to be sent.
+    """
+
+    RETRY_MIN = 0.5
+    RETRY_MAX = 30.0
+
+    def __init__(self, address, clock=time.monotonic):
+        self.address = address
+        self._clock = clock
+        self._socket = None
+        self._connected = False
+        self._resolved = None
+        self._resolver = None
+        self._resolve_error = None
+        self._pending = None
+        self._retry_delay = self.RETRY_MIN
+        self._next_attempt = 0.0
+        self.stats = {
+            'frames': 0,
+            'dropped': 0,
+            'bytes': 0,
+            'connects': 0,
+            'errors': 0,
+            'last-error': None,
+        }
+
+    def connected(self):
+        return self._connected
+
+    def send(self, packet):
+        """
+        Sends one complete OPC message (header and data) from a bytes-like
+        object.  Returns True if the message was sent (or at least started),
+        False if it was dropped.
+        """
+        if not self._connected and not self._connect():
+            self.stats['dropped'] += 1
+            return False
+
+        try:
+            # Finish the previous message first, or the stream would be corrupt
+            if self._pending is not None:
+                sent = self._socket.send(self._pending)
+                self.stats['bytes'] += sent
+                if sent < len(self._pending):
+                    self._pending = self._pending[sent:]
+                    self.stats['dropped'] += 1
+                    return False
+                self._pending = None
+
+            view = memoryview(packet).cast('B')
+            sent = self._socket.send(view)
+            self.stats['bytes'] += sent
+            if sent < len(view):
+                self._pending = bytes(view[sent:])
+        except (BlockingIOError, InterruptedError):
+            self.stats['dropped'] += 1
+            return False
+        except OSError as e:
+            self._fail(e)
+            self.stats['dropped'] += 1
+            return False
+
+        self.stats['frames'] += 1
+        return True
+
+    def _connect(self):
+        """
+        Starts or continues connecting.  Returns True once connected.
+        """
+        if self._socket is None:
+            if self._clock() < self._next_attempt:
+                return False
+            if self._resolved is None and not self._resolve():
+                return False
+            try:
+                self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                self._socket.setblocking(False)
+                self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                result = self._socket.connect_ex(self._resolved)
+            except (OSError, UnicodeError) as e:
+                self._fail(e)
+                return False
+            if result not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+                self._fail(OSError(result, errno.errorcode.get(result, str(result))))
+                return False
+            if result != 0:
+                return False
+        else:
+            # A connect is in progress; see whether it has finished
+            result = self._socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if result != 0:
+                self._fail(OSError(result, errno.errorcode.get(result, str(result))))
+                return False
+            try:
+                self._socket.getpeername()
+            except OSError:
+                # Not connected yet
+                return False
+
+        self._connected = True
+        self._retry_delay = self.RETRY_MIN
+        self.stats['connects'] += 1
+        log.info("Connected to OPC server at %s:%d" % self.address)
+        return True
+
+    def _resolve(self):
+        """
+        Starts or checks on the lookup of the server's address.  Returns True
+        once it is known.
+        """
+        host, port = self.address
+        if self._resolver is None:
+            try:
+                # IP addresses don't need a lookup
+                socket.inet_aton(host)
+                self._resolved = (host, port)
+                return True
+            except (OSError, UnicodeError):
+                pass
+            self._resolve_error = None
+            self._resolver = threading.Thread(target=self._lookup, args=(host, port),
+                                              name="Firemix-OPC-resolver", daemon=True)
+            self._resolver.start()
+        if self._resolver.is_alive():
+            return False
+
+        self._resolver = None
+        if self._resolved is None:
+            self._fail(self._resolve_error)
+            return False
+        return True
+
+    def _lookup(self, host, port):
+        try:
+            self._resolved = (socket.gethostbyname(host), port)
+        except (OSError, UnicodeError) as e:
+            self._resolve_error = e
+
+    def _fail(self, error):
+        if self._connected:
+            log.warning("Lost connection to OPC server at %s:%d (%s)"
+                        % (self.address[0], self.address[1], error))
+        else:
+            log.debug("Can't connect to OPC server at %s:%d (%s)"
+                      % (self.address[0], self.address[1], error))
+        self.stats['errors'] += 1
+        self.stats['last-error'] = str(error)
+        self.close()
+        self._next_attempt = self._clock() + self._retry_delay
+        self._retry_delay = min(2 * self._retry_delay, self.RETRY_MAX)
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+        self._socket = None
+        self._connected = False
+        self._pending = None
@@ -0,0 +1,141 @@
+# This file is part of Firemix.
+#
+# Copyright 2013-2020 Jonathan Evans <jon@craftyjon.com>
+#
+# Firemix is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Firemix is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Firemix.  If not, see <http://www.gnu.org/licenses/>.
+
+from builtins import range
+from builtins import object
+import logging
+import threading
+from collections import deque
+
+import numpy as np
+
+from lib.buffer_utils import BufferUtils
+
+log = logging.getLogger("firemix.core.output_pipeline")
+
+
+class OutputPipeline(object):
+    """
+    Runs the output stage (colour conversion and network transmission) on its
+    own thread, so that the mixer can render frame N+1 while frame N is being
+    sent.
+
+    Frames are handed off through a fixed ring of buffers allocated up front
+    with BufferUtils.create_buffer().  At any time one slot may be owned by the
+    output thread, and the rest are either free or waiting to be sent.  If the
+    output stage falls behind, the oldest waiting frame is overwritten rather
+    than blocking the render thread.
+    """
+
+    def __init__(self, sink, depth=3):
+        assert depth >= 2, "Output pipeline needs at least two frame buffers"
+        self._sink = sink
+        self._frames = [BufferUtils.create_buffer() for i in range(depth)]
+        # Strands changed since the previously queued frame (None = all),
+        # kept in a mask per slot
+        self._masks = [np.zeros(BufferUtils.num_strands, dtype=bool) for i in range(depth)]
+        self._dirty = [None] * depth
+        self._free = deque(range(depth))
+        self._ready = deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self.running = False
+        self.sent = 0
+        self.dropped = 0
+
+    def start(self):
+        assert self._thread is None, "Cannot start output thread more than once"
+        self.running = True
+        self._thread = threading.Thread(target=self._output_loop,
+                                        name="Firemix-output-thread")
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self.running = False
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, buffer, dirty=None):
+        """
+        Copies a rendered frame into the ring and queues it for output.
+        `dirty` is an optional mask of the strands that changed since the
+        previous frame.  Called from the render thread.
+        """
+        with self._cond:
+            carried = False
+            if self._free:
+                slot = self._free.popleft()
+            else:
+                slot = self._ready.popleft()
+                self.dropped += 1
+                # The changes in the dropped frame still have to be sent with
+                # whichever frame goes out next.
+                if self._ready:
+                    following = self._ready[0]
+                    self._dirty[following] = self._merge_dirty(self._dirty[following],
+                                                               self._dirty[slot])
+                elif self._dirty[slot] is None:
+                    dirty = None
+                else:
+                    carried = True
+
+        # The slot is owned by the render thread until it is queued again
+        np.copyto(self._frames[slot], buffer)
+        if dirty is None:
+            self._dirty[slot] = None
+        else:
+            mask = self._masks[slot]
+            if carried:
+                # The slot's mask still holds the dropped frame's changes
+                np.logical_or(mask, dirty, mask)
+            else:
+                np.copyto(mask, dirty)
+            self._dirty[slot] = mask
+
+        with self._cond:
+            self._ready.append(slot)
+            self._cond.notify()
+
+    @staticmethod
+    def _merge_dirty(a, b):
+        """
+        Merges mask `b` into mask `a` in place and returns it
+        """
+        if a is None or b is None:
+            return None
+        return np.logical_or(a, b, a)
+
+    def _output_loop(self):
+        while True:
+            with self._cond:
+                while self.running and not self._ready:
+                    self._cond.wait()
+                if not self.running:
+                    return
+                slot = self._ready.popleft()
+
+            try:
+                self._sink(self._frames[slot], self._dirty[slot])
+                self.sent += 1
+            except Exception:
+                log.exception("Exception raised in output stage")
+            finally:
+                with self._cond:
+                    self._free.append(slot)
@@ -0,0 +1,257 @@
+# This file is part of Firemix.
+#
+# Copyright 2013-2020 Jonathan Evans <jon@craftyjon.com>
+#
+# Firemix is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Firemix is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Firemix.  If not, see <http://www.gnu.org/licenses/>.
+
+from builtins import object
+import asyncio
+import logging
+import socket
+import threading
+
+log = logging.getLogger("firemix.core.output_service")
+
+
+class _ClientProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, channel):
+        self._channel = channel
+
+    def error_received(self, exc):
+        self._channel.record_error(exc)
+
+    def connection_lost(self, exc):
+        self._channel.connection_lost(exc)
+
+    def pause_writing(self):
+        self._channel.writable.clear()
+
+    def resume_writing(self):
+        self._channel.writable.set()
+
+
+class _ClientChannel(object):
+    """
+    Sends frames to one client.  Only used from the service's event loop,
+    apart from reading the statistics.
+
+    A frame is a dict of datagrams, keyed by strand, that is sent in key
+    order between the channel's header and footer datagrams.  Only the latest
+    frame is kept: if a new frame arrives before the previous one was sent,
+    its datagrams replace those of the previous frame, so that a partial
+    frame never loses the strands that the frame it supersedes changed.
+    """
+
+    RETRY_MIN = 0.5
+    RETRY_MAX = 30.0
+
+    def __init__(self, address, header=(), footer=()):
+        self.address = address
+        self.header = header
+        self.footer = footer
+        self.pending = None
+        self.transport = None
+        self.closed = False
+        self.wakeup = asyncio.Event()
+        self.writable = asyncio.Event()
+        self.stats = {
+            'resolved': None,
+            'frames': 0,
+            'datagrams': 0,
+            'bytes': 0,
+            'superseded': 0,
+            'errors': 0,
+            'last-error': None,
+        }
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    def submit(self, datagrams, full):
+        if self.pending is not None:
+            self.stats['superseded'] += 1
+            if not full:
+                self.pending.update(datagrams)
+                datagrams = None
+        if datagrams is not None:
+            self.pending = dict(datagrams)
+        self.wakeup.set()
+
+    def record_error(self, exc):
+        self.stats['errors'] += 1
+        self.stats['last-error'] = str(exc)
+
+    def connection_lost(self, exc):
+        if exc is not None:
+            self.record_error(exc)
+        self.transport = None
+        # Wake _run() even if it was waiting for a paused socket, so that it
+        # reopens the endpoint (or exits, if closed)
+        self.writable.set()
+        self.wakeup.set()
+
+    def close(self):
+        self.closed = True
+        self.task.cancel()
+        self.writable.set()
+        self.wakeup.set()
+        if self.transport is not None:
+            self.transport.close()
+
+    async def _open(self):
+        """
+        Resolves the client's address (once) and opens a datagram endpoint
+        to it, retrying with exponential backoff until it succeeds.
+        """
+        loop = asyncio.get_running_loop()
+        host, port = self.address
+        delay = self.RETRY_MIN
+        while True:
+            try:
+                if self.stats['resolved'] is None:
+                    infos = await loop.getaddrinfo(host, port, family=socket.AF_INET,
+                                                   type=socket.SOCK_DGRAM)
+                    self.stats['resolved'] = infos[0][4]
+                self.transport, _ = await loop.create_datagram_endpoint(
+                    lambda: _ClientProtocol(self), remote_addr=self.stats['resolved'],
+                    allow_broadcast=True)
+                self.writable.set()
+                return
+            except (OSError, UnicodeError) as e:
+                self.record_error(e)
+                log.warning("Can't send to %s:%d (%s), retrying in %0.1f s"
+                            % (host, port, e, delay))
+                await asyncio.sleep(delay)
+                delay = min(2 * delay, self.RETRY_MAX)
+
+    async def _run(self):
+        while not self.closed:
+            if self.transport is None:
+                await self._open()
+
+            # Frames that arrive while the socket buffer is full are merged
+            # into the pending frame rather than queued.
+            await self.writable.wait()
+            if self.closed:
+                return
+            if self.transport is None:
+                # Lost while waiting
+                continue
+            if self.pending is None:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            frame, self.pending = self.pending, None
+
+            datagrams = list(self.header)
+            datagrams.extend(frame[key] for key in sorted(frame))
+            datagrams.extend(self.footer)
+            for datagram in datagrams:
+                self.transport.sendto(datagram)
+                self.stats['bytes'] += len(datagram)
+            self.stats['datagrams'] += len(datagrams)
+            self.stats['frames'] += 1
+
+
+class OutputService(object):
+    """
+    Runs network output on an asyncio event loop in its own thread.
+
+    Each client gets its own channel, with its own socket, a latest-frame-wins
+    pending frame, its host name resolved once, and send statistics.  Sending
+    a frame from the render or output thread only hands the datagrams over to
+    the event loop, so a slow or unreachable client can't hold up the caller
+    or any other client.  Datagrams must not be modified after they have been
+    handed over (use bytes).
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._thread = None
+        self._channels = {}
+        self._started = threading.Event()
+
+    def start(self):
+        assert self._thread is None, "Output service is already running"
+        self._started.clear()
+        self._thread = threading.Thread(target=self._run_loop,
+                                        name="Firemix-network-thread",
+                                        daemon=True)
+        self._thread.start()
+        self._started.wait()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._loop.call_soon_threadsafe(self._shutdown)
+        self._thread.join()
+        self._thread = None
+        for key, stats in sorted(self.stats().items()):
+            log.info("%s: %d frames, %d datagrams, %d superseded, %d errors"
+                     % (key, stats['frames'], stats['datagrams'],
+                        stats['superseded'], stats['errors']))
+
+    def _run_loop(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._started.set()
+        try:
+            self._loop.run_forever()
+        finally:
+            self._loop.close()
+
+    def _shutdown(self):
+        for channel in self._channels.values():
+            channel.close()
+        # Let the cancelled tasks and closed transports finish up
+        self._loop.call_later(0.1, self._loop.stop)
+
+    def send(self, addresses, datagrams, full=True, header=(), footer=()):
+        """
+        Queues a frame for each of `addresses`.  `datagrams` is a list of
+        (key, bytes) tuples; if `full` is False, the frame only updates the
+        keys it contains.  `header` and `footer` are datagrams sent before and
+        after every frame to these addresses.
+        """
+        if self._thread is None:
+            return
+        self._loop.call_soon_threadsafe(self._submit, addresses, datagrams,
+                                        full, header, footer)
+
+    def _submit(self, addresses, datagrams, full, header, footer):
+        for address in addresses:
+            key = (address, header, footer)
+            channel = self._channels.get(key, None)
+            if channel is None:
+                channel = _ClientChannel(address, header, footer)
+                self._channels[key] = channel
+            channel.submit(datagrams, full)
+
+    def retain(self, addresses):
+        """
+        Closes the channels to any clients not in `addresses`
+        """
+        if self._thread is not None:
+            self._loop.call_soon_threadsafe(self._retain, set(addresses))
+
+    def _retain(self, addresses):
+        for key in [k for k in self._channels if k[0] not in addresses]:
+            self._channels.pop(key).close()
+
+    def stats(self):
+        """
+        Returns a dict of the send statistics of each client, keyed by
+        "host:port"
+        """
+        return dict(("%s:%d" % channel.address, dict(channel.stats))
+                    for channel in list(self._channels.values()))
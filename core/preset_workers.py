@@ -0,0 +1,261 @@
+# This file is part of Firemix.
+#
+# Copyright 2013-2020 Jonathan Evans <jon@craftyjon.com>
+#
+# Firemix is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Firemix is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Firemix.  If not, see <http://www.gnu.org/licenses/>.
+
+from builtins import object
+import logging
+import multiprocessing
+import signal
+import traceback
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from PyQt5 import QtCore
+
+import lib.dtypes as dtypes
+from core import audio_events
+from lib.buffer_utils import BufferUtils
+
+log = logging.getLogger("firemix.core.preset_workers")
+
+
+def fork_available():
+    return 'fork' in multiprocessing.get_all_start_methods()
+
+
+def _snapshot_parameters(preset):
+    return dict((name, p.get_as_str()) for name, p in preset.get_parameters().items())
+
+
+def _audio_snapshot(audio):
+    return {
+        'fft': list(audio.fft),
+        'smoothed': audio.smoothed,
+        'gain': audio.gain,
+        'smoothEnergy': audio.smoothEnergy,
+        'fader': audio.fader,
+        'pitch': audio.pitch,
+        'pitch_confidence': audio.pitch_confidence,
+    }
+
+
+def _worker_main(preset, buffer, conn):
+    """
+    Entry point of a worker process.  The process is forked from the render
+    thread, so `preset` (and the app it refers to) is a private copy of the
+    parent's state at the time the worker was started.
+    """
+    # Shutdown is driven by the parent process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    mixer = preset._app.mixer
+    audio = mixer.audio
+    # The mutex may have been held by the audio thread when we forked
+    audio._mutex = QtCore.QMutex()
+
+    while True:
+        try:
+            msg = conn.recv()
+        except EOFError:
+            break
+        if msg is None:
+            break
+
+        dt, frame_time, events, reset, params, audio_state, quality = msg
+        try:
+            for name, value in params.items():
+                parameter = preset.parameter(name)
+                if parameter is not None:
+                    parameter.set_from_str(value)
+            if quality != preset.quality:
+                preset.set_quality(quality)
+            if audio_state is not None:
+                for name, value in audio_state.items():
+                    setattr(audio, name, value)
+            if reset:
+                preset._reset()
+
+            if not preset.disabled:
+                mixer._frame_time = frame_time
+                mixer._frame_events = events
+                mixer._frame_onset = any(e.kind == audio_events.ONSET for e in events)
+                preset.tick(dt)
+                preset.render(buffer)
+
+            conn.send(('ok', (preset.can_transition(), preset.take_dirty_strands())))
+        except Exception:
+            # The parent disables the preset class; stop rendering it here too
+            preset.disabled = True
+            conn.send(('error', traceback.format_exc()))
+
+
+class PresetWorker(object):
+    """
+    A forked process that owns one playing preset and renders it into a
+    pixel buffer in shared memory.
+    """
+
+    def __init__(self, context, preset):
+        self.preset = preset
+        self.can_transition = True
+        self.dirty_strands = None
+        # Cleared once the worker process is found to have exited
+        self.alive = True
+        self._send_error = None
+        self._needs_reset = False
+        self._params = _snapshot_parameters(preset)
+
+        length = BufferUtils.get_buffer_size()
+        self._shm = shared_memory.SharedMemory(create=True,
+                                               size=length * dtypes.pixel_color.itemsize)
+        self.buffer = np.ndarray(length, dtype=dtypes.pixel_color, buffer=self._shm.buf)
+        self.buffer.fill(0)
+
+        self._conn, child_conn = context.Pipe()
+        self._process = context.Process(target=_worker_main,
+                                        args=(preset, self.buffer, child_conn),
+                                        name="Firemix-preset-%s" % preset.slug(),
+                                        daemon=True)
+        self._process.start()
+        child_conn.close()
+
+    def request_reset(self):
+        self._needs_reset = True
+
+    def send_frame(self, dt, frame_time, events, audio_state):
+        params = _snapshot_parameters(self.preset)
+        changed = dict((name, value) for name, value in params.items()
+                       if self._params.get(name) != value)
+        self._params = params
+
+        try:
+            self._conn.send((dt, frame_time, events, self._needs_reset, changed,
+                             audio_state, self.preset.quality))
+        except (BrokenPipeError, OSError):
+            self.alive = False
+            self._send_error = "Worker process for %s exited unexpectedly" % self.preset.name()
+        self._needs_reset = False
+
+    def receive_frame(self):
+        """
+        Waits for the worker to finish rendering.  Returns None on success,
+        or the formatted traceback of an exception raised by the preset.
+        """
+        if self._send_error is not None:
+            return self._send_error
+        try:
+            status, value = self._conn.recv()
+        except (EOFError, OSError):
+            self.alive = False
+            return "Worker process for %s exited unexpectedly" % self.preset.name()
+        if status == 'ok':
+            self.can_transition, self.dirty_strands = value
+            return None
+        return value
+
+    def stop(self):
+        try:
+            self._conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self._process.join(1.0)
+        if self._process.is_alive():
+            self._process.terminate()
+            self._process.join()
+        self._conn.close()
+        # Drop our view before releasing the mapping
+        self.buffer = None
+        self._shm.close()
+        self._shm.unlink()
+
+
+class PresetWorkerPool(object):
+    """
+    Renders each playing preset in its own worker process, so that the two
+    presets of a transition render in parallel instead of contending for the
+    GIL.  The mixer only blends the resulting buffers.
+
+    Workers are forked on demand when a preset starts playing, and stopped
+    once it is no longer the active or next preset.  Preset state lives in the
+    worker; the parent keeps forwarding parameter changes, resets, audio
+    events, audio data and the quality level to it every frame.  Watches and
+    wibbler values shown in the GUI come from the parent's copy of the preset
+    and are not updated.
+    """
+
+    def __init__(self, mixer):
+        self._mixer = mixer
+        self._context = multiprocessing.get_context('fork')
+        self._workers = {}
+        self._last_fft = None
+
+    def worker(self, preset):
+        worker = self._workers.get(id(preset), None)
+        if worker is None or worker.preset is not preset:
+            worker = PresetWorker(self._context, preset)
+            self._workers[id(preset)] = worker
+            log.info("Started worker process for %s" % preset.name())
+        return worker
+
+    def reset(self, preset):
+        worker = self._workers.get(id(preset), None)
+        if worker is not None and worker.preset is preset:
+            worker.request_reset()
+
+    def can_transition(self, preset):
+        worker = self._workers.get(id(preset), None)
+        if worker is not None and worker.preset is preset:
+            return worker.can_transition
+        return preset.can_transition()
+
+    def dirty_strands(self, preset):
+        worker = self._workers.get(id(preset), None)
+        if worker is not None and worker.preset is preset:
+            return worker.dirty_strands
+        return None
+
+    def render(self, presets, dt, frame_time, events):
+        """
+        Ticks and renders the given presets concurrently.  Returns a list of
+        (buffer, error) tuples in the same order as `presets`.
+        """
+        # Workers that died on the previous frame are replaced by new ones
+        playing = set(id(p) for p in presets)
+        for key in [k for k in self._workers
+                    if k not in playing or not self._workers[k].alive]:
+            log.info("Stopping worker process for %s" % self._workers[key].preset.name())
+            self._workers.pop(key).stop()
+
+        # Audio data only changes when a new FFT frame arrives, so avoid
+        # pickling the history on every frame.
+        audio = self._mixer.audio
+        audio_state = None
+        latest_fft = audio.fft[0]
+        if latest_fft is not self._last_fft:
+            self._last_fft = latest_fft
+            audio_state = _audio_snapshot(audio)
+
+        workers = [self.worker(p) for p in presets]
+        for worker in workers:
+            worker.send_frame(dt, frame_time, events, audio_state)
+        return [(worker.buffer, worker.receive_frame()) for worker in workers]
+
+    def stop(self):
+        for worker in self._workers.values():
+            worker.stop()
+        self._workers = {}
+        self._last_fft = None
@@ -0,0 +1,71 @@
+# This file is part of Firemix.
+#
+# Copyright 2013-2020 Jonathan Evans <jon@craftyjon.com>
+#
+# Firemix is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Firemix is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Firemix.  If not, see <http://www.gnu.org/licenses/>.
+
+from builtins import object
+import logging
+
+log = logging.getLogger("firemix.core.quality_governor")
+
+
+class QualityGovernor(object):
+    """
+    Chooses a render quality level from the measured tick time.
+
+    Level 0 is full quality; each level up to MAX_LEVEL asks presets (through
+    Pattern.set_quality) for a cheaper rendition.  The governor tracks an
+    exponential moving average of the time spent ticking each frame, and
+    degrades one level when it stays above `degrade_at` of the frame budget,
+    or restores one level when it stays below `restore_at`.  After each change
+    it waits `holdoff` frames so the effect of the change can be measured
+    before deciding again.
+    """
+
+    MAX_LEVEL = 3
+
+    def __init__(self, tick_rate, degrade_at=0.9, restore_at=0.5,
+                 smoothing=0.1, holdoff=None):
+        self.budget = 1.0 / tick_rate
+        self.degrade_at = degrade_at
+        self.restore_at = restore_at
+        self.smoothing = smoothing
+        # Default to one second's worth of frames
+        self.holdoff = int(tick_rate) if holdoff is None else holdoff
+        self.level = 0
+        self.load = 0.0
+        self._frames_since_change = 0
+
+    def update(self, tick_time):
+        """
+        Records the time (in seconds) spent rendering the last frame.
+        Returns the quality level to render the next frame at.
+        """
+        self.load += self.smoothing * (tick_time / self.budget - self.load)
+        self._frames_since_change += 1
+        if self._frames_since_change < self.holdoff:
+            return self.level
+
+        if self.load > self.degrade_at and self.level < self.MAX_LEVEL:
+            self._set_level(self.level + 1)
+        elif self.load < self.restore_at and self.level > 0:
+            self._set_level(self.level - 1)
+        return self.level
+
+    def _set_level(self, level):
+        log.info("Render load at %d%% of frame budget, changing quality level %d -> %d"
+                 % (self.load * 100.0, self.level, level))
+        self.level = level
+        self._frames_since_change = 0
@@ -0,0 +1,183 @@
+# This file is part of Firemix.
+#
+# Copyright 2013-2020 Jonathan Evans <jon@craftyjon.com>
+#
+# Firemix is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Firemix is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Firemix.  If not, see <http://www.gnu.org/licenses/>.
+
+from builtins import object
+import logging
+
+import numpy as np
+
+from core.frame_scheduler import FrameScheduler
+from core.networking import Rgb8Encoder
+from core.offline_renderer import open_frame_file
+from lib.buffer_utils import BufferUtils
+from lib.colors import hls_to_rgb, rgb_to_hls
+from lib.scratch_arena import ScratchArena
+
+log = logging.getLogger("firemix.core.show_player")
+
+
+class ShowPlayer(object):
+    """
+    Plays back shows pre-rendered with 'firemix.py render --format rgb8'.
+
+    Each segment is a memory-mapped RGB8 frame file, so outside of crossfades
+    a frame is sent straight from the mapping to the network packet writers
+    without running any pattern or colour conversion code.
+
+    Crossfades between segments reuse the transition plugins: the two
+    overlapping frames are converted back to HLS, blended by the transition
+    and converted to RGB8 again.  The frames already contain the perceptual
+    colour correction, so the return trip uses the plain HLS conversion.  The
+    gamma is undone before blending and applied again afterwards, the same
+    way as in the render.
+    """
+
+    def __init__(self, app, paths, frame_rate, loop=False,
+                 crossfade=0.0, transition=None):
+        self._app = app
+        self._net = app.net
+        self._segments = [self._open_segment(path) for path in paths]
+        self._frame_rate = frame_rate
+        self.loop = loop
+        # Each segment fades in and out, so a crossfade can cover at most
+        # half of the shortest one
+        longest_fade = min(len(frames) for frames in self._segments) // 2
+        self._crossfade_frames = int(round(crossfade * frame_rate))
+        if self._crossfade_frames > longest_fade:
+            log.warning("Crossfade shortened to %d frames to fit the shortest segment"
+                        % longest_fade)
+            self._crossfade_frames = longest_fade
+        self._transition = transition
+        self._segment = 0
+        self._frame = 0
+        self.running = False
+
+        # Scratch space for crossfades
+        self._start_hls = BufferUtils.create_buffer()
+        self._end_hls = BufferUtils.create_buffer()
+        self._mixed_hls = BufferUtils.create_buffer()
+        self._scratch = ScratchArena()
+        self._encoder = Rgb8Encoder(app.settings['networking'])
+        self._mixed_rgb8 = np.empty((BufferUtils.get_buffer_size(), 3), dtype=np.uint8)
+
+    def _open_segment(self, path):
+        frames = open_frame_file(path, np.uint8, None, mode='r')
+        if frames.ndim == 1 and frames.size % (BufferUtils.get_buffer_size() * 3) == 0:
+            # Raw files don't record their shape
+            frames = frames.reshape((-1, BufferUtils.get_buffer_size(), 3))
+        if frames.ndim != 3 or frames.shape[1:] != (BufferUtils.get_buffer_size(), 3):
+            raise ValueError("%s is not an RGB8 render of this scene" % path)
+        log.info("Loaded %s (%d frames)" % (path, frames.shape[0]))
+        return frames
+
+    def seek(self, seconds, segment=None):
+        """
+        Moves playback to `seconds` into the given segment (default: the
+        current one).
+        """
+        if segment is not None:
+            if segment < 0 or segment >= len(self._segments):
+                raise ValueError("No such segment: %d" % segment)
+            self._segment = segment
+        frame = int(round(seconds * self._frame_rate))
+        self._frame = min(max(frame, 0), len(self._segments[self._segment]) - 1)
+
+    def _next_segment(self):
+        """
+        Returns the index of the segment following the current one, or None
+        if playback should stop after it.
+        """
+        if self._segment + 1 < len(self._segments):
+            return self._segment + 1
+        if self.loop:
+            return 0
+        return None
+
+    def play(self):
+        """
+        Streams frames to the network at the render frame rate until the show
+        ends or stop() is called.
+        """
+        scheduler = FrameScheduler(self._frame_rate)
+        self.running = True
+        while self.running:
+            scheduler.wait()
+            if not self.step():
+                break
+        self.running = False
+
+        stats = scheduler.stats()
+        log.info("Played %d frames, %d skipped, jitter %0.2f ms"
+                 % (stats['frames'], stats['skipped'], stats['jitter'] * 1000.0))
+
+    def stop(self):
+        self.running = False
+
+    def step(self):
+        """
+        Sends the current frame and advances.  Returns False at the end of
+        the show.
+        """
+        frames = self._segments[self._segment]
+        next_segment = self._next_segment()
+        fade_start = len(frames) - self._crossfade_frames
+
+        if (self._transition is not None and next_segment is not None
+                and self._frame >= fade_start):
+            # Overlap the tail of this segment with the head of the next
+            fade_frame = self._frame - fade_start
+            if fade_frame == 0:
+                self._transition.reset()
+            progress = float(fade_frame) / self._crossfade_frames
+            self._write_crossfade(frames[self._frame],
+                                  self._segments[next_segment][fade_frame],
+                                  progress)
+        else:
+            self._net.write_rgb8(frames[self._frame].reshape(-1).view(np.int8))
+
+        self._frame += 1
+        if self._frame >= len(frames):
+            if next_segment is None:
+                return False
+            self._segment = next_segment
+            self._frame = self._crossfade_frames if self._transition is not None else 0
+        return True
+
+    def _linear_frame(self, frame, name):
+        """
+        Returns the RGB8 frame `frame` with the render's gamma undone, as
+        floats in [0..255]
+        """
+        if self._encoder.gamma == 1.0:
+            return frame
+        linear = self._scratch.get(name, frame.shape, np.float64)
+        np.multiply(frame, 1.0 / 255, linear)
+        np.power(linear, 1.0 / self._encoder.gamma, linear)
+        np.multiply(linear, 255.0, linear)
+        return linear
+
+    def _write_crossfade(self, start, end, progress):
+        rgb_to_hls(self._linear_frame(start, 'crossfade.start'), self._start_hls, self._scratch)
+        rgb_to_hls(self._linear_frame(end, 'crossfade.end'), self._end_hls, self._scratch)
+        self._transition.render(self._start_hls, self._end_hls, progress, self._mixed_hls)
+
+        np.mod(self._mixed_hls['hue'], 1.0, self._mixed_hls['hue'])
+        np.clip(self._mixed_hls['light'], 0.0, 1.0, self._mixed_hls['light'])
+        np.clip(self._mixed_hls['sat'], 0.0, 1.0, self._mixed_hls['sat'])
+
+        self._encoder.encode(self._mixed_hls, self._mixed_rgb8, hls_to_rgb)
+        self._net.write_rgb8(self._mixed_rgb8.reshape(-1).view(np.int8))
@@ -0,0 +1,153 @@
+# This file is part of Firemix.
+#
+# Copyright 2013-2020 Jonathan Evans <jon@craftyjon.com>
+#
+# Firemix is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Firemix is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Firemix.  If not, see <http://www.gnu.org/licenses/>.
+
+from builtins import object
+import json
+import logging
+import time
+from collections import deque
+
+log = logging.getLogger("firemix.core.tick_profiler")
+
+
+class _Span(object):
+    __slots__ = ('_samples', '_start')
+
+    def __init__(self, samples):
+        self._samples = samples
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._samples.append(time.perf_counter() - self._start)
+        return False
+
+
+class _NullSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_null_span = _NullSpan()
+
+
+def _percentile(ordered, fraction):
+    """
+    Nearest-rank percentile of an already sorted list
+    """
+    index = int(round(fraction * (len(ordered) - 1)))
+    return ordered[index]
+
+
+class TickProfiler(object):
+    """
+    Collects per-stage timings from the render and output paths.
+
+    Each sample is keyed by a stage (see STAGES) and a key within the stage,
+    such as the preset or transition class being timed.  The most recent
+    `window` samples of each (stage, key) are kept, so the percentiles reflect
+    current behaviour rather than the whole session.
+
+    Timing a block is done with:
+
+        with profiler.span('preset-render', 'Dragons'):
+            ...
+
+    When the profiler is disabled, span() returns a shared do-nothing context,
+    so instrumented code costs a method call and no clock reads.
+
+    Stages may nest: preset-tick includes the parameter-tick of that preset.
+    Samples can be recorded from any thread.
+    """
+
+    STAGES = ['parameter-tick', 'preset-tick', 'preset-render',
+              'transition-render', 'colour-conversion', 'network-send']
+
+    def __init__(self, enabled=False, window=512):
+        self.enabled = enabled
+        self._window = window
+        self._samples = {}
+
+    def _get_samples(self, stage, key):
+        samples = self._samples.get((stage, key), None)
+        if samples is None:
+            samples = deque(maxlen=self._window)
+            self._samples[(stage, key)] = samples
+        return samples
+
+    def span(self, stage, key):
+        if not self.enabled:
+            return _null_span
+        return _Span(self._get_samples(stage, key))
+
+    def record(self, stage, key, duration):
+        """
+        Adds a sample (in seconds) measured elsewhere
+        """
+        if self.enabled:
+            self._get_samples(stage, key).append(duration)
+
+    def reset(self):
+        self._samples = {}
+
+    def stats(self):
+        """
+        Returns {stage: {key: stats}}, where stats has the sample count and
+        the mean, p50, p95, p99 and max durations in milliseconds.
+        """
+        result = {}
+        for (stage, key), samples in list(self._samples.items()):
+            ordered = sorted(samples)
+            if not ordered:
+                continue
+            result.setdefault(stage, {})[key] = {
+                'count': len(ordered),
+                'mean': 1000.0 * sum(ordered) / len(ordered),
+                'p50': 1000.0 * _percentile(ordered, 0.50),
+                'p95': 1000.0 * _percentile(ordered, 0.95),
+                'p99': 1000.0 * _percentile(ordered, 0.99),
+                'max': 1000.0 * ordered[-1],
+            }
+        return result
+
+    def rows(self):
+        """
+        Returns the stats as a flat list of (stage, key, stats) tuples, in
+        stage order and then by decreasing p95.
+        """
+        stats = self.stats()
+        rows = []
+        for stage in self.STAGES + sorted(set(stats) - set(self.STAGES)):
+            keys = stats.get(stage, {})
+            for key in sorted(keys, key=lambda k: -keys[k]['p95']):
+                rows.append((stage, key, keys[key]))
+        return rows
+
+    def dump(self, path):
+        """
+        Writes the current stats to `path` as JSON
+        """
+        with open(path, 'w') as f:
+            json.dump(self.stats(), f, indent=4, sort_keys=True)
+        log.info("Wrote tick profile to %s" % path)
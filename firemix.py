@@ -21,9 +21,12 @@
 import argparse
 import functools
 import logging
+import random
 import signal
 import sys
 
+import numpy as np
+
 from PyQt5 import QtCore, QtWidgets
 
 try:
@@ -31,8 +34,9 @@ try:
 except ImportError:
     qdarkstyle = None
 
-from firemix_app import FireMixApp
-from ui.firemixgui import FireMixGUI
+from firemix_app import FireMixApp, PlaybackApp
+from core.offline_renderer import OfflineRenderer
+from core.show_player import ShowPlayer
 
 
 def call_ignoring_exceptions(func):
@@ -47,7 +51,120 @@ def sig_handler(app, sig, frame):
     call_ignoring_exceptions(app.exit)
     call_ignoring_exceptions(app.qt_app.exit)
 
+def set_log_level(log, verbose):
+    if verbose >= 2:
+        log.setLevel(logging.DEBUG)
+    elif verbose >= 1:
+        log.setLevel(logging.INFO)
+
+def print_tick_profile(profiler):
+    print("------ TICK STAGES (ms) ------")
+    print("%-18s %-24s %6s %8s %8s %8s %8s" % ("stage", "class", "count", "p50", "p95", "p99", "max"))
+    for stage, key, stats in profiler.rows():
+        print("%-18s %-24s %6d %8.3f %8.3f %8.3f %8.3f" % (stage, key, stats['count'], stats['p50'],
+                                                         stats['p95'], stats['p99'], stats['max']))
+
+def render_main(argv):
+    """
+    Headless offline render: runs the mixer in simulated time and writes
+    every frame to a memory-mapped file.
+    """
+    logging.basicConfig(level=logging.ERROR)
+    log = logging.getLogger("firemix")
+
+    parser = argparse.ArgumentParser(prog="firemix.py render",
+                                     description="Render a playlist or preset to a frame file")
+    parser.add_argument("scene", type=str, help="Scene file to load (create scenes with FireSim)")
+    parser.add_argument("output", type=str, help="Frame file to write (.npy, or raw for any other extension)")
+    parser.add_argument("--playlist", type=str, help="Playlist file to load", default=None)
+    parser.add_argument("--preset", type=str, help="Specify a preset name to render only that preset")
+    parser.add_argument("--duration", type=float, required=True, help="Length of the render in seconds")
+    parser.add_argument("--tick-rate", type=float, default=None, help="Frames per second (default: from settings)")
+    parser.add_argument("--format", choices=OfflineRenderer.FORMATS, default="rgb8", help="Frame format")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed, for reproducible renders")
+    parser.add_argument("--profile-json", type=str, default=None, help="Profile the render and write per-stage timings to this file")
+    parser.add_argument("--verbose", "-v", action='count', default=0,
+                        help="Enable verbose log output. Specify more than once for more output")
+
+    args = parser.parse_args(argv)
+    # The rest of the app expects the same options as an interactive run
+    args.profile = False
+    args.gui = False
+    args.noaudio = True
+    args.nonet = True
+
+    set_log_level(log, args.verbose)
+
+    if args.seed is not None:
+        random.seed(args.seed)
+        np.random.seed(args.seed)
+
+    # Qt objects in the mixer need an application instance, but its event
+    # loop is never run.
+    qt_app = QtCore.QCoreApplication(sys.argv)
+    app = FireMixApp(qt_app, args)
+
+    if args.tick_rate is not None:
+        # Only affects this run; settings are not saved in render mode
+        app.settings.get('mixer')['tick-rate'] = args.tick_rate
+    tick_rate = app.settings.get('mixer')['tick-rate']
+
+    if args.profile_json is not None:
+        app.mixer.profiler.enabled = True
+
+    renderer = OfflineRenderer(app, tick_rate, args.format)
+    renderer.render(args.output, args.duration)
+    app.mixer.shutdown()
+
+    if args.profile_json is not None:
+        print_tick_profile(app.mixer.profiler)
+        app.mixer.profiler.dump(args.profile_json)
+
+def play_main(argv):
+    """
+    Streams pre-rendered RGB8 frame files to the network, without running
+    the mixer or any preset code.
+    """
+    logging.basicConfig(level=logging.ERROR)
+    log = logging.getLogger("firemix")
+
+    parser = argparse.ArgumentParser(prog="firemix.py play",
+                                     description="Play back shows rendered with 'firemix.py render'")
+    parser.add_argument("scene", type=str, help="Scene the shows were rendered for")
+    parser.add_argument("segments", type=str, nargs='+', help="RGB8 frame files to play in order")
+    parser.add_argument("--tick-rate", type=float, default=None,
+                        help="Frame rate the shows were rendered at (default: from settings)")
+    parser.add_argument("--loop", action='store_const', const=True, default=False, help="Loop the show")
+    parser.add_argument("--start", type=float, default=0.0, help="Start this many seconds into the first segment")
+    parser.add_argument("--transition", type=str, default="Cut", help="Transition to crossfade between segments with")
+    parser.add_argument("--crossfade", type=float, default=0.0, help="Crossfade duration in seconds")
+    parser.add_argument("--verbose", "-v", action='count', default=0,
+                        help="Enable verbose log output. Specify more than once for more output")
+
+    args = parser.parse_args(argv)
+    set_log_level(log, args.verbose)
+
+    app = PlaybackApp(args)
+    tick_rate = args.tick_rate or app.settings.get('mixer')['tick-rate']
+    player = ShowPlayer(app, args.segments, tick_rate, loop=args.loop,
+                        crossfade=args.crossfade,
+                        transition=app.get_transition_by_name(args.transition))
+    player.seek(args.start)
+
+    signal.signal(signal.SIGINT, lambda sig, frame: player.stop())
+    player.play()
+    app.net.stop()
+
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "render":
+        render_main(sys.argv[2:])
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == "play":
+        play_main(sys.argv[2:])
+        return
+
+    from ui.firemixgui import FireMixGUI
+
     logging.basicConfig(level=logging.ERROR)
     log = logging.getLogger("firemix")
 
@@ -55,19 +172,18 @@ def main():
     parser.add_argument("scene", type=str, help="Scene file to load (create scenes with FireSim)")
     parser.add_argument("--playlist", type=str, help="Playlist file to load", default=None)
     parser.add_argument("--profile", action='store_const', const=True, default=False, help="Enable profiling")
+    parser.add_argument("--profile-json", type=str, default=None, help="With --profile, write per-stage timings to this file on exit")
     parser.add_argument("--nogui", dest='gui', action='store_false',
                         default=True, help="Disable GUI")
     parser.add_argument("--preset", type=str, help="Specify a preset name to run only that preset (useful for debugging)")
     parser.add_argument("--verbose", "-v", action='count', default=0,
                         help="Enable verbose log output. Specify more than once for more output")
     parser.add_argument("--noaudio", action='store_const', const=True, default=False, help="Disable audio processing client")
+    parser.add_argument("--nonet", action='store_const', const=True, default=False, help="Disable network output")
 
     args = parser.parse_args()
 
-    if args.verbose >= 2:
-        log.setLevel(logging.DEBUG)
-    elif args.verbose >= 1:
-        log.setLevel(logging.INFO)
+    set_log_level(log, args.verbose)
 
     log.info("Booting FireMix...")
 
@@ -103,5 +219,16 @@ def main():
         for c in sorted(app.mixer._tick_time_data.keys()):
             print("[%d fps]:\t%4d\t%0.2f%%" % (c, app.mixer._tick_time_data[c], (float(app.mixer._tick_time_data[c]) / app.mixer._num_frames) * 100.0))
 
+        stats = app.mixer.frame_stats()
+        if stats is not None:
+            print("------ FRAME SCHEDULING ------")
+            print("%d overruns, %d frames skipped" % (stats['overruns'], stats['skipped']))
+            print("Lateness: mean %0.2f ms, max %0.2f ms" % (stats['mean-lateness'] * 1000.0, stats['max-lateness'] * 1000.0))
+            print("Interval: mean %0.2f ms, jitter %0.2f ms" % (stats['mean-interval'] * 1000.0, stats['jitter'] * 1000.0))
+
+        print_tick_profile(app.mixer.profiler)
+        if args.profile_json is not None:
+            app.mixer.profiler.dump(args.profile_json)
+
 if __name__ == "__main__":
     main()
@@ -16,8 +16,10 @@
 # along with Firemix.  If not, see <http://www.gnu.org/licenses/>.
 
 
+from builtins import object
 import logging
 
+import numpy as np
 from PyQt5 import QtCore
 
 from core.mixer import Mixer
@@ -28,11 +30,22 @@ from lib.settings import Settings
 from lib.scene import Scene
 from lib.plugin_loader import PluginLoader
 from lib.buffer_utils import BufferUtils
+from lib import dtypes
 
 
 log = logging.getLogger("firemix")
 
 
+def set_pixel_precision(settings):
+    """
+    Switches pixel buffers to float32 if the settings ask for it.  Must run
+    before any buffers are created.
+    """
+    if settings.get('mixer').get('float32', False):
+        log.info("Using float32 pixel buffers")
+        dtypes.set_float_type(np.float32)
+
+
 class FireMixApp(QtCore.QThread):
     """
     Main logic of FireMix.  Operates the mixer tick loop.
@@ -44,7 +57,8 @@ class FireMixApp(QtCore.QThread):
         self._running = False
         self.args = args
         self.settings = Settings()
-        self.net = Networking(self)
+        set_pixel_precision(self.settings)
+        self.net = None if args.nonet else Networking(self)
         BufferUtils.set_app(self)
         self.scene = Scene(self)
         self.plugins = PluginLoader()
@@ -70,3 +84,32 @@ class FireMixApp(QtCore.QThread):
         self.mixer.stop()
         self.playlist.save()
         self.settings.save()
+
+
+class PlaybackApp(object):
+    """
+    Just enough of FireMixApp to drive network output and transitions for
+    pre-rendered show playback.  There is no mixer, playlist or preset code,
+    and the scene caches used by presets are not warmed up.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.settings = Settings()
+        set_pixel_precision(self.settings)
+        self.net = Networking(self)
+        BufferUtils.set_app(self)
+        self.scene = Scene(self)
+        self.plugins = PluginLoader()
+        self.mixer = None
+        BufferUtils.init()
+
+    def get_transition_by_name(self, name):
+        if not name or name == "Cut":
+            return None
+        tl = [c for c in self.plugins.get('Transition') if str(c(None)) == name]
+        if len(tl) != 1:
+            raise ValueError("Transition %s is not loaded!" % name)
+        transition = tl[0](self)
+        transition.setup()
+        return transition
@@ -18,6 +18,7 @@
 from builtins import range
 import logging
 import struct
+import time
 from PyQt5 import QtCore, QtNetwork
 
 log = logging.getLogger("firemix.lib.aubio_connector")
@@ -25,7 +26,8 @@ log = logging.getLogger("firemix.lib.aubio_connector")
 
 class AubioConnector(QtCore.QObject):
 
-    onset_detected = QtCore.pyqtSignal()
+    # Carries the time.perf_counter() time the onset packet was read
+    onset_detected = QtCore.pyqtSignal(float)
     fft_data = QtCore.pyqtSignal(list)
     pitch_data = QtCore.pyqtSignal(float, float)
 
@@ -52,7 +54,7 @@ class AubioConnector(QtCore.QObject):
             (datagram, sender, sport) = self.socket.readDatagram(datagram.size())
             if len(datagram) > 0:
                 if datagram[0] == self.PACKET_ONSET:
-                    self.onset_detected.emit()
+                    self.onset_detected.emit(time.perf_counter())
                 elif datagram[0] == self.PACKET_FFT:
                     fft_size = datagram[1] + (datagram[2] << 8)
                     fft = []
@@ -0,0 +1,94 @@
+# This file is part of Firemix.
+#
+# Copyright 2013-2020 Jonathan Evans <jon@craftyjon.com>
+#
+# Firemix is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Firemix is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Firemix.  If not, see <http://www.gnu.org/licenses/>.
+
+from builtins import object
+import numpy as np
+
+from lib import dtypes
+from lib.buffer_utils import struct_flat
+from lib.colors import rgb_to_uint8
+
+
+class ColorLut(object):
+    """
+    A quantized HLS to RGB8 lookup table, so that converting a frame is one
+    gather per pixel instead of a chain of floating-point operations.
+
+    The table holds the output bytes of `convert` (e.g. hls_to_rgb_perceptual)
+    followed by `gamma`, sampled on a grid of `size` (hue, light, sat) steps.
+    Each pixel is rounded to the nearest grid point.  The global dimmer scales
+    the light index, so it doesn't need a new table.  The number of hue steps
+    must be a power of two, so that hues outside [0..1) wrap with a bitwise
+    and.
+    """
+
+    DEFAULT_SIZE = (128, 256, 32)
+
+    def __init__(self, convert, size=DEFAULT_SIZE, gamma=1.0):
+        hues, lights, sats = size
+        if hues < 1 or hues & (hues - 1) or lights < 2 or sats < 2:
+            raise ValueError("Invalid color LUT size %r" % (size,))
+        self.size = tuple(size)
+        self.gamma = gamma
+
+        grid = np.empty(size, dtype=dtypes.hls_color)
+        grid['hue'] = (np.arange(hues, dtype=np.float64) / hues)[:, np.newaxis, np.newaxis]
+        grid['light'] = np.linspace(0.0, 1.0, lights)[np.newaxis, :, np.newaxis]
+        grid['sat'] = np.linspace(0.0, 1.0, sats)[np.newaxis, np.newaxis, :]
+        rgb = convert(grid.reshape(-1))
+        if gamma != 1.0:
+            np.power(struct_flat(rgb), gamma, struct_flat(rgb))
+
+        self._rgb = np.empty((rgb.size, 3), dtype=np.uint8)
+        rgb_to_uint8(rgb, self._rgb)
+        self._bgr = np.ascontiguousarray(self._rgb[:, ::-1])
+
+    def nbytes(self):
+        return self._rgb.nbytes + self._bgr.nbytes
+
+    def lookup(self, arr, out, scratch, dimmer=1.0, swizzle=False):
+        """
+        Converts the HLS array `arr` into `out`, a contiguous uint8 array of
+        shape arr.shape + (3,), in BGR order if `swizzle` is set
+        """
+        hues, lights, sats = self.size
+        f = scratch.get('color_lut.f', arr.shape, arr.dtype[0])
+        index = scratch.get('color_lut.index', arr.shape, np.intp)
+        tmp = scratch.get('color_lut.tmp', arr.shape, np.intp)
+
+        np.multiply(arr['hue'], hues, f)
+        np.rint(f, f)
+        np.copyto(index, f, casting='unsafe')
+        np.bitwise_and(index, hues - 1, index)
+        np.multiply(index, lights * sats, index)
+
+        np.multiply(arr['light'], dimmer * (lights - 1), f)
+        np.clip(f, 0, lights - 1, f)
+        np.rint(f, f)
+        np.copyto(tmp, f, casting='unsafe')
+        np.multiply(tmp, sats, tmp)
+        np.add(index, tmp, index)
+
+        np.multiply(arr['sat'], sats - 1, f)
+        np.clip(f, 0, sats - 1, f)
+        np.rint(f, f)
+        np.copyto(tmp, f, casting='unsafe')
+        np.add(index, tmp, index)
+
+        # NaNs cast to arbitrary indices, so clip rather than raise
+        np.take(self._bgr if swizzle else self._rgb, index, axis=0, out=out, mode='clip')
+        return out
@@ -15,6 +15,61 @@
 # You should have received a copy of the GNU General Public License
 # along with Firemix.  If not, see <http://www.gnu.org/licenses/>.
 
+import numpy as np
+
 modes = ["RGB8", "HSVF32", "HLSF32"]
 
 strand_modes = ["RGB8", "BGR8"]
+
+# Size of one pixel on the wire.  The float modes are three native-endian
+# (on all supported platforms, little-endian) float32 values per pixel.
+bytes_per_pixel = {
+    "RGB8": 3,
+    "HSVF32": 12,
+    "HLSF32": 12,
+}
+
+
+def hls_to_hlsf32(arr, out, scratch):
+    """
+    Writes an HLS color array to `out`, an (n, 3) float32 array of
+    (hue, lightness, saturation)
+    """
+    for i, channel in enumerate(('hue', 'light', 'sat')):
+        np.copyto(out[:, i], arr[channel], casting='same_kind')
+    return out
+
+
+def hls_to_hsvf32(arr, out, scratch):
+    """
+    Writes an HLS color array to `out`, an (n, 3) float32 array of
+    (hue, saturation, value)
+
+    V = L + S * min(L, 1 - L), S_v = 2 * (1 - L / V), or 0 for black
+    """
+    value = scratch.get('hsvf32.value', arr.shape, arr.dtype[0])
+    np.subtract(1.0, arr['light'], value)
+    np.minimum(value, arr['light'], value)
+    np.multiply(value, arr['sat'], value)
+    np.add(value, arr['light'], value)
+
+    # Black has no saturation; 1 here makes it 0 below
+    lit = scratch.get('hsvf32.lit', arr.shape, bool)
+    np.greater(value, 0, out=lit)
+    sat = scratch.get('hsvf32.sat', arr.shape, arr.dtype[0])
+    np.divide(arr['light'], value, sat, where=lit)
+    np.logical_not(lit, lit)
+    np.copyto(sat, 1.0, where=lit)
+    np.subtract(1.0, sat, sat)
+    np.multiply(sat, 2.0, sat)
+
+    np.copyto(out[:, 0], arr['hue'], casting='same_kind')
+    np.copyto(out[:, 1], sat, casting='same_kind')
+    np.copyto(out[:, 2], value, casting='same_kind')
+    return out
+
+
+float_encoders = {
+    "HSVF32": hls_to_hsvf32,
+    "HLSF32": hls_to_hlsf32,
+}
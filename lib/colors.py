@@ -19,7 +19,8 @@ from lib.color_fade import ColorFade
 import colorsys
 from lib import dtypes
 
-from lib.buffer_utils import struct_flat
+from lib.buffer_utils import empty_like, struct_flat
+from lib.scratch_arena import ScratchArena
 
 import numpy as np
 
@@ -55,7 +56,36 @@ def blend_to_buffer(source, destination, progress, mode):
     return destination
 
 
-def hls_blend(start, end, out, progress, mode, fade_length=1.0, ease_power=0.5):
+def _hue_vector(color, power, x, y, tmp):
+    """
+    Writes the hues of `color` to (x, y) as vectors whose length is their
+    weight in hls_blend
+    """
+    np.clip(color['light'], 0, 1, tmp)
+    np.subtract(0.5, tmp, tmp)
+    np.absolute(tmp, tmp)
+    np.multiply(tmp, -2.0, tmp)
+    np.add(tmp, 1.0, tmp)
+    np.multiply(tmp, color['sat'], tmp)
+    np.multiply(tmp, power, tmp)
+
+    np.multiply(color['hue'], 2 * np.pi, x)
+    np.sin(x, y)
+    np.cos(x, x)
+    np.multiply(x, tmp, x)
+    np.multiply(y, tmp, y)
+
+
+def hls_blend(start, end, out, progress, mode, fade_length=1.0, ease_power=0.5,
+              scratch=None):
+    """
+    Blends two HLS buffers into `out` (which may be one of the inputs).
+    Intermediate results are kept in `scratch`, if given, so that repeated
+    calls don't allocate.
+    """
+    if scratch is None:
+        scratch = ScratchArena()
+
     p = abs(progress)
 
     startPower = (1.0 - p) / fade_length
@@ -66,45 +96,56 @@ def hls_blend(start, end, out, progress, mode, fade_length=1.0, ease_power=0.5):
     endPower = clip(0.0, endPower, 1.0)
     endPower = pow(endPower, ease_power)
 
-    l1clipped = np.empty_like(start['light'])
-    l2clipped = np.empty_like(end['light'])
-    np.clip(start['light'],0,1,l1clipped)
-    np.clip(end['light'],0,1,l2clipped)
+    shape = start.shape
+    float_type = start.dtype[0]
+    x1 = scratch.get('hls_blend.x1', shape, float_type)
+    y1 = scratch.get('hls_blend.y1', shape, float_type)
+    x2 = scratch.get('hls_blend.x2', shape, float_type)
+    y2 = scratch.get('hls_blend.y2', shape, float_type)
+    h = scratch.get('hls_blend.h', shape, float_type)
+    l = scratch.get('hls_blend.l', shape, float_type)
+    s = scratch.get('hls_blend.s', shape, float_type)
+    tmp = scratch.get('hls_blend.tmp', shape, float_type)
+
     np.clip(start['sat'],0,1,start['sat'])
     np.clip(end['sat'],0,1,end['sat'])
 
-    startWeight = (1.0 - 2 * np.abs(0.5 - l1clipped)) * start['sat']
-    endWeight = (1.0 - 2 * np.abs(0.5 - l2clipped)) * end['sat']
+    _hue_vector(start, startPower, x1, y1, tmp)
+    _hue_vector(end, endPower, x2, y2, tmp)
 
-    s = (start['sat'] * startPower + end['sat'] * endPower)
-    x1 = np.cos(2 * np.pi * start['hue']) * startPower * startWeight
-    x2 = np.cos(2 * np.pi * end['hue']) * endPower * endWeight
-    y1 = np.sin(2 * np.pi * start['hue']) * startPower * startWeight
-    y2 = np.sin(2 * np.pi * end['hue']) * endPower * endWeight
-    x = x1 + x2
-    y = y1 + y2
+    np.multiply(start['sat'], startPower, s)
+    np.multiply(end['sat'], endPower, tmp)
+    np.add(s, tmp, s)
 
     if progress >= 0:
-        l = np.maximum(start['light'] * startPower, end['light'] * endPower)
-        opposition = np.sqrt(np.square((x1-x2) / 2) + np.square((y1-y2) / 2))
+        np.multiply(start['light'], startPower, l)
+        np.multiply(end['light'], endPower, tmp)
         if mode == 'multiply':
-            l = np.minimum(start['light'] * startPower, end['light'] * endPower)
-            #l -= opposition
-        elif mode == 'add':
-            l = np.maximum(l, opposition, l)
+            np.minimum(l, tmp, l)
+        else:
+            np.maximum(l, tmp, l)
+            if mode == 'add':
+                # opposition = |v1 - v2| / 2
+                np.subtract(x1, x2, h)
+                np.subtract(y1, y2, tmp)
+                np.hypot(h, tmp, tmp)
+                np.multiply(tmp, 0.5, tmp)
+                np.maximum(l, tmp, l)
+        np.add(x1, x2, x1)
+        np.add(y1, y2, y1)
     else: # hacky support for old blend
-        l = np.sqrt(np.square(x) + np.square(y)) / 2
-
-    h = np.arctan2(y, x) / (2*np.pi)
+        np.add(x1, x2, x1)
+        np.add(y1, y2, y1)
+        np.hypot(x1, y1, l)
+        np.multiply(l, 0.5, l)
 
-    nocolor = (x * y == 0)
-    np.where(nocolor, h, 0)
-    np.where(nocolor, s, 0)
+    np.arctan2(y1, x1, h)
+    np.divide(h, 2 * np.pi, h)
 
     np.clip(l, 0, 1, l)
 
     if out is None:
-        out = np.empty_like(start)
+        out = empty_like(start)
 
     out['hue'] = h
     out['light'] = l
@@ -112,56 +153,78 @@ def hls_blend(start, end, out, progress, mode, fade_length=1.0, ease_power=0.5):
 
     return out
 
-def rgb_to_hls(arr):
-    """ fast rgb_to_hls using numpy array """
-    # XXX: arr is assumed to be an unstructured, multidimensional integer array
-    # rather than an array with dtype rgb_color. This is because the only user
-    # of this function is ImagePattern and I don't feel like fixing that.
-
-    # adapted from Arnar Flatberg
-    # http://www.mail-archive.com/numpy-discussion@scipy.org/msg06147.html
-
-    arr = arr.astype("float32") / 255.0
-    out = np.empty(arr.shape[0], dtype=dtypes.hls_color)
-
-    arr_max = arr.max(-1)
-    delta = arr.ptp(-1)
-    arr_min = arr.min(-1)
-    total = arr_max + arr_min
-
-    l = total / 2.0
-
-    if total.all() > 0:
-        s = delta / total
-        idx = (l > 0.5)
-        s[idx] = delta[idx] / (2.0 - total[idx])
-
-        # red is max
-        idx = (arr[:,:,0] == arr_max)
-        out['hue'][idx] = (arr[idx, 1] - arr[idx, 2]) / delta[idx]
-
-        # green is max
-        idx = (arr[:,:,1] == arr_max)
-        out['hue'][idx] = 2. + (arr[idx, 2] - arr[idx, 0] ) / delta[idx]
-
-        # blue is max
-        idx = (arr[:,:,2] == arr_max)
-        out['hue'][idx] = 4. + (arr[idx, 0] - arr[idx, 1] ) / delta[idx]
-
-        out['hue'] = (out['hue']/6.0) % 1.0
-        out['light'] = l
-        out['sat'] = s
-
-        idx = (delta==0)
-        out['sat'][idx] = 0.0
-        out['hue'][idx] = 0.0
+def rgb_to_hls(arr, out=None, scratch=None):
+    """
+    Converts an RGB8 array, whose last axis holds (r, g, b) in [0..255]
+    (e.g. an (n, 3) list of pixels or an (h, w, 3) image), to an HLS color
+    array of shape arr.shape[:-1].  The result is written to `out` if given
+    (a structured HLS array or a PlanarBuffer), and work arrays are kept in
+    `scratch`, so that converting every frame doesn't allocate.
 
-        # remove NaN
-        flat = struct_flat(out)
-        flat[np.isnan(flat)] = 0
+    Black, white and grays get a hue and saturation of 0, as in colorsys.
+    """
+    if scratch is None:
+        scratch = ScratchArena()
+    shape = arr.shape[:-1]
+    if out is None:
+        out = np.empty(shape, dtype=dtypes.hls_color)
+    float_type = out.dtype[0]
+
+    # One contiguous plane per channel
+    rgb = scratch.get('rgb_to_hls.rgb', (3,) + shape, float_type)
+    np.multiply(np.moveaxis(arr, -1, 0), 1.0 / 255, rgb)
+    r, g, b = rgb
+
+    high = scratch.get('rgb_to_hls.high', shape, float_type)
+    low = scratch.get('rgb_to_hls.low', shape, float_type)
+    delta = scratch.get('rgb_to_hls.delta', shape, float_type)
+    tmp = scratch.get('rgb_to_hls.tmp', shape, float_type)
+    np.maximum(r, g, high)
+    np.maximum(high, b, high)
+    np.minimum(r, g, low)
+    np.minimum(low, b, low)
+    np.subtract(high, low, delta)
+
+    # L = (max + min) / 2, S = delta / (1 - |max + min - 1|).  The divisor
+    # is at least delta, so S is in [0..1] and only grays divide by zero;
+    # clamping the divisor gives them S = 0.
+    np.add(high, low, low)
+    np.multiply(low, 0.5, out['light'])
+    np.subtract(low, 1.0, tmp)
+    np.absolute(tmp, tmp)
+    np.subtract(1.0, tmp, tmp)
+    np.maximum(tmp, 1e-12, tmp)
+    np.divide(delta, tmp, out['sat'])
+
+    # The hue is measured from whichever channel is the largest, in sixths
+    # of the color wheel.  Red goes last, so that it wins ties like
+    # colorsys, and grays (with a zero difference) get a hue of 0.
+    np.maximum(delta, 1e-12, delta)
+    np.reciprocal(delta, delta)
+    hue = scratch.get('rgb_to_hls.hue', shape, float_type)
+    is_max = scratch.get('rgb_to_hls.is_max', shape, bool)
+
+    np.subtract(r, g, hue)
+    np.multiply(hue, delta, hue)
+    np.add(hue, 4.0, hue)
+
+    np.equal(g, high, is_max)
+    np.subtract(b, r, tmp)
+    np.multiply(tmp, delta, tmp)
+    np.add(tmp, 2.0, tmp)
+    np.copyto(hue, tmp, where=is_max)
+
+    np.equal(r, high, is_max)
+    np.subtract(g, b, tmp)
+    np.multiply(tmp, delta, tmp)
+    np.copyto(hue, tmp, where=is_max)
+
+    np.multiply(hue, 1.0 / 6, hue)
+    np.mod(hue, 1.0, out['hue'])
 
     return out
 
+
 lookup_entries = 4096
 
 max_r = 0.9
@@ -181,101 +244,142 @@ hue_lookup = ColorFade(
         (max_r*0.7, 0,          max_b),
         (max_r,     0,          0),
     ], lookup_entries)
+# The last entry of the fade is the first color again, so leave it out and
+# let indices wrap around instead
+hue_lookup_rgb = struct_flat(hue_lookup.color_cache).reshape((-1, 3))[:lookup_entries]
+# The table in each color channel type, so that lookups don't convert
+_hue_lookup_rgb = {hue_lookup_rgb.dtype: hue_lookup_rgb}
 
-def hls_to_rgb_perceptual(arr, out=None):
-
-    # uncorrected/spectral RGB values don't produce a nice color space
-    # this function attempts to produce something that has:
-    #   * even brightness across hues
-    #   * a hue curve closer to human concepts of rainbows
-
-    # use lookup table based on hue
-    hues = arr['hue']
-
-    lookup_index = ((hues - hues.astype(np.int)) * lookup_entries).astype(np.int)
-
-    out = hue_lookup.color_cache[lookup_index]
-    outview = out.view(np.float64).reshape(out.shape + (-1,))
-
-    # adjust L and S ...
-
-    luminances = np.clip(arr['light'], 0, 1).reshape((3600,1))
-    shades = np.clip(luminances * 2, 0, 1)
-    outview *= shades
-    pastels = np.clip(luminances * 2 - 1, 0, 1)
-    outview += pastels
-    grays = np.tile(np.clip(arr['light'], 0, 1),(3,1)).T
-    saturations = np.clip(arr['sat'], 0, 1).reshape((3600,1))
-    final = saturations*outview + (1-saturations)*grays
-
-    return final.view(dtypes.rgb_color).reshape(arr.shape)
-
-
-
-
+def hls_to_rgb_perceptual(arr, out=None, scratch=None):
+    """
+    Converts an HLS color array of any shape to RGB in [0..1], writing into
+    `out` if given.  Work arrays are kept in `scratch`, so repeated calls
+    don't allocate.
+
+    Uncorrected/spectral RGB values don't produce a nice color space.  This
+    attempts to produce something that has:
+      * even brightness across hues
+      * a hue curve closer to human concepts of rainbows
+    """
+    if scratch is None:
+        scratch = ScratchArena()
+    if out is None:
+        out = np.empty(arr.shape, dtype=dtypes.rgb_color)
+    outview = struct_flat(out).reshape(arr.shape + (3,))
+    float_type = outview.dtype
+
+    table = _hue_lookup_rgb.get(float_type, None)
+    if table is None:
+        table = hue_lookup_rgb.astype(float_type)
+        _hue_lookup_rgb[float_type] = table
+
+    # Look up the fully saturated color of each hue.  Hues outside [0..1)
+    # wrap around the table.
+    lookup = scratch.get('perceptual.lookup', arr.shape, arr.dtype[0])
+    lookup_index = scratch.get('perceptual.lookup_index', arr.shape, np.intp)
+    np.multiply(arr['hue'], lookup_entries, lookup)
+    np.copyto(lookup_index, lookup, casting='unsafe')
+    np.take(table, lookup_index, axis=0, out=outview, mode='wrap')
+
+    # Darken it towards black below L = 0.5 (shades) and lighten it towards
+    # white above (pastels), then mix with gray by saturation:
+    #   rgb = S * (color * shade + pastel) + (1 - S) * L
+    #       = color * (S * shade) + (S * (pastel - L) + L)
+    # so that only two passes are made over the three channels.
+    light = scratch.get('perceptual.light', arr.shape, float_type)
+    sat = scratch.get('perceptual.sat', arr.shape, float_type)
+    scale = scratch.get('perceptual.scale', arr.shape, float_type)
+    offset = scratch.get('perceptual.offset', arr.shape, float_type)
+    np.clip(arr['light'], 0, 1, light)
+    np.clip(arr['sat'], 0, 1, sat)
+
+    np.multiply(light, 2, offset)
+    np.minimum(offset, 1, scale)
+    np.multiply(scale, sat, scale)
+
+    np.subtract(offset, 1, offset)
+    np.maximum(offset, 0, offset)
+    np.subtract(offset, light, offset)
+    np.multiply(offset, sat, offset)
+    np.add(offset, light, offset)
+
+    outview *= scale[..., np.newaxis]
+    outview += offset[..., np.newaxis]
+    # Pastels of the brighter hues go past white
+    np.minimum(outview, 1.0, outview)
 
+    return out
 
 
-def hls_to_rgb(arr, out=None):
+def hls_to_rgb(arr, out=None, scratch=None):
     """
     Converts HLS color array [[H,L,S]] to RGB array.
 
-    http://en.wikipedia.org/wiki/HSL_and_HSV#From_HSL
+    http://en.wikipedia.org/wiki/HSL_and_HSV#HSL_to_RGB_alternative
 
     Returns [[R,G,B]] in [0..1]
-
-    Adapted from: http://stackoverflow.com/questions/4890373/detecting-thresholds-in-hsv-color-space-from-rgb-using-python-pil/4890878#4890878
     """
-
+    if scratch is None:
+        scratch = ScratchArena()
     if out is None:
-        out = np.zeros_like(arr, dtype=dtypes.rgb_color)
-    else:
-        assert "I believe there is a bug here. if an array is passed in, it needs to get zeroed"
+        out = np.empty(arr.shape, dtype=dtypes.rgb_color)
+
+    float_type = arr.dtype[0]
+
+    # a = S * min(L, 1 - L)
+    a = scratch.get('hls_to_rgb.a', arr.shape, float_type)
+    np.subtract(1.0, arr['light'], a)
+    np.minimum(a, arr['light'], a)
+    np.multiply(a, arr['sat'], a)
+
+    h12 = scratch.get('hls_to_rgb.h12', arr.shape, float_type)
+    np.multiply(arr['hue'], 12.0, h12)
+
+    k = scratch.get('hls_to_rgb.k', arr.shape, float_type)
+    t = scratch.get('hls_to_rgb.t', arr.shape, float_type)
+    for n, channel in ((0, 'r'), (8, 'g'), (4, 'b')):
+        # f(n) = L - a * max(-1, min(k - 3, 9 - k, 1)), k = (n + H * 12) mod 12
+        np.add(h12, n, k)
+        np.mod(k, 12.0, k)
+        np.subtract(9.0, k, t)
+        np.subtract(k, 3.0, k)
+        np.minimum(k, t, k)
+        np.clip(k, -1.0, 1.0, k)
+        np.multiply(k, a, k)
+        np.subtract(arr['light'], k, out[channel])
 
-    C = (1 - np.absolute(2 * arr['light'] - 1)) * arr['sat']
-
-    Hp = arr['hue'] * 6.0
-    i = Hp.astype(np.int)
-    #f = Hp - i  # |H' mod 2|  ?
-
-    X = C * (1 - np.absolute(np.mod(Hp, 2) - 1))
-    #X = C * (1 - f)
-
-    # handle each case:
-
-    #mask = (Hp >= 0) == ( Hp < 1)
-    mask = i % 6 == 0
-    out['r'][mask] = C[mask]
-    out['g'][mask] = X[mask]
-
-    #mask = (Hp >= 1) == ( Hp < 2)
-    mask = i == 1
-    out['r'][mask] = X[mask]
-    out['g'][mask] = C[mask]
-
-    #mask = (Hp >= 2) == ( Hp < 3)
-    mask = i == 2
-    out['g'][mask] = C[mask]
-    out['b'][mask] = X[mask]
-
-    #mask = (Hp >= 3) == ( Hp < 4)
-    mask = i == 3
-    out['g'][mask] = X[mask]
-    out['b'][mask] = C[mask]
-
-    #mask = (Hp >= 4) == ( Hp < 5)
-    mask = i == 4
-    out['r'][mask] = X[mask]
-    out['b'][mask] = C[mask]
-
-    #mask = (Hp >= 5) == ( Hp < 6)
-    mask = i == 5
-    out['r'][mask] = C[mask]
-    out['b'][mask] = X[mask]
+    return out
 
-    m = arr['light'] - 0.5*C
-    out['r'] += m
-    out['g'] += m
-    out['b'] += m
 
+def rgb_to_uint8(arr, out, residual=None, scratch=None):
+    """
+    Scales an RGB color array (in place, without a residual) and rounds it to
+    the nearest byte in `out`, a uint8 array of shape arr.shape + (3,).  The
+    colors must be in [0..1], which hls_to_rgb and hls_to_rgb_perceptual
+    guarantee for clamped HLS input, so nothing is clipped.
+
+    With `residual` (float32, shaped like `out`), the rounding error of each
+    channel is carried over to the next call, so that over time a pixel
+    averages out to its exact color (temporal dithering).  This avoids
+    banding in dark gradients and at low dimmer levels.
+    """
+    flat = struct_flat(arr).reshape(out.shape)
+    if residual is None:
+        np.multiply(flat, 255, flat)
+        np.add(flat, 0.5, flat)
+        np.copyto(out, flat, casting='unsafe')
+        return out
+
+    if scratch is None:
+        scratch = ScratchArena()
+    # Single precision is plenty for values up to 255, and faster.  The
+    # residual is within +/- 0.5, so only the top can overflow.
+    wanted = scratch.like('rgb_to_uint8.wanted', residual)
+    rounded = scratch.like('rgb_to_uint8.rounded', residual)
+    np.multiply(flat, 255, wanted, casting='same_kind')
+    np.add(wanted, residual, wanted)
+    np.rint(wanted, rounded)
+    np.minimum(rounded, 255, rounded)
+    np.copyto(out, rounded, casting='unsafe')
+    np.subtract(wanted, rounded, residual)
     return out
@@ -17,15 +17,47 @@
 
 import numpy as np
 
-rgb_color = np.dtype({'names': ['r', 'g', 'b'],
-                      'formats': [float, float, float],
-                      'titles': ['red', 'green', 'blue']})
+# The floating-point type of every color channel.  Pixel buffers use float64
+# unless set_float_type() switches them to float32 at startup.
+float_type = np.dtype(np.float64)
 
-hls_color = np.dtype({'names': ['hue', 'light', 'sat'],
-                      'formats': [float, float, float],
-                      'titles': [None, 'lightness', 'saturation']})
+
+def color_dtypes(float_type):
+    """
+    Returns the (rgb, hls) color dtypes with channels of `float_type`
+    """
+    rgb = np.dtype({'names': ['r', 'g', 'b'],
+                    'formats': [float_type, float_type, float_type],
+                    'titles': ['red', 'green', 'blue']})
+
+    hls = np.dtype({'names': ['hue', 'light', 'sat'],
+                    'formats': [float_type, float_type, float_type],
+                    'titles': [None, 'lightness', 'saturation']})
+    return rgb, hls
+
+
+rgb_color, hls_color = color_dtypes(float_type)
 
 pixel_color = hls_color
 
 pixel_location = np.dtype({'names': ['x', 'y'],
                            'formats': [np.int32, np.int32]})
+
+
+def set_float_type(new_float_type):
+    """
+    Switches the color dtypes to np.float32 or np.float64.  Single precision
+    halves the memory traffic of every preset, transition and conversion,
+    and is still far finer than an LED can show.
+
+    Buffers that already exist keep their type, so this must be called
+    before any are created (i.e. before the mixer, presets and output are
+    set up).
+    """
+    global float_type, rgb_color, hls_color, pixel_color
+    new_float_type = np.dtype(new_float_type)
+    if new_float_type not in (np.float32, np.float64):
+        raise ValueError("Unsupported color channel type %s" % new_float_type)
+    float_type = new_float_type
+    rgb_color, hls_color = color_dtypes(float_type)
+    pixel_color = hls_color
@@ -33,6 +33,10 @@ log = logging.getLogger("firemix.lib.pattern")
 class Pattern(JSONDict):
     """Base Pattern.  Does nothing."""
 
+    # Set this to True in patterns that call mark_dirty() for every pixel
+    # they change.  Otherwise the whole frame is assumed to change each time.
+    dirty_tracking = False
+
     def __init__(self, app, slug=""):
         self._app = app
         self._ticks = 0
@@ -43,6 +47,9 @@ class Pattern(JSONDict):
         self._instance_slug = slug
         self.initialized = False
         self.disabled = False
+        self.quality = 0
+        self._dirty_strands = None
+        self._all_dirty = True
 
         filepath = os.path.join(os.getcwd(), "data", "presets", "".join([slug, ".json"]))
         JSONDict.__init__(self, 'preset', filepath, True)
@@ -100,6 +107,7 @@ class Pattern(JSONDict):
 
     def _reset(self):
         self.reset()
+        self.mark_all_dirty()
 
     def setup(self):
         """
@@ -121,6 +129,46 @@ class Pattern(JSONDict):
         """
         return True
 
+    def set_quality(self, level):
+        """
+        Called by the mixer's quality governor when the render load changes.
+        Level 0 is full quality; higher levels (up to QualityGovernor.MAX_LEVEL)
+        ask for progressively cheaper rendering when the mixer can't keep up.
+        Extend this method if your pattern has expensive settings that can be
+        scaled back; the current level is also available as self.quality.
+        """
+        self.quality = level
+
+    def mark_dirty(self, indices):
+        """
+        Records that the pixel(s) at `indices` changed in this frame.  Only
+        used by patterns with dirty_tracking enabled.
+        """
+        if self._dirty_strands is None:
+            self._dirty_strands = np.zeros(BufferUtils.num_strands, dtype=bool)
+        self._dirty_strands[BufferUtils.pixel_strands()[indices]] = True
+
+    def mark_all_dirty(self):
+        self._all_dirty = True
+
+    def take_dirty_strands(self):
+        """
+        Called by the mixer after each render.  Returns a boolean mask of the
+        strands that changed since the last call, or None if any pixel may
+        have changed, and starts a new frame.
+        """
+        if not self.dirty_tracking or self._all_dirty:
+            self._all_dirty = False
+            if self._dirty_strands is not None:
+                self._dirty_strands[:] = False
+            return None
+
+        if self._dirty_strands is None:
+            self._dirty_strands = np.zeros(BufferUtils.num_strands, dtype=bool)
+        dirty = self._dirty_strands.copy()
+        self._dirty_strands[:] = False
+        return dirty
+
     def add_parameter(self, parameter):
         """
         Adds a parameter to the preset (see ./lib/parameters.py)
@@ -171,8 +219,9 @@ class Pattern(JSONDict):
         if self.disabled:
             return
 
-        for parameter in list(self._parameters.values()):
-            parameter.tick(dt)
+        with self._app.mixer.profiler.span('parameter-tick', self.__class__.__name__):
+            for parameter in list(self._parameters.values()):
+                parameter.tick(dt)
 
         self._ticks += 1
 
@@ -113,6 +113,7 @@ class Scene(JSONDict):
 
     def set_strand_settings(self, settings):
         self.data["strand-settings"] = settings
+        self._strand_settings = settings
 
     def fixtures(self):
         """
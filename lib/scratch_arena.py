@@ -0,0 +1,64 @@
+# This file is part of Firemix.
+#
+# Copyright 2013-2020 Jonathan Evans <jon@craftyjon.com>
+#
+# Firemix is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Firemix is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Firemix.  If not, see <http://www.gnu.org/licenses/>.
+
+from builtins import object
+import numpy as np
+
+
+class ScratchArena(object):
+    """
+    A set of named work arrays that are allocated on first use and then reused
+    on every frame, so that the steady-state render and output paths don't
+    allocate.
+
+    The contents of a scratch array are undefined when it is handed out.  An
+    arena is not thread-safe: each component that renders or outputs frames
+    owns its own, so that e.g. the output thread never shares scratch space
+    with the render thread.
+    """
+
+    def __init__(self):
+        self._arrays = {}
+
+    def get(self, name, shape, dtype=np.float64):
+        """
+        Returns the work array called `name` with the requested shape and
+        dtype.  The array is a view of storage that only grows, so asking for
+        smaller arrays under the same name (e.g. one strand at a time) doesn't
+        reallocate.
+        """
+        if not isinstance(shape, tuple):
+            shape = (shape,)
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape))
+        storage = self._arrays.get(name, None)
+        if storage is None or storage.dtype != dtype or storage.size < size:
+            storage = np.empty(size, dtype=dtype)
+            self._arrays[name] = storage
+        return storage[:size].reshape(shape)
+
+    def like(self, name, arr, dtype=None):
+        """
+        Returns a work array with the same shape as `arr`
+        """
+        return self.get(name, arr.shape, arr.dtype if dtype is None else dtype)
+
+    def clear(self):
+        self._arrays = {}
+
+    def nbytes(self):
+        return sum(arr.nbytes for arr in self._arrays.values())
@@ -17,6 +17,9 @@
 
 
 from builtins import object
+
+from lib.scratch_arena import ScratchArena
+
 class Transition(object):
     """
     Defines the interface for a transition.
@@ -26,6 +29,8 @@ class Transition(object):
 
     def __init__(self, app):
         self._app = app
+        # Work arrays for render(), reused across frames
+        self._scratch = ScratchArena()
 
     def __repr__(self):
         """
@@ -0,0 +1,107 @@
+# This file is part of Firemix.
+#
+# Copyright 2013-2020 Jonathan Evans <jon@craftyjon.com>
+#
+# Firemix is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Firemix is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Firemix.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Stand-in Open Pixel Control server for testing OPC output without hardware.
+Accepts any number of TCP connections, parses the OPC messages and prints
+the frame and pixel rates once a second.
+
+    python opc_server.py [--port 7890] [--delay SECONDS]
+
+--delay makes the server sleep after each message, to simulate a server that
+can't keep up.
+"""
+
+import argparse
+import asyncio
+import logging
+import time
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger("opc_server")
+
+
+class OpcStats(object):
+
+    def __init__(self):
+        self.frames = 0
+        self.pixels = 0
+        self.channels = set()
+        self.connections = 0
+
+    def report(self, elapsed):
+        log.info("%d connections, %.1f frames/s, %.0f pixels/s, channels %s"
+                 % (self.connections, self.frames / elapsed, self.pixels / elapsed,
+                    sorted(self.channels)))
+        self.frames = 0
+        self.pixels = 0
+        self.channels = set()
+
+
+async def handle_client(reader, writer, stats, delay):
+    peer = writer.get_extra_info('peername')
+    log.info("Connection from %s:%d" % peer[:2])
+    stats.connections += 1
+    try:
+        while True:
+            header = await reader.readexactly(4)
+            channel, command = header[0], header[1]
+            length = (header[2] << 8) | header[3]
+            await reader.readexactly(length)
+            if command == 0:
+                stats.frames += 1
+                stats.pixels += length // 3
+                stats.channels.add(channel)
+            if delay > 0:
+                await asyncio.sleep(delay)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        stats.connections -= 1
+        writer.close()
+        log.info("%s:%d disconnected" % peer[:2])
+
+
+async def report_loop(stats):
+    last = time.monotonic()
+    while True:
+        await asyncio.sleep(1.0)
+        now = time.monotonic()
+        stats.report(now - last)
+        last = now
+
+
+async def serve(port, delay):
+    stats = OpcStats()
+    server = await asyncio.start_server(
+        lambda r, w: handle_client(r, w, stats, delay), "0.0.0.0", port)
+    log.info("Listening for OPC on port %d" % port)
+    asyncio.ensure_future(report_loop(stats))
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stand-in OPC server")
+    parser.add_argument("--port", type=int, default=7890)
+    parser.add_argument("--delay", type=float, default=0.0,
+                        help="Seconds to sleep after each message")
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.port, args.delay))
+    except KeyboardInterrupt:
+        pass
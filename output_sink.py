@@ -0,0 +1,495 @@
+# This file is part of Firemix.
+#
+# Copyright 2013-2020 Jonathan Evans <jon@craftyjon.com>
+#
+# Firemix is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Firemix is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Firemix.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Local stand-in for the controllers, for testing and profiling network output
+on one machine.  Receives Legacy frames ('B', 'S'/'D' packets, 'E') over UDP
+and Open Pixel Control over TCP and UDP, and prints per-source statistics
+once a second: frames/s, incomplete frames, per-strand completeness, the time
+from the first to the last packet of a frame ("spread") and the interval
+between frames.
+
+    python output_sink.py [--port 3020] [--opc-port 7890] [--strands N] [--record FILE]
+
+With --record, every complete Legacy frame and every OPC message is written
+to FILE (see read_recording()).
+
+    python output_sink.py --bench [--strands 20] [--pixels 240] [--fps 60] [--duration 10]
+
+runs the sink in-process and sends it synthetic Legacy frames through the
+same batched UDP sender FireMix uses, measuring loss and the latency from
+sending a frame to receiving all of it.
+"""
+
+import argparse
+import asyncio
+import logging
+import socket
+import struct
+import threading
+import time
+
+import numpy as np
+
+log = logging.getLogger("output_sink")
+
+# kind (b'L' or b'O'), receive time, OPC channel or Legacy strand count, length
+RECORD_HEADER = struct.Struct("<cdHI")
+
+
+class Recorder(object):
+    """
+    Appends received frames to a file.  Each record is a RECORD_HEADER
+    followed by the data: for Legacy, the latest 'S' packet (header included)
+    of every strand seen so far; for OPC, the message's pixel data.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, "wb")
+        self._start = time.monotonic()
+        self.records = 0
+
+    def write(self, kind, when, channel, data):
+        self._file.write(RECORD_HEADER.pack(kind, when - self._start, channel, len(data)))
+        self._file.write(data)
+        self.records += 1
+
+    def close(self):
+        self._file.close()
+
+
+def read_recording(path):
+    """
+    Yields (kind, time, channel, data) for each record in a file written
+    with --record
+    """
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            kind, when, channel, length = RECORD_HEADER.unpack(header)
+            yield kind, when, channel, f.read(length)
+
+
+def percentile(samples, q):
+    return float(np.percentile(samples, q)) if samples else 0.0
+
+
+class SourceStats(object):
+    """
+    What has been received from one sender (Legacy over UDP, or one OPC
+    connection).
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.packets = 0
+        self.bytes = 0
+        self.frames = 0
+        self.incomplete = 0
+        self.malformed = 0
+        self.spreads = []
+        self.intervals = []
+        self.last_frame = None
+        # Legacy: latest data of each strand, strands in the current frame,
+        # and how many frames each strand was part of
+        self.strands = {}
+        self.frame_strands = None
+        self.frame_start = None
+        self.strand_frames = {}
+        # OPC: messages per channel
+        self.channels = {}
+        self.last_channel = None
+
+    def end_frame(self, now):
+        self.frames += 1
+        if self.frame_start is not None:
+            self.spreads.append(now - self.frame_start)
+        if self.last_frame is not None:
+            self.intervals.append(now - self.last_frame)
+        self.last_frame = now
+
+    def summary(self, elapsed, expected_strands=None):
+        """
+        Returns the statistics since the last call as a dict, and resets them
+        """
+        expected = expected_strands or len(self.strands)
+        completeness = [self.strand_frames.get(strand, 0) / float(self.frames)
+                        for strand in range(expected)] if self.frames and expected else []
+        summary = {
+            'frames': self.frames,
+            'fps': self.frames / elapsed if elapsed > 0 else 0.0,
+            'packets': self.packets,
+            'bytes': self.bytes,
+            'incomplete': self.incomplete,
+            'malformed': self.malformed,
+            'strands': len(self.strands),
+            'channels': sorted(self.channels),
+            # The fraction of frames that included the least complete strand
+            'completeness': min(completeness) if completeness else 1.0,
+            'spread-p50': percentile(self.spreads, 50),
+            'spread-p99': percentile(self.spreads, 99),
+            'interval-p50': percentile(self.intervals, 50),
+            'interval-p99': percentile(self.intervals, 99),
+        }
+        self.packets = self.bytes = self.frames = 0
+        self.incomplete = self.malformed = 0
+        self.spreads = []
+        self.intervals = []
+        self.strand_frames = {}
+        self.channels = {}
+        return summary
+
+
+class _LegacyProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, sink):
+        self._sink = sink
+
+    def datagram_received(self, data, addr):
+        self._sink.legacy_datagram(data, addr, time.monotonic())
+
+
+class _OpcDatagramProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, sink):
+        self._sink = sink
+
+    def datagram_received(self, data, addr):
+        source = self._sink.source("OPC-UDP %s:%d" % addr)
+        now = time.monotonic()
+        offset = 0
+        while offset + 4 <= len(data):
+            length = (data[offset + 2] << 8) | data[offset + 3]
+            if offset + 4 + length > len(data):
+                break
+            self._sink.opc_message(source, data[offset], data[offset + 1],
+                                   data[offset + 4:offset + 4 + length], now)
+            offset += 4 + length
+        if offset != len(data):
+            source.malformed += 1
+
+
+class OutputSink(object):
+    """
+    Receives network output on an asyncio event loop.  Either await start()
+    on a running loop, or use start_thread() to run it on a loop of its own
+    in the background (e.g. from a test or benchmark).
+
+    Port 0 picks a free port; the bound addresses are in `legacy_address`
+    and `opc_address` once started.  `on_frame` is called on the event loop
+    with (source name, receive time) for each complete Legacy frame.
+    """
+
+    def __init__(self, host="127.0.0.1", port=3020, opc_port=7890, expected_strands=None,
+                 pixel_size=3, recorder=None, on_frame=None):
+        self.host = host
+        self.port = port
+        self.opc_port = opc_port
+        self.expected_strands = expected_strands
+        self.pixel_size = pixel_size
+        self.recorder = recorder
+        self.on_frame = on_frame
+        self.legacy_address = None
+        self.opc_address = None
+        self._sources = {}
+        self._transports = []
+        self._server = None
+        self._loop = None
+        self._thread = None
+        self._last_summary = time.monotonic()
+
+    def source(self, name):
+        source = self._sources.get(name, None)
+        if source is None:
+            source = SourceStats(name)
+            self._sources[name] = source
+        return source
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        if self.port is not None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+            sock.bind((self.host, self.port))
+            transport, _ = await loop.create_datagram_endpoint(
+                lambda: _LegacyProtocol(self), sock=sock)
+            self._transports.append(transport)
+            self.legacy_address = sock.getsockname()
+        if self.opc_port is not None:
+            self._server = await asyncio.start_server(self._handle_opc, self.host, self.opc_port)
+            self.opc_address = self._server.sockets[0].getsockname()
+            # OPC-UDP on the same port number
+            transport, _ = await loop.create_datagram_endpoint(
+                lambda: _OpcDatagramProtocol(self), local_addr=self.opc_address)
+            self._transports.append(transport)
+
+    def close(self):
+        for transport in self._transports:
+            transport.close()
+        self._transports = []
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        if self.recorder is not None:
+            self.recorder.close()
+
+    def start_thread(self):
+        """
+        Runs the sink on its own event loop in a background thread
+        """
+        started = threading.Event()
+        errors = []
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            try:
+                self._loop.run_until_complete(self.start())
+            except OSError as e:
+                errors.append(e)
+                started.set()
+                return
+            started.set()
+            self._loop.run_forever()
+            self.close()
+            self._loop.run_until_complete(asyncio.sleep(0))
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, name="Firemix-output-sink", daemon=True)
+        self._thread.start()
+        started.wait()
+        if errors:
+            self._thread.join()
+            self._thread = None
+            raise errors[0]
+
+    def stop_thread(self):
+        if self._thread is None:
+            return
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._thread = None
+
+    def summary(self):
+        """
+        Returns the statistics of each source since the last call, keyed by
+        source name.  Safe to call from another thread.
+        """
+        if self._loop is not None and self._thread is not None:
+            return asyncio.run_coroutine_threadsafe(self._summary(), self._loop).result()
+        return self._summarize()
+
+    async def _summary(self):
+        return self._summarize()
+
+    def _summarize(self):
+        now = time.monotonic()
+        elapsed = now - self._last_summary
+        self._last_summary = now
+        return dict((name, source.summary(elapsed, self.expected_strands))
+                    for name, source in self._sources.items())
+
+    def legacy_datagram(self, data, addr, now):
+        source = self.source("Legacy %s:%d" % addr)
+        source.packets += 1
+        source.bytes += len(data)
+        kind = data[:1]
+
+        if kind == b'B':
+            if source.frame_strands is not None:
+                # The previous frame's end marker never arrived
+                source.incomplete += 1
+            source.frame_strands = set()
+            source.frame_start = now
+        elif kind == b'S' and len(data) >= 4:
+            strand = data[1]
+            length = data[2] | (data[3] << 8)
+            if len(data) - 4 != length:
+                source.malformed += 1
+                return
+            source.strands[strand] = bytearray(data)
+            if source.frame_strands is not None:
+                source.frame_strands.add(strand)
+        elif kind == b'D' and len(data) >= 6:
+            strand = data[1]
+            offset = self.pixel_size * (data[2] | (data[3] << 8))
+            length = data[4] | (data[5] << 8)
+            packet = source.strands.get(strand, None)
+            if (len(data) - 6 != length or packet is None
+                    or 4 + offset + length > len(packet)):
+                # Malformed, or a delta for a strand whose keyframe was lost
+                source.malformed += 1
+                return
+            packet[4 + offset:4 + offset + length] = data[6:]
+            if source.frame_strands is not None:
+                source.frame_strands.add(strand)
+        elif kind == b'E':
+            if source.frame_strands is None:
+                # The begin marker never arrived
+                source.incomplete += 1
+                return
+            source.end_frame(now)
+            for strand in source.frame_strands:
+                source.strand_frames[strand] = source.strand_frames.get(strand, 0) + 1
+            source.frame_strands = None
+            if self.recorder is not None:
+                self.recorder.write(b'L', now, len(source.strands),
+                                    b''.join(bytes(source.strands[s])
+                                             for s in sorted(source.strands)))
+            if self.on_frame is not None:
+                self.on_frame(source.name, now)
+        else:
+            source.malformed += 1
+
+    def opc_message(self, source, channel, command, data, now):
+        source.packets += 1
+        source.bytes += 4 + len(data)
+        if command != 0:
+            return
+        # A new frame starts when the channel number doesn't go up
+        if source.last_channel is None or channel <= source.last_channel:
+            source.end_frame(now)
+        source.last_channel = channel
+        source.channels[channel] = source.channels.get(channel, 0) + 1
+        if self.recorder is not None:
+            self.recorder.write(b'O', now, channel, bytes(data))
+
+    async def _handle_opc(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        source = self.source("OPC %s:%d" % peer[:2])
+        try:
+            while True:
+                header = await reader.readexactly(4)
+                length = (header[2] << 8) | header[3]
+                data = await reader.readexactly(length)
+                self.opc_message(source, header[0], header[1], data, time.monotonic())
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+def print_summary(summary):
+    for name, s in sorted(summary.items()):
+        if s['packets'] == 0:
+            continue
+        log.info("%s: %.1f frames/s, %d incomplete, %d malformed, %d strands %.1f%% complete, "
+                 "spread p50 %.2f ms p99 %.2f ms, interval p50 %.2f ms p99 %.2f ms"
+                 % (name, s['fps'], s['incomplete'], s['malformed'], s['strands'],
+                    100 * s['completeness'], 1e3 * s['spread-p50'], 1e3 * s['spread-p99'],
+                    1e3 * s['interval-p50'], 1e3 * s['interval-p99']))
+
+
+async def serve(args):
+    recorder = Recorder(args.record) if args.record else None
+    sink = OutputSink(args.host, args.port, args.opc_port, args.strands,
+                      args.pixel_size, recorder)
+    await sink.start()
+    log.info("Listening for Legacy on %s:%d and OPC on %s:%d"
+             % (sink.legacy_address + sink.opc_address))
+    try:
+        while True:
+            await asyncio.sleep(1.0)
+            print_summary(sink.summary())
+    finally:
+        sink.close()
+
+
+def bench(args):
+    """
+    Sends synthetic Legacy frames to an in-process sink at a fixed rate and
+    reports loss and send-to-receive latency
+    """
+    # Imported here so that the sink itself runs without the rest of FireMix
+    from core.udp_batch import UdpBatchSender
+
+    received = []
+    sink = OutputSink(args.host, 0, None, args.strands,
+                      on_frame=lambda name, now: received.append(now))
+    sink.start_thread()
+
+    packets = [np.array([ord('B')], dtype=np.int8)]
+    for strand in range(args.strands):
+        packet = np.zeros(4 + 3 * args.pixels, dtype=np.int8)
+        packet[0] = ord('S')
+        packet[1] = strand
+        packet[2] = (3 * args.pixels) & 0xFF
+        packet[3] = ((3 * args.pixels) & 0xFF00) >> 8
+        packets.append(packet)
+    packets.append(np.array([ord('E')], dtype=np.int8))
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sender = UdpBatchSender(sock)
+    batch = sender.prepare(packets, [sink.legacy_address])
+
+    frames = int(args.fps * args.duration)
+    sent = []
+    start = time.monotonic()
+    sink.summary()
+    for i in range(frames):
+        # Stamp the frame so that each one carries different data
+        packets[1][4:8] = np.frombuffer(struct.pack("<I", i), dtype=np.int8)
+        sent.append(time.monotonic())
+        sender.send(batch)
+        delay = start + (i + 1) / float(args.fps) - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+    time.sleep(0.2)
+    summary = sink.summary()
+    sink.stop_thread()
+    sock.close()
+
+    # Frames can only be matched up in order, so latency is only meaningful
+    # while nothing is lost
+    latencies = [r - s for s, r in zip(sent, received)] if len(received) == len(sent) else []
+    print("%d strands x %d pixels at %d FPS: %d frames sent, %d received"
+          % (args.strands, args.pixels, args.fps, len(sent), len(received)))
+    if latencies:
+        print("latency p50 %.3f ms, p99 %.3f ms, max %.3f ms"
+              % (1e3 * percentile(latencies, 50), 1e3 * percentile(latencies, 99),
+                 1e3 * max(latencies)))
+    print_summary(summary)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Local output sink")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=3020, help="Legacy UDP port")
+    parser.add_argument("--opc-port", type=int, default=7890, help="OPC TCP and UDP port")
+    parser.add_argument("--strands", type=int, default=None,
+                        help="Number of strands expected in each frame")
+    parser.add_argument("--pixel-size", type=int, default=3,
+                        help="Bytes per pixel, for 'D' (delta) packets")
+    parser.add_argument("--record", help="File to record received frames to")
+    parser.add_argument("--bench", action="store_true",
+                        help="Benchmark sending synthetic frames to an in-process sink")
+    parser.add_argument("--pixels", type=int, default=240, help="Pixels per strand (--bench)")
+    parser.add_argument("--fps", type=float, default=60, help="Frames per second (--bench)")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds (--bench)")
+    args = parser.parse_args()
+
+    if args.bench:
+        if args.strands is None:
+            args.strands = 20
+        bench(args)
+    else:
+        try:
+            asyncio.run(serve(args))
+        except KeyboardInterrupt:
+            pass
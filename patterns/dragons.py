@@ -58,7 +58,7 @@ class _Dragon(object):
                 self.alive = True
                 self.lifetime = self.pattern._current_time
 
-            self.pattern.setPixelHLS(self.pattern._buffer, self.loc, color)
+            self.pattern._set_pixel(self.loc, color)
 
         # Alive - can move or die
         if not self.alive:
@@ -66,7 +66,7 @@ class _Dragon(object):
 
         for times in range(int(self.growth)):
             s, f, p = BufferUtils.index_to_logical(self.loc)
-            self.pattern.setPixelHLS(self.pattern._buffer, self.loc, (0, 0, 0))
+            self.pattern._set_pixel(self.loc, (0, 0, 0))
 
             if random.random() < self.growth:
                 self.growth -= 1
@@ -87,7 +87,7 @@ class _Dragon(object):
                     self.pattern._tails.append((self.loc, self.pattern._current_time, self.pattern._tail_fader))
                     new_address = BufferUtils.logical_to_index((s, f, p + self.dir))
                     self.loc = new_address
-                    self.pattern.setPixelHLS(self.pattern._buffer, new_address, self.pattern._alive_color)
+                    self.pattern._set_pixel(new_address, self.pattern._alive_color)
 
             # Kill dragons that run into each other
             if self not in to_remove:
@@ -151,6 +151,9 @@ class Dragons(Pattern):
     _explode_color = (1.0, 1.0, 1.0)
     _fader_steps = 256
 
+    # Only the pixels touched by dragons and their tails change each frame
+    dirty_tracking = True
+
     def setup(self):
         self._dragons = set()
         self._tails = []
@@ -185,6 +188,10 @@ class Dragons(Pattern):
     def reset(self):
         self._buffer = BufferUtils.create_buffer()
 
+    def _set_pixel(self, loc, color):
+        self.setPixelHLS(self._buffer, loc, color)
+        self.mark_dirty(loc)
+
     def tick(self, dt):
         super(Dragons, self).tick(dt)
         self._current_time += dt
@@ -216,10 +223,10 @@ class Dragons(Pattern):
             if (self._current_time - time) > self.parameter('tail-persist').get():
                 if (loc, time, fader) in self._tails:
                     tails_to_remove.append((loc, time, fader))
-                self.setPixelHLS(self._buffer, loc, (0, 0, 0))
+                self._set_pixel(loc, (0, 0, 0))
             else:
                 progress = (self._current_time - time) / self.parameter('tail-persist').get()
-                self.setPixelHLS(self._buffer, loc, fader.get_color(progress * self._fader_steps))
+                self._set_pixel(loc, fader.get_color(progress * self._fader_steps))
         for tail in tails_to_remove:
             self._tails.remove(tail)
 
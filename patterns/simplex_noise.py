@@ -38,6 +38,7 @@ class SimplexNoise(Pattern):
     """
 
     _lightness_steps = 256
+    _pixel_step = 1
 
     def setup(self):
         self.add_parameter(FloatParameter('audio-brightness', 0.0))
@@ -69,6 +70,12 @@ class SimplexNoise(Pattern):
     def reset(self):
         self._setup_pars()
 
+    def set_quality(self, level):
+        super(SimplexNoise, self).set_quality(level)
+        # Under heavy load, sample the noise at every other pixel and let
+        # each sample cover its neighbour.
+        self._pixel_step = 2 if level >= 2 else 1
+
     def _setup_pars(self):
         self.hue_min = self.parameter('hue-min').get()
         self.hue_max = self.parameter('hue-max').get()
@@ -97,9 +104,12 @@ class SimplexNoise(Pattern):
         lightness_scale = self.parameter('lightness-scale').get() / 100.0
 
         stretch = self.parameter('stretch').get()
-        brights = snoise3(self._offset_x * stretch * lightness_scale,
-                          self._offset_y * lightness_scale,
+        step = self._pixel_step
+        brights = snoise3(self._offset_x[::step] * stretch * lightness_scale,
+                          self._offset_y[::step] * lightness_scale,
                           self._offset_z)
+        if step > 1:
+            brights = np.repeat(brights, step)[:len(self._offset_x)]
         brights = (1.0 + brights) / 2
         brights *= self._lightness_steps
         LS = self.lum_fader.color_cache[np.int_(brights)]
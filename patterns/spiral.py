@@ -24,6 +24,7 @@ import ast
 from lib.pattern import Pattern
 from lib.parameters import FloatParameter, HLSParameter, StringParameter
 from lib.color_fade import ColorFade
+from core import audio_events
 
 class SpiralGradient(Pattern):
     """Spiral gradient that responds to onsets"""
@@ -57,6 +58,7 @@ class SpiralGradient(Pattern):
         self.center_offset_angle = 0
 
         self.onset_speed_boost = 1
+        self._frame_decay = 0
 
         self.audio_twist = 0
 
@@ -78,11 +80,19 @@ class SpiralGradient(Pattern):
         self.wave_offset += dt * self.parameter('wave-speed').get() * self.onset_speed_boost
         self.color_offset += dt * self.parameter('speed').get() * self.onset_speed_boost
 
-    def render(self, out):
-        if self._app.mixer.is_onset():
-            self.onset_speed_boost = self.parameter('onset-speed-boost').get()
+        # onset-speed-decay is per frame at the configured tick rate; scale it
+        # by the actual frame time so the decay doesn't depend on frame rate.
+        self._frame_decay = self.parameter('onset-speed-decay').get() * dt * self.tick_rate()
 
-        self.onset_speed_boost = max(1, self.onset_speed_boost - self.parameter('onset-speed-decay').get())
+    def render(self, out):
+        onsets = self._app.mixer.frame_events(audio_events.ONSET)
+        if onsets:
+            # Start the boost from when the onset happened, not from this frame
+            age = max(0.0, self._app.mixer.frame_time() - onsets[-1].time)
+            self.onset_speed_boost = (self.parameter('onset-speed-boost').get()
+                                      - self.parameter('onset-speed-decay').get() * age * self.tick_rate())
+
+        self.onset_speed_boost = max(1, self.onset_speed_boost - self._frame_decay)
         audio_energy = self._app.mixer.audio.getEnergy()
         wave_hue_period = (2 * math.pi * self.parameter('wave-hue-period').get()
                            + self.parameter('audio-wave-period-boost').get() * audio_energy)
@@ -34,6 +34,9 @@ class Twinkle(Pattern):
     _time = {}
     _fader = None
     _fader_steps = 256
+    # Most audio rings drawn per frame at each quality level
+    _ring_limits = [None, 32, 8, 2]
+    _ring_limit = None
 
     def setup(self):
         random.seed()
@@ -65,6 +68,10 @@ class Twinkle(Pattern):
         self._setup_colors()
         self.eq_centers = self._idle[:int(self.parameter('audio-eq-bands').get())]
 
+    def set_quality(self, level):
+        super(Twinkle, self).set_quality(level)
+        self._ring_limit = self._ring_limits[level]
+
     def _setup_colors(self):
         #fade_colors = [self.parameter('black-color').get(), self.parameter('off-color').get(), self.parameter('on-color').get()]
         fade_colors = ast.literal_eval(self.parameter('color-gradient').get())
@@ -130,7 +137,12 @@ class Twinkle(Pattern):
 
             currentTimes = self._current_time - self.ringTimes
             ringLife = self.parameter('audio-ring-lifetime').get()
-            for pixel in np.where(currentTimes < ringLife)[0]:
+            ring_pixels = np.where(currentTimes < ringLife)[0]
+            if self._ring_limit is not None and len(ring_pixels) > self._ring_limit:
+                # Keep the youngest rings
+                ages = currentTimes[ring_pixels]
+                ring_pixels = ring_pixels[np.argsort(ages)[:self._ring_limit]]
+            for pixel in ring_pixels:
                 if self.ringTimes[pixel] > 0:
                     #print pixel
                     ringWidth = self.parameter('audio-ring-width').get()
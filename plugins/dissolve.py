@@ -29,4 +29,5 @@ class Dissolve(Transition):
         return "Dissolve"
 
     def render(self, start, end, progress, out):
-        hls_blend(start, end, out, progress, 'add', 1.0, 1.0)
+        hls_blend(start, end, out, progress, 'add', 1.0, 1.0,
+                  scratch=self._scratch)
@@ -33,4 +33,5 @@ class LinearBlend(Transition):
         return "Linear Blend"
 
     def render(self, start, end, progress, out):
-        hls_blend(start, end, out, progress, 'add', 0.6, 1.0)
+        hls_blend(start, end, out, progress, 'add', 0.6, 1.0,
+                  scratch=self._scratch)
@@ -32,4 +32,5 @@ class MultiplyBlend(Transition):
         return "Multiply Blend"
 
     def render(self, start, end, progress, out):
-        hls_blend(start, end, out, progress, 'multiply', 0.5, 0.5)
+        hls_blend(start, end, out, progress, 'multiply', 0.5, 0.5,
+                  scratch=self._scratch)
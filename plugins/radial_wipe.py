@@ -19,7 +19,7 @@ import numpy as np
 import math
 
 from lib.transition import Transition
-from lib.buffer_utils import BufferUtils
+from lib.buffer_utils import BufferUtils, copy_buffer
 
 
 class RadialWipe(Transition):
@@ -42,5 +42,15 @@ class RadialWipe(Transition):
         self.distances /= max(self.distances)
 
     def render(self, start, end, progress, out):
-        np.copyto(out, np.where(self.distances < progress, end, start))
-        out['light'][np.abs(self.distances - progress) < 0.02] += 0.5 # we can apply effects to transition line here
+        mask = self._scratch.like('mask', self.distances, bool)
+        distance = self._scratch.like('distance', self.distances)
+
+        np.less(self.distances, progress, mask)
+        copy_buffer(out, start)
+        copy_buffer(out, end, where=mask)
+
+        # we can apply effects to transition line here
+        np.subtract(self.distances, progress, distance)
+        np.absolute(distance, distance)
+        np.less(distance, 0.02, mask)
+        np.add(out['light'], 0.5, out['light'], where=mask)
@@ -18,6 +18,7 @@
 import numpy as np
 import math
 
+from lib.buffer_utils import copy_buffer
 from lib.transition import Transition
 
 class Wipe(Transition):
@@ -47,5 +48,15 @@ class Wipe(Transition):
         self.dots /= maxDot - minDot
 
     def render(self, start, end, progress, out):
-        np.copyto(out, np.where(self.dots < progress, end, start))
-        out['sat'][np.abs(self.dots - progress) < 0.02] += 0.1 # we can apply effects to transition line here
+        mask = self._scratch.like('mask', self.dots, bool)
+        distance = self._scratch.like('distance', self.dots)
+
+        np.less(self.dots, progress, mask)
+        copy_buffer(out, start)
+        copy_buffer(out, end, where=mask)
+
+        # we can apply effects to transition line here
+        np.subtract(self.dots, progress, distance)
+        np.absolute(distance, distance)
+        np.less(distance, 0.02, mask)
+        np.add(out['sat'], 0.1, out['sat'], where=mask)
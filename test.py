@@ -1,13 +1,48 @@
 import unittest
 import string
+import asyncio
+import colorsys
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import types
+
+import numpy as np
 
 import core.mixer
 import core.networking
+import core.frame_scheduler
+import core.tick_profiler
+import core.quality_governor
+import core.audio
+import core.audio_events
+import core.udp_batch
+import core.output_service
+import core.opc_client
+import core.dmx
+import core.offline_renderer
+import core.output_pipeline
+import core.preset_workers
+import core.show_player
+
+import output_sink
+import plugins.radial_wipe
+import plugins.wipe
 
+import lib.parameters
 import lib.pattern
 import lib.color_fade
+import lib.buffer_utils
+import lib.colors
+import lib.color_lut
+import lib.color_modes
+import lib.dtypes
 import lib.playlist
 import lib.scene
+import lib.scratch_arena
 
 divider = '------'
 
@@ -84,8 +119,67 @@ class TestPlaylist(unittest.TestCase):
     #TODO test tabs and other whitespace handling
         #test_chars = set([i for i in string.whitespace])
 
-if __name__ == "__main__":
-    unittest.main()
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, t):
+        self.now += t
+
+
+class TestFrameScheduler(unittest.TestCase):
+    def setUp(self):
+        print(divider)
+        print('Starting test: ' + self.id().split('.')[-2] + ' ' + self.id().split('.')[-1])
+        print(divider)
+        self.fake = FakeClock()
+
+    def tearDown(self):
+        print(divider)
+        print('Ending test: ' + self.id().split('.')[-2] + ' ' + self.id().split('.')[-1])
+        print(divider)
+
+    def make_scheduler(self, **kwargs):
+        return core.frame_scheduler.FrameScheduler(10, spin_time=0.0, clock=self.fake.clock,
+                                                   sleep=self.fake.sleep, **kwargs)
+
+    def test_deadlines_do_not_drift(self):
+        sched = self.make_scheduler()
+        for i in range(100):
+            sched.wait()
+            self.fake.now += 0.03  # simulated render time
+        self.assertAlmostEqual(self.fake.now, 9.93)
+        self.assertEqual(sched.overruns, 0)
+
+    def test_measured_dt_is_returned(self):
+        sched = self.make_scheduler()
+        self.assertAlmostEqual(sched.wait(), 0.1)
+        self.fake.now += 0.25  # overrun
+        self.assertAlmostEqual(sched.wait(), 0.25)
+
+    def test_overrun_skips_missed_frames(self):
+        sched = self.make_scheduler(skip_frames=True)
+        sched.wait()
+        self.fake.now += 0.25
+        sched.wait()
+        self.assertEqual(sched.overruns, 1)
+        self.assertEqual(sched.skipped, 1)
+        # Back on the original frame grid
+        sched.wait()
+        self.assertAlmostEqual(self.fake.now, 0.3)
+
+    def test_overrun_catches_up(self):
+        sched = self.make_scheduler(skip_frames=False)
+        sched.wait()
+        self.fake.now += 0.25
+        sched.wait()
+        sched.wait()
+        sched.wait()
+        self.assertEqual(sched.skipped, 0)
+        self.assertAlmostEqual(self.fake.now, 0.3)
 
 
 def string_contains_characters(testString, set):
@@ -99,3 +193,1436 @@ def string_contains_characters(testString, set):
         if char in testString:
             return True
     return False
+
+
+class TestColors(unittest.TestCase):
+    def setUp(self):
+        print(divider)
+        print('Starting test: ' + self.id().split('.')[-2] + ' ' + self.id().split('.')[-1])
+        print(divider)
+
+    def tearDown(self):
+        print(divider)
+        print('Ending test: ' + self.id().split('.')[-2] + ' ' + self.id().split('.')[-1])
+        print(divider)
+
+    def random_hls(self, n=500):
+        buf = np.zeros(n, dtype=lib.dtypes.hls_color)
+        rng = np.random.RandomState(0)
+        buf['hue'] = rng.random_sample(n)
+        buf['light'] = rng.random_sample(n)
+        buf['sat'] = rng.random_sample(n)
+        return buf
+
+    def test_hls_to_rgb_matches_colorsys(self):
+        buf = self.random_hls()
+        rgb = lib.colors.hls_to_rgb(buf)
+        for hls, out in zip(buf, rgb):
+            expected = colorsys.hls_to_rgb(*hls)
+            for a, b in zip(expected, out):
+                self.assertAlmostEqual(a, b)
+
+    def test_hsvf32_matches_colorsys(self):
+        buf = self.random_hls()
+        buf['light'][:10] = 0.0
+        out = np.empty((len(buf), 3), dtype=np.float32)
+        lib.color_modes.hls_to_hsvf32(buf, out, lib.scratch_arena.ScratchArena())
+        for hls, hsv in zip(buf, out):
+            expected = colorsys.rgb_to_hsv(*colorsys.hls_to_rgb(*hls))
+            if expected[1] > 0:
+                self.assertAlmostEqual(expected[0], hsv[0], places=5)
+            self.assertAlmostEqual(expected[1], hsv[1], places=5)
+            self.assertAlmostEqual(expected[2], hsv[2], places=5)
+
+    def test_rgb_to_uint8_rounds(self):
+        rgb = np.zeros(2, dtype=lib.dtypes.rgb_color)
+        rgb[0] = (0.0, 1.0, 0.5)
+        rgb[1] = (127.6 / 255, 200.4 / 255, 1.0 / 510 - 1e-9)
+        out = np.empty((2, 3), dtype=np.uint8)
+        lib.colors.rgb_to_uint8(rgb, out)
+        np.testing.assert_array_equal(out, [[0, 255, 128], [128, 200, 0]])
+
+    def test_rgb_to_uint8_dithering_averages_out(self):
+        out = np.empty((3, 3), dtype=np.uint8)
+        residual = np.zeros((3, 3), dtype=np.float32)
+        scratch = lib.scratch_arena.ScratchArena()
+        total = np.zeros((3, 3))
+        for frame in range(100):
+            rgb = np.zeros(3, dtype=lib.dtypes.rgb_color)
+            rgb[0] = (10.25 / 255, 0.7 / 255, 0.0)
+            rgb[1] = (1.0, 254.5 / 255, 0.5)
+            rgb[2] = (3.9 / 255, 0.0, 1.0)
+            lib.colors.rgb_to_uint8(rgb, out, residual, scratch)
+            total += out
+        np.testing.assert_allclose(total / 100, [[10.25, 0.7, 0], [255, 254.5, 127.5],
+                                                 [3.9, 0, 255]], atol=0.01)
+
+    def test_perceptual_works_on_any_shape(self):
+        buf = np.zeros((4, 16), dtype=lib.dtypes.hls_color)
+        buf['hue'] = np.arange(16) / 16.0
+        buf['light'] = 0.4
+        buf['sat'] = 0.8
+        # Hues wrap around
+        buf['hue'][1] -= 1.0
+        buf['hue'][2] += 1.0
+        buf['hue'][3] += 3.0
+
+        rgb = lib.colors.hls_to_rgb_perceptual(buf)
+        self.assertEqual(rgb.shape, (4, 16))
+        for row in range(1, 4):
+            np.testing.assert_array_equal(rgb[row], rgb[0])
+
+        flat = lib.colors.hls_to_rgb_perceptual(buf.reshape(-1))
+        np.testing.assert_array_equal(flat, rgb.reshape(-1))
+
+    def test_perceptual_stays_in_range(self):
+        buf = self.random_hls(2000)
+        rgb = lib.buffer_utils.struct_flat(lib.colors.hls_to_rgb_perceptual(buf))
+        self.assertLessEqual(rgb.max(), 1.0)
+        self.assertGreaterEqual(rgb.min(), 0.0)
+
+    def test_color_lut_matches_conversion_on_grid(self):
+        lut = lib.color_lut.ColorLut(lib.colors.hls_to_rgb_perceptual, (16, 9, 5))
+        buf = np.zeros((16, 9, 5), dtype=lib.dtypes.hls_color)
+        buf['hue'] = (np.arange(16) / 16.0)[:, None, None]
+        buf['light'] = np.linspace(0, 1, 9)[None, :, None]
+        buf['sat'] = np.linspace(0, 1, 5)[None, None, :]
+        buf = buf.reshape(-1)
+        expected = np.empty((len(buf), 3), dtype=np.uint8)
+        lib.colors.rgb_to_uint8(lib.colors.hls_to_rgb_perceptual(buf), expected)
+
+        scratch = lib.scratch_arena.ScratchArena()
+        out = np.empty((len(buf), 3), dtype=np.uint8)
+        lut.lookup(buf, out, scratch)
+        np.testing.assert_array_equal(out, expected)
+        lut.lookup(buf, out, scratch, swizzle=True)
+        np.testing.assert_array_equal(out, expected[:, ::-1])
+
+        # Hues wrap, and out of range lights and sats are clamped
+        shifted = buf.copy()
+        shifted['hue'] -= 3.0
+        shifted['light'] = np.where(buf['light'] == 1.0, 1.5, buf['light'])
+        shifted['sat'] = np.where(buf['sat'] == 0.0, -0.5, buf['sat'])
+        lut.lookup(shifted, out, scratch)
+        np.testing.assert_array_equal(out, expected)
+
+        # The dimmer scales the light
+        dimmed = buf.copy()
+        dimmed['light'] *= 2
+        lut.lookup(dimmed, out, scratch, dimmer=0.5)
+        np.testing.assert_array_equal(out, expected)
+
+    def test_float32_buffers(self):
+        buf = self.random_hls()
+        end = self.random_hls()[::-1].copy()
+        expected = [lib.colors.hls_to_rgb(buf), lib.colors.hls_to_rgb_perceptual(buf),
+                    lib.colors.hls_blend(buf, end, None, 0.3, 'add')]
+        try:
+            lib.dtypes.set_float_type(np.float32)
+            buf32 = buf.astype(lib.dtypes.hls_color)
+            end32 = end.astype(lib.dtypes.hls_color)
+            scratch = lib.scratch_arena.ScratchArena()
+            results = [lib.colors.hls_to_rgb(buf32, scratch=scratch),
+                       lib.colors.hls_to_rgb_perceptual(buf32, scratch=scratch),
+                       lib.colors.hls_blend(buf32, end32, None, 0.3, 'add', scratch=scratch)]
+            for name, arr in scratch._arrays.items():
+                if arr.dtype.kind == 'f':
+                    self.assertEqual(arr.dtype, np.float32, name)
+        finally:
+            lib.dtypes.set_float_type(np.float64)
+
+        for result, reference in zip(results, expected):
+            self.assertEqual(lib.buffer_utils.struct_flat(result).dtype, np.float32)
+            np.testing.assert_allclose(lib.buffer_utils.struct_flat(result),
+                                       lib.buffer_utils.struct_flat(reference), atol=1e-5)
+
+    def test_rgb_to_hls_matches_colorsys(self):
+        rng = np.random.RandomState(0)
+        rgb = rng.randint(0, 256, (500, 3)).astype(np.uint8)
+        # Grays, and ties between the largest channels
+        rgb[:10] = rng.randint(0, 256, (10, 1))
+        rgb[10:14] = [(255, 255, 0), (255, 0, 255), (0, 255, 255), (0, 0, 0)]
+        hls = lib.colors.rgb_to_hls(rgb)
+        for pixel, out in zip(rgb, hls):
+            expected = colorsys.rgb_to_hls(*(pixel / 255.0))
+            for a, b in zip(expected, out):
+                self.assertAlmostEqual(a, b)
+
+    def test_rgb_to_hls_into_buffers(self):
+        rng = np.random.RandomState(0)
+        image = rng.randint(0, 256, (6, 8, 3)).astype(np.uint8)
+        expected = lib.colors.rgb_to_hls(image.reshape((-1, 3)))
+        self.assertEqual(lib.colors.rgb_to_hls(image).shape, (6, 8))
+        np.testing.assert_array_equal(lib.colors.rgb_to_hls(image).reshape(-1), expected)
+
+        scratch = lib.scratch_arena.ScratchArena()
+        out = np.empty(48, dtype=lib.dtypes.hls_color)
+        self.assertIs(lib.colors.rgb_to_hls(image.reshape((-1, 3)), out, scratch), out)
+        np.testing.assert_array_equal(out, expected)
+        planar = lib.buffer_utils.PlanarBuffer.zeros(48)
+        lib.colors.rgb_to_hls(image.reshape((-1, 3)), planar, scratch)
+        np.testing.assert_array_equal(planar.to_struct(), expected)
+
+    def test_out_buffers_are_reused(self):
+        buf = self.random_hls()
+        scratch = lib.scratch_arena.ScratchArena()
+        out = np.empty(buf.shape, dtype=lib.dtypes.rgb_color)
+
+        expected = lib.colors.hls_to_rgb_perceptual(buf)
+        self.assertIs(lib.colors.hls_to_rgb_perceptual(buf, out, scratch), out)
+        np.testing.assert_array_equal(out, expected)
+
+        arrays = dict(scratch._arrays)
+        lib.colors.hls_to_rgb_perceptual(buf, out, scratch)
+        for name, arr in scratch._arrays.items():
+            self.assertIs(arrays[name], arr)
+
+
+class TestPlanarBuffer(unittest.TestCase):
+    def setUp(self):
+        print(divider)
+        print('Starting test: ' + self.id().split('.')[-2] + ' ' + self.id().split('.')[-1])
+        print(divider)
+        rng = np.random.RandomState(0)
+        self.buf = np.zeros(300, dtype=lib.dtypes.hls_color)
+        lib.buffer_utils.struct_flat(self.buf)[:] = rng.random_sample(900)
+        self.planar = lib.buffer_utils.PlanarBuffer.from_struct(self.buf)
+
+    def tearDown(self):
+        print(divider)
+        print('Ending test: ' + self.id().split('.')[-2] + ' ' + self.id().split('.')[-1])
+        print(divider)
+
+    def test_matches_structured_buffer(self):
+        planar, buf = self.planar, self.buf
+        self.assertEqual(len(planar), 300)
+        self.assertTrue(planar['light'].flags['C_CONTIGUOUS'])
+        np.testing.assert_array_equal(planar['lightness'], buf['light'])
+
+        mask = buf['sat'] > 0.5
+        for target in (buf, planar):
+            target[3] = (0.1, 0.2, 0.3)
+            target[mask] = (0.0, 0.0, 0.0)
+            target[10:20]['hue'] += 1.0
+            target['sat'] *= 0.5
+        np.testing.assert_array_equal(planar.to_struct(), buf)
+        self.assertEqual(planar[3], tuple(buf[3]))
+
+        planar[:100] = buf[100:200]
+        np.testing.assert_array_equal(planar[:100].to_struct(), buf[100:200])
+        planar.fill(0)
+        self.assertEqual(lib.buffer_utils.struct_flat(planar).max(), 0.0)
+
+    def test_color_kernels_accept_planar_buffers(self):
+        end = self.buf[::-1].copy()
+        planar_end = lib.buffer_utils.PlanarBuffer.from_struct(end)
+        scratch = lib.scratch_arena.ScratchArena()
+        for convert in (lib.colors.hls_to_rgb, lib.colors.hls_to_rgb_perceptual):
+            np.testing.assert_array_equal(convert(self.planar, scratch=scratch),
+                                          convert(self.buf, scratch=scratch))
+
+        expected = lib.colors.hls_blend(self.buf, end, None, 0.3, 'add', scratch=scratch)
+        blended = lib.colors.hls_blend(self.planar, planar_end, None, 0.3, 'add', scratch=scratch)
+        self.assertIsInstance(blended, lib.buffer_utils.PlanarBuffer)
+        np.testing.assert_array_equal(blended.to_struct(), expected)
+
+        lut = lib.color_lut.ColorLut(lib.colors.hls_to_rgb_perceptual, (16, 9, 5))
+        out = np.empty((300, 3), dtype=np.uint8)
+        expected = lut.lookup(self.buf, out.copy(), scratch)
+        np.testing.assert_array_equal(lut.lookup(self.planar, out, scratch), expected)
+
+    def test_wipes_accept_planar_buffers(self):
+        end = self.buf[::-1].copy()
+        planar_end = lib.buffer_utils.PlanarBuffer.from_struct(end)
+        positions = np.random.RandomState(1).random_sample(300)
+        wipe = plugins.wipe.Wipe(None)
+        wipe.dots = positions
+        radial_wipe = plugins.radial_wipe.RadialWipe(None)
+        radial_wipe.distances = positions
+        for transition in (wipe, radial_wipe):
+            expected = np.empty_like(self.buf)
+            transition.render(self.buf, end, 0.4, expected)
+            for start, finish in ((self.planar, planar_end), (self.buf, planar_end)):
+                out = lib.buffer_utils.PlanarBuffer.zeros(300)
+                transition.render(start, finish, 0.4, out)
+                np.testing.assert_array_equal(out.to_struct(), expected)
+
+
+class TestTickProfiler(unittest.TestCase):
+    def setUp(self):
+        print(divider)
+        print('Starting test: ' + self.id().split('.')[-2] + ' ' + self.id().split('.')[-1])
+        print(divider)
+
+    def tearDown(self):
+        print(divider)
+        print('Ending test: ' + self.id().split('.')[-2] + ' ' + self.id().split('.')[-1])
+        print(divider)
+
+    def test_disabled_profiler_records_nothing(self):
+        profiler = core.tick_profiler.TickProfiler()
+        with profiler.span('preset-render', 'Test'):
+            pass
+        profiler.record('network-send', 'OPC', 0.001)
+        self.assertEqual(profiler.stats(), {})
+
+    def test_percentiles(self):
+        profiler = core.tick_profiler.TickProfiler(enabled=True, window=100)
+        # Only the most recent 100 samples (1..100 ms) are kept
+        for i in range(200):
+            profiler.record('preset-render', 'Test', (i - 99) / 1000.0)
+        stats = profiler.stats()['preset-render']['Test']
+        self.assertEqual(stats['count'], 100)
+        self.assertAlmostEqual(stats['p50'], 51.0)
+        self.assertAlmostEqual(stats['p95'], 95.0)
+        self.assertAlmostEqual(stats['p99'], 99.0)
+        self.assertAlmostEqual(stats['max'], 100.0)
+
+
+class TestQualityGovernor(unittest.TestCase):
+    def setUp(self):
+        print(divider)
+        print('Starting test: ' + self.id().split('.')[-2] + ' ' + self.id().split('.')[-1])
+        print(divider)
+
+    def tearDown(self):
+        print(divider)
+        print('Ending test: ' + self.id().split('.')[-2] + ' ' + self.id().split('.')[-1])
+        print(divider)
+
+    def test_degrades_and_restores(self):
+        governor = core.quality_governor.QualityGovernor(50.0, holdoff=10)
+        for i in range(200):
+            governor.update(0.05)
+        self.assertEqual(governor.level, governor.MAX_LEVEL)
+
+        for i in range(200):
+            governor.update(0.001)
+        self.assertEqual(governor.level, 0)
+
+    def test_holds_level_within_budget(self):
+        governor = core.quality_governor.QualityGovernor(50.0, holdoff=10)
+        for i in range(200):
+            governor.update(0.014)
+        self.assertEqual(governor.level, 0)
+
+
+class TestAudioEventQueue(unittest.TestCase):
+    def setUp(self):
+        print(divider)
+        print('Starting test: ' + self.id().split('.')[-2] + ' ' + self.id().split('.')[-1])
+        print(divider)
+
+    def tearDown(self):
+        print(divider)
+        print('Ending test: ' + self.id().split('.')[-2] + ' ' + self.id().split('.')[-1])
+        print(divider)
+
+    def test_drain_stops_at_frame_time(self):
+        queue = core.audio_events.AudioEventQueue()
+        queue.push(core.audio_events.ONSET, timestamp=1.0)
+        queue.push(core.audio_events.PITCH, (440.0, 0.9), timestamp=1.5)
+        queue.push(core.audio_events.ONSET, timestamp=2.5)
+
+        events = queue.drain(2.0, [])
+        self.assertEqual([e.time for e in events], [1.0, 1.5])
+        self.assertEqual(events[1].value, (440.0, 0.9))
+        self.assertEqual(len(queue), 1)
+
+        events = queue.drain(3.0, [])
+        self.assertEqual([e.kind for e in events], [core.audio_events.ONSET])
+        self.assertEqual(len(queue), 0)
+
+    def test_onsets_keep_detection_time(self):
+        app = types.SimpleNamespace(settings={'mixer': {'onset-holdoff': 0.1}})
+        audio = core.audio.Audio(types.SimpleNamespace(_app=app))
+        audio._sim_timer.stop()
+        for timestamp in (1.0, 1.05, 1.2):
+            audio.trigger_onset(timestamp)
+        before = time.perf_counter()
+        audio.trigger_onset()
+
+        events = audio.events.drain(time.perf_counter(), [])
+        self.assertEqual([e.kind for e in events], [core.audio_events.ONSET] * 3)
+        # The second onset is within the holdoff of the first
+        self.assertEqual([e.time for e in events[:2]], [1.0, 1.2])
+        self.assertGreaterEqual(events[2].time, before)
+
+
+class TestUdpBatch(unittest.TestCase):
+    def setUp(self):
+        print(divider)
+        print('Starting test: ' + self.id().split('.')[-2] + ' ' + self.id().split('.')[-1])
+        print(divider)
+        self.sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sink.bind(("127.0.0.1", 0))
+        self.sink.settimeout(1.0)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def tearDown(self):
+        self.sink.close()
+        self.sock.close()
+        print(divider)
+        print('Ending test: ' + self.id().split('.')[-2] + ' ' + self.id().split('.')[-1])
+        print(divider)
+
+    def check_batch(self, use_sendmmsg):
+        sender = core.udp_batch.UdpBatchSender(self.sock, use_sendmmsg)
+        packets = [np.array([ord('B')], dtype=np.int8),
+                   np.arange(12, dtype=np.int8),
+                   np.array([ord('E')], dtype=np.int8)]
+        batch = sender.prepare(packets, [self.sink.getsockname(), ("no-such-host.invalid", 1)])
+        self.assertEqual(len(batch), 3)
+
+        # Batches refer to the packets, so updates are picked up
+        packets[1][:] = 7
+        self.assertEqual(sender.send(batch), 3)
+        received = [self.sink.recv(1024) for i in range(3)]
+        self.assertEqual(received, [b'B', bytes([7] * 12), b'E'])
+
+    def test_send_each(self):
+        self.check_batch(False)
+
+    @unittest.skipUnless(core.udp_batch.sendmmsg_available(), "sendmmsg() not available")
+    def test_sendmmsg(self):
+        self.check_batch(True)
+
+
+class TestOutputService(unittest.TestCase):
+    def setUp(self):
+        print(divider)
+        print('Starting test: ' + self.id().split('.')[-2] + ' ' + self.id().split('.')[-1])
+        print(divider)
+        self.sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sink.bind(("127.0.0.1", 0))
+        self.sink.settimeout(2.0)
+        self.service = core.output_service.OutputService()
+        self.service.start()
+
+    def tearDown(self):
+        self.service.stop()
+        self.sink.close()
+        print(divider)
+        print('Ending test: ' + self.id().split('.')[-2] + ' ' + self.id().split('.')[-1])
+        print(divider)
+
+    def receive(self, count):
+        return [self.sink.recv(1024) for i in range(count)]
+
+    def test_full_and_partial_frames(self):
+        address = self.sink.getsockname()
+        framing = dict(header=(b'B',), footer=(b'E',))
+        self.service.send([address], [(1, b'one'), (0, b'zero')], **framing)
+        self.assertEqual(self.receive(4), [b'B', b'zero', b'one', b'E'])
+
+        self.service.send([address], [(1, b'uno')], full=False, **framing)
+        self.assertEqual(self.receive(3), [b'B', b'uno', b'E'])
+
+        stats = self.service.stats()["%s:%d" % address]
+        self.assertEqual(stats['errors'], 0)
+
+    def test_bad_host_does_not_block_others(self):
+        address = self.sink.getsockname()
+        self.service.send([("no-such-host.invalid", 1), address], [(0, b'data')])
+        self.assertEqual(self.receive(1), [b'data'])
+
+    def test_reopens_socket_lost_while_paused(self):
+        async def wait_for(condition):
+            for i in range(100):
+                if condition():
+                    return
+                await asyncio.sleep(0.01)
+
+        async def run():
+            channel = core.output_service._ClientChannel(self.sink.getsockname())
+            await wait_for(lambda: channel.transport is not None)
+            transport = channel.transport
+            # The frame waits for the paused socket, which is then lost
+            transport.get_protocol().pause_writing()
+            channel.submit([(0, b'data')], True)
+            await asyncio.sleep(0.05)
+            transport.close()
+            await wait_for(lambda: channel.stats['frames'] == 1)
+            self.assertIsNot(channel.transport, transport)
+
+            channel.transport.get_protocol().pause_writing()
+            channel.close()
+            await asyncio.wait([channel.task], timeout=1.0)
+            self.assertTrue(channel.task.done())
+
+        asyncio.run(run())
+        self.assertEqual(self.receive(1), [b'data'])
+
+
+class TestOpcClient(unittest.TestCase):
+    def setUp(self):
+        print(divider)
+        print('Starting test: ' + self.id().split('.')[-2] + ' ' + self.id().split('.')[-1])
+        print(divider)
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(1)
+        self.server.settimeout(2.0)
+
+    def tearDown(self):
+        self.server.close()
+        print(divider)
+        print('Ending test: ' + self.id().split('.')[-2] + ' ' + self.id().split('.')[-1])
+        print(divider)
+
+    def test_sends_frames(self):
+        client = core.opc_client.OpcClient(self.server.getsockname())
+        packet = np.array([0, 0, 0, 6, 1, 2, 3, 4, 5, 6], dtype=np.int8)
+        for i in range(100):
+            if client.send(packet):
+                break
+            time.sleep(0.01)
+        self.assertTrue(client.connected())
+
+        conn, peer = self.server.accept()
+        conn.settimeout(2.0)
+        received = b''
+        while len(received) < len(packet):
+            received += conn.recv(1024)
+        conn.close()
+        client.close()
+        self.assertEqual(received, packet.tobytes())
+
+    def test_backs_off_when_refused(self):
+        address = self.server.getsockname()
+        self.server.close()
+        now = [0.0]
+        client = core.opc_client.OpcClient(address, clock=lambda: now[0])
+        packet = np.zeros(4, dtype=np.int8)
+        for i in range(100):
+            client.send(packet)
+            if client.stats['errors'] > 0:
+                break
+            time.sleep(0.01)
+        self.assertEqual(client.stats['errors'], 1)
+
+        # No new attempt until the retry delay has passed
+        client.send(packet)
+        self.assertEqual(client.stats['errors'], 1)
+        now[0] = 10.0
+        for i in range(100):
+            client.send(packet)
+            if client.stats['errors'] > 1:
+                break
+            time.sleep(0.01)
+        self.assertEqual(client.stats['errors'], 2)
+
+    def test_host_lookup_does_not_block(self):
+        gate = threading.Event()
+        lookups = []
+
+        def gethostbyname(host):
+            lookups.append(host)
+            gate.wait(2.0)
+            if host == "unknown.invalid":
+                raise socket.gaierror("not found")
+            return "127.0.0.1"
+
+        original = core.opc_client.socket.gethostbyname
+        core.opc_client.socket.gethostbyname = gethostbyname
+        try:
+            now = [0.0]
+            clients = [core.opc_client.OpcClient((host, self.server.getsockname()[1]),
+                                                 clock=lambda: now[0])
+                       for host in ("opc.local", "unknown.invalid")]
+            packet = np.zeros(4, dtype=np.int8)
+            start = time.perf_counter()
+            for client in clients:
+                self.assertFalse(client.send(packet))
+                self.assertFalse(client.send(packet))
+            self.assertLess(time.perf_counter() - start, 0.5)
+            self.assertEqual(lookups, ["opc.local", "unknown.invalid"])
+
+            gate.set()
+            for i in range(100):
+                clients[0].send(packet)
+                clients[1].send(packet)
+                if clients[0].connected() and clients[1].stats['errors']:
+                    break
+                time.sleep(0.01)
+            self.assertTrue(clients[0].connected())
+            # A failed lookup waits for the retry delay like a failed connect
+            self.assertEqual(clients[1].stats['errors'], 1)
+            clients[1].send(packet)
+            self.assertEqual(len(lookups), 2)
+            now[0] = 10.0
+            clients[1].send(packet)
+            self.assertEqual(len(lookups), 3)
+            for client in clients:
+                client.close()
+        finally:
+            core.opc_client.socket.gethostbyname = original
+
+
+class TestDmxLayout(unittest.TestCase):
+    def setUp(self):
+        print(divider)
+        print('Starting test: ' + self.id().split('.')[-2] + ' ' + self.id().split('.')[-1])
+        print(divider)
+
+    def tearDown(self):
+        print(divider)
+        print('Ending test: ' + self.id().split('.')[-2] + ' ' + self.id().split('.')[-1])
+        print(divider)
+
+    def test_e131_packets(self):
+        frame = (np.arange(3 * 400) % 256).astype(np.uint8).view(np.int8)
+        layout = core.dmx.DmxLayout('E1.31', [(0, 400)], 7)
+        layout.fill(frame, 42)
+        self.assertEqual(layout.universes, [7, 8, 9])
+
+        packet = layout.packets[1].tobytes()
+        self.assertEqual(len(packet), 638)
+        self.assertEqual(packet[4:16], b'ASC-E1.17\x00\x00\x00')
+        self.assertEqual(packet[111], 42)
+        self.assertEqual(packet[113:115], b'\x00\x08')
+        self.assertEqual(packet[123:125], b'\x02\x01')
+        self.assertEqual(packet[125], 0)
+        self.assertEqual(packet[126:126 + 510], frame[510:1020].tobytes())
+
+        # The last universe is only partly used
+        packet = layout.packets[2].tobytes()
+        self.assertEqual(packet[126:126 + 180], frame[1020:1200].tobytes())
+        self.assertEqual(packet[126 + 180:], bytes(512 - 180))
+
+    def test_artnet_universe_per_run(self):
+        frame = np.ones(3 * 300, dtype=np.int8)
+        layout = core.dmx.DmxLayout('Art-Net', [(0, 100), (100, 300)], 0x123,
+                                    universe_pixels=100, universe_per_run=True)
+        layout.fill(frame, 3)
+        self.assertEqual(layout.universes, [0x123, 0x124, 0x125])
+
+        packet = layout.packets[0].tobytes()
+        self.assertEqual(len(packet), 530)
+        self.assertEqual(packet[:8], b'Art-Net\x00')
+        self.assertEqual(packet[8:12], b'\x00\x50\x00\x0e')
+        self.assertEqual(packet[12], 3)
+        self.assertEqual(packet[14:16], b'\x23\x01')
+        self.assertEqual(packet[16:18], b'\x02\x00')
+        self.assertEqual(packet[18:18 + 300], bytes([1] * 300))
+        self.assertEqual(packet[18 + 300:], bytes(512 - 300))
+
+
+class TestOutputSink(unittest.TestCase):
+    def setUp(self):
+        print(divider)
+        print('Starting test: ' + self.id().split('.')[-2] + ' ' + self.id().split('.')[-1])
+        print(divider)
+        self.sink = output_sink.OutputSink(port=0, opc_port=0, expected_strands=2)
+        self.sink.start_thread()
+
+    def tearDown(self):
+        self.sink.stop_thread()
+        print(divider)
+        print('Ending test: ' + self.id().split('.')[-2] + ' ' + self.id().split('.')[-1])
+        print(divider)
+
+    def wait_for(self, condition):
+        summary = {}
+        for i in range(100):
+            time.sleep(0.01)
+            for name, stats in self.sink.summary().items():
+                summary.setdefault(name, []).append(stats)
+            if condition(summary):
+                break
+        return summary
+
+    def test_counts_legacy_frames(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        datagrams = [b'B', b'S\x00\x03\x00abc', b'S\x01\x03\x00def', b'E',
+                     # Lost begin marker and strand 1
+                     b'S\x00\x03\x00ghi', b'E',
+                     b'B', b'S\x00\x03\x00jkl', b'D\x00\x00\x00\x01\x00x', b'E',
+                     b'S\x00\x09\x00short']
+        for datagram in datagrams:
+            sock.sendto(datagram, self.sink.legacy_address)
+            time.sleep(0.001)
+        sock.close()
+
+        summary = self.wait_for(lambda s: sum(x['packets'] for v in s.values() for x in v) >= 11)
+        self.assertEqual(len(summary), 1)
+        stats = list(summary.values())[0]
+        self.assertEqual(sum(s['frames'] for s in stats), 2)
+        self.assertEqual(sum(s['incomplete'] for s in stats), 1)
+        self.assertEqual(sum(s['malformed'] for s in stats), 1)
+        self.assertEqual(stats[-1]['strands'], 2)
+
+    def test_counts_opc_messages(self):
+        sock = socket.create_connection(self.sink.opc_address)
+        for i in range(3):
+            sock.sendall(b'\x01\x00\x00\x03abc\x02\x00\x00\x03def')
+        sock.close()
+
+        summary = self.wait_for(lambda s: sum(x['packets'] for v in s.values() for x in v) >= 6)
+        stats = list(summary.values())[0]
+        self.assertEqual(sum(s['frames'] for s in stats), 3)
+        self.assertEqual(sorted(set(c for s in stats for c in s['channels'])), [1, 2])
+
+
+class FakeFixture(object):
+    def __init__(self, strand, address, pixels):
+        self.strand = strand
+        self.address = address
+        self.pixels = pixels
+
+
+class FakeScene(object):
+    """
+    Three strands of one 10-pixel fixture each; strand 1 is sent as BGR8
+    """
+
+    def __init__(self):
+        self.fixtures = dict(((strand, 0), FakeFixture(strand, 0, 10)) for strand in range(3))
+        self.strand_settings = [{"id": strand, "enabled": True, "color-mode": "RGB8"}
+                                for strand in range(3)]
+        self.strand_settings[1]["color-mode"] = "BGR8"
+
+    def fixture_hierarchy(self):
+        hierarchy = {}
+        for (strand, address), fixture in self.fixtures.items():
+            hierarchy.setdefault(strand, {})[address] = fixture
+        return hierarchy
+
+    def fixture(self, strand, address):
+        return self.fixtures[(strand, address)]
+
+    def get_matrix_extents(self):
+        return 3, 10
+
+    def get_strand_settings(self):
+        return self.strand_settings
+
+
+class FakeMixer(object):
+    """
+    Outputs a different random frame every tick
+    """
+
+    def __init__(self):
+        self.profiler = core.tick_profiler.TickProfiler()
+        self.global_dimmer = 1.0
+        self.useColorCorrections = True
+        self.frames = 0
+        self._buffer = lib.buffer_utils.BufferUtils.create_buffer()
+
+    def start(self, threaded=True):
+        pass
+
+    def stop(self):
+        pass
+
+    def run_frame(self, dt):
+        rng = np.random.RandomState(self.frames)
+        lib.buffer_utils.struct_flat(self._buffer)[:] = rng.random_sample(3 * len(self._buffer))
+        self.frames += 1
+
+    def output_buffer(self):
+        return self._buffer
+
+
+class FakeApp(object):
+    def __init__(self, networking=None):
+        self.settings = {'networking': dict({'clients': []}, **(networking or {}))}
+        self.scene = FakeScene()
+        lib.buffer_utils.BufferUtils.set_app(self)
+        lib.buffer_utils.BufferUtils.init()
+        self.mixer = FakeMixer()
+        self.net = None
+
+
+def legacy_client(sock, **settings):
+    client = {"enabled": True, "host": "127.0.0.1", "port": sock.getsockname()[1],
+              "protocol": "Legacy", "color-mode": "RGB8"}
+    client.update(settings)
+    return client
+
+
+def receive_datagrams(sock):
+    """
+    Returns the datagrams waiting on the non-blocking socket `sock`
+    """
+    time.sleep(0.01)
+    datagrams = []
+    while True:
+        try:
+            datagrams.append(sock.recv(65536))
+        except BlockingIOError:
+            return datagrams
+
+
+def random_buffer(seed):
+    buf = lib.buffer_utils.BufferUtils.create_buffer()
+    rng = np.random.RandomState(seed)
+    lib.buffer_utils.struct_flat(buf)[:] = rng.random_sample(3 * len(buf))
+    return buf
+
+
+class TestOfflineRenderer(unittest.TestCase):
+    def setUp(self):
+        print(divider)
+        print('Starting test: ' + self.id().split('.')[-2] + ' ' + self.id().split('.')[-1])
+        print(divider)
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+        print(divider)
+        print('Ending test: ' + self.id().split('.')[-2] + ' ' + self.id().split('.')[-1])
+        print(divider)
+
+    def test_renders_frames_to_file(self):
+        mixer = FakeApp().mixer
+        expected = []
+        for i in range(4):
+            mixer.run_frame(1 / 60.0)
+            expected.append(mixer.output_buffer().copy())
+
+        for frame_format in core.offline_renderer.OfflineRenderer.FORMATS:
+            app = FakeApp()
+            path = os.path.join(self.tempdir, frame_format + '.npy')
+            renderer = core.offline_renderer.OfflineRenderer(app, 60.0, frame_format)
+            self.assertEqual(renderer.render(path, 4 / 60.0), 4)
+            frames = np.load(path)
+            for i, frame in enumerate(frames):
+                if frame_format == "hls":
+                    np.testing.assert_array_equal(frame, expected[i])
+                else:
+                    rgb8 = np.empty((30, 3), dtype=np.uint8)
+                    core.networking.hls_to_rgb8(expected[i], rgb8,
+                                                lib.colors.hls_to_rgb_perceptual)
+                    np.testing.assert_array_equal(frame, rgb8)
+            self.assertEqual(frames.shape, (4,) + renderer.frame_shape())
+            self.assertEqual(frames.dtype, renderer.frame_dtype())
+
+        # Other extensions are raw frame data
+        path = os.path.join(self.tempdir, 'show.rgb')
+        core.offline_renderer.OfflineRenderer(FakeApp(), 60.0).render(path, 4 / 60.0)
+        np.testing.assert_array_equal(np.fromfile(path, dtype=np.uint8).reshape(frames.shape),
+                                      frames)
+
+    def test_rgb8_frames_match_network_output(self):
+        for networking in ({}, {'gamma': 2.2}, {'color-lut': [16, 32, 8], 'gamma': 2.2}):
+            app = FakeApp(networking)
+            path = os.path.join(self.tempdir, 'show.npy')
+            renderer = core.offline_renderer.OfflineRenderer(app, 60.0)
+            renderer.render(path, 3 / 60.0)
+            frames = np.load(path)
+
+            net = core.networking.Networking(app)
+            plan = net._get_plan()
+            lut = None
+            if plan.color_lut is not None:
+                lut = net._color_lut('perceptual', plan)
+            mixer = FakeMixer()
+            for expected in frames:
+                mixer.run_frame(1 / 60.0)
+                frame, sent = net._encode("RGB8", False, mixer.output_buffer(), plan, None,
+                                          lib.colors.hls_to_rgb_perceptual, lut=lut)
+                # The render keeps every strand in RGB order
+                live = frame.view(np.uint8).reshape((-1, 3)).copy()
+                live[10:20] = live[10:20, ::-1]
+                np.testing.assert_array_equal(expected, live)
+            net.socket.close()
+
+
+class TestDirtyTracking(unittest.TestCase):
+    def setUp(self):
+        print(divider)
+        print('Starting test: ' + self.id().split('.')[-2] + ' ' + self.id().split('.')[-1])
+        print(divider)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.setblocking(False)
+        self.app = FakeApp({'clients': [legacy_client(self.sock)]})
+        self.net = core.networking.Networking(self.app)
+        self.cwd = os.getcwd()
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tempdir)
+        self.net.socket.close()
+        self.sock.close()
+        print(divider)
+        print('Ending test: ' + self.id().split('.')[-2] + ' ' + self.id().split('.')[-1])
+        print(divider)
+
+    def write(self, buf, dirty=None):
+        """
+        Writes a frame and returns the strand packets received, by strand
+        """
+        if dirty is not None:
+            dirty = np.array(dirty)
+        self.net.write_buffer(buf, dirty)
+        datagrams = receive_datagrams(self.sock)
+        if not datagrams:
+            return {}
+        self.assertEqual((datagrams[0], datagrams[-1]), (b'B', b'E'))
+        return dict((ord(d[1:2]), d[4:]) for d in datagrams[1:-1])
+
+    def test_partial_update_rewrites_marked_strands(self):
+        first = self.write(random_buffer(0))
+        self.assertEqual(sorted(first), [0, 1, 2])
+
+        buf = random_buffer(1)
+        sent = self.write(buf, [False, True, False])
+        self.assertEqual(list(sent), [1])
+        expected = np.empty((10, 3), dtype=np.uint8)
+        core.networking.hls_to_rgb8(buf[10:20], expected, lib.colors.hls_to_rgb_perceptual)
+        self.assertEqual(sent[1], expected[:, ::-1].tobytes())
+
+        # The strands that weren't marked are sent as they were
+        frame = self.net._frames[("RGB8", True)].tobytes()
+        self.assertEqual(frame[:30], first[0])
+        self.assertEqual(frame[60:], first[2])
+
+    def test_keyframe_sends_every_strand(self):
+        self.write(random_buffer(0))
+        for i in range(core.networking.Networking.KEYFRAME_INTERVAL - 1):
+            self.assertEqual(self.write(random_buffer(i), [False, i % 2 == 0, False]),
+                             {1: self.net._frames[("RGB8", True)].tobytes()[30:60]}
+                             if i % 2 == 0 else {})
+        buf = random_buffer(100)
+        sent = self.write(buf, [False, False, False])
+        self.assertEqual(sorted(sent), [0, 1, 2])
+        self.assertEqual(b''.join(sent[strand] for strand in range(3)),
+                         self.net._frames[("RGB8", True)].tobytes())
+
+    def test_dropped_frames_merge_dirty_masks(self):
+        received = []
+        pipeline = core.output_pipeline.OutputPipeline(
+            lambda frame, dirty: received.append((frame.copy(), dirty.copy())), depth=2)
+        frames = [random_buffer(i) for i in range(4)]
+        masks = [[True, False, False], [False, True, False], [False, False, False],
+                 [False, False, True]]
+        # Nothing is sent yet, so the first two frames are dropped
+        for frame, mask in zip(frames, masks):
+            pipeline.submit(frame, np.array(mask))
+        self.assertEqual(pipeline.dropped, 2)
+
+        pipeline.start()
+        for i in range(100):
+            if pipeline.sent == 2:
+                break
+            time.sleep(0.01)
+        pipeline.stop()
+
+        self.assertEqual(len(received), 2)
+        np.testing.assert_array_equal(received[0][0], frames[2])
+        self.assertEqual(list(received[0][1]), [True, True, False])
+        np.testing.assert_array_equal(received[1][0], frames[3])
+        self.assertEqual(list(received[1][1]), [False, False, True])
+
+    def test_patterns_without_dirty_tracking_send_whole_frames(self):
+        os.chdir(self.tempdir)
+        os.makedirs(os.path.join("data", "presets"))
+
+        class Untracked(lib.pattern.Pattern):
+            pass
+
+        class Tracked(lib.pattern.Pattern):
+            dirty_tracking = True
+
+        mixer = types.SimpleNamespace(_preset_pool=None, _dirty_tracking=True,
+                                      _in_transition=False, _last_rendered_preset=None)
+        untracked = Untracked(self.app, "untracked")
+        for i in range(3):
+            untracked.mark_dirty(np.array([12, 13]))
+            self.assertIsNone(core.mixer.Mixer._take_dirty_strands(mixer, untracked))
+
+        tracked = Tracked(self.app, "tracked")
+        tracked.mark_dirty(np.array([12, 13]))
+        # The first frame of a preset is always sent in full
+        self.assertIsNone(core.mixer.Mixer._take_dirty_strands(mixer, tracked))
+        tracked.mark_dirty(np.array([12, 13]))
+        self.assertEqual(list(core.mixer.Mixer._take_dirty_strands(mixer, tracked)),
+                         [False, True, False])
+        self.assertEqual(list(core.mixer.Mixer._take_dirty_strands(mixer, tracked)),
+                         [False, False, False])
+
+class TestDedup(unittest.TestCase):
+    def setUp(self):
+        print(divider)
+        print('Starting test: ' + self.id().split('.')[-2] + ' ' + self.id().split('.')[-1])
+        print(divider)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.setblocking(False)
+
+    def tearDown(self):
+        self.net.socket.close()
+        self.sock.close()
+        print(divider)
+        print('Ending test: ' + self.id().split('.')[-2] + ' ' + self.id().split('.')[-1])
+        print(divider)
+
+    def start(self, **client_settings):
+        app = FakeApp({'dedup': True, 'clients': [legacy_client(self.sock, **client_settings)]})
+        self.net = core.networking.Networking(app)
+
+    def write(self, buf):
+        self.net.write_buffer(buf)
+        return receive_datagrams(self.sock)
+
+    def test_delta_packet_layout(self):
+        self.start(delta=True)
+        buf = random_buffer(0)
+        self.assertEqual(len(self.write(buf)), 5)
+
+        buf[23] = (0.5, 0.5, 1.0)
+        buf[25] = (0.0, 0.25, 1.0)
+        datagrams = self.write(buf)
+        self.assertEqual(len(datagrams), 3)
+        self.assertEqual((datagrams[0], datagrams[2]), (b'B', b'E'))
+        expected = np.empty((3, 3), dtype=np.uint8)
+        core.networking.hls_to_rgb8(buf[23:26], expected, lib.colors.hls_to_rgb_perceptual)
+        # Strand 2, from pixel 3, 9 bytes (including the unchanged pixel 24)
+        self.assertEqual(datagrams[1], b'D\x02\x03\x00\x09\x00' + expected.tobytes())
+
+    def test_unchanged_strands_are_not_sent(self):
+        self.start()
+        buf = random_buffer(0)
+        self.assertEqual(len(self.write(buf)), 5)
+        self.assertEqual(self.write(buf), [])
+
+        buf[5] = (0.5, 0.5, 1.0)
+        datagrams = self.write(buf)
+        self.assertEqual(len(datagrams), 3)
+        self.assertEqual(datagrams[1][:2], b'S\x00')
+
+    def test_full_frame_every_keyframe_interval(self):
+        for settings in ({}, {'delta': True}):
+            self.start(**settings)
+            buf = random_buffer(0)
+            self.assertEqual(len(self.write(buf)), 5)
+            for i in range(core.networking.Networking.KEYFRAME_INTERVAL - 1):
+                self.assertEqual(self.write(buf), [])
+            datagrams = self.write(buf)
+            self.assertEqual([d[:2] for d in datagrams[1:-1]], [b'S\x00', b'S\x01', b'S\x02'])
+            self.net.socket.close()
+
+
+def reference_packets(rgb8, strand_settings):
+    """
+    The Legacy packets and OPC message of a frame, built the way
+    Networking.write_buffer did before output plans
+    """
+    packets = [b'B']
+    for strand in range(len(strand_settings)):
+        if not strand_settings[strand]["enabled"]:
+            continue
+        start, end = lib.buffer_utils.BufferUtils.get_strand_extents(strand)
+        length = 3 * (end - start)
+        packets.append(bytes([ord('S'), strand, length & 0x00FF, (length & 0xFF00) >> 8])
+                       + rgb8[3 * start:3 * end])
+    packets.append(b'E')
+    opc = bytes([0, 0, (len(rgb8) & 0xFF00) >> 8, len(rgb8) & 0xFF]) + rgb8
+    return packets, opc
+
+
+class TestOutputPlan(unittest.TestCase):
+    def setUp(self):
+        print(divider)
+        print('Starting test: ' + self.id().split('.')[-2] + ' ' + self.id().split('.')[-1])
+        print(divider)
+        self.legacy_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.opc_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for sock in (self.legacy_sock, self.opc_sock):
+            sock.bind(('127.0.0.1', 0))
+            sock.setblocking(False)
+        self.app = FakeApp({'clients': [
+            legacy_client(self.legacy_sock),
+            legacy_client(self.opc_sock, protocol="OPC-UDP")]})
+        self.strand_settings = self.app.scene.strand_settings
+        self.strand_settings[1]["color-mode"] = "RGB8"
+        self.net = core.networking.Networking(self.app)
+
+    def tearDown(self):
+        self.net.socket.close()
+        self.legacy_sock.close()
+        self.opc_sock.close()
+        print(divider)
+        print('Ending test: ' + self.id().split('.')[-2] + ' ' + self.id().split('.')[-1])
+        print(divider)
+
+    def write(self, buf):
+        self.net.write_buffer(buf)
+        return receive_datagrams(self.legacy_sock), receive_datagrams(self.opc_sock)
+
+    def expected(self, buf):
+        rgb8 = np.empty((len(buf), 3), dtype=np.uint8)
+        core.networking.hls_to_rgb8(buf, rgb8, lib.colors.hls_to_rgb_perceptual)
+        return reference_packets(rgb8.tobytes(), self.strand_settings)
+
+    def test_packets_match_unplanned_encoding(self):
+        self.strand_settings[2]["enabled"] = False
+        for seed in range(3):
+            buf = random_buffer(seed)
+            packets, opc = self.expected(buf)
+            self.assertEqual(self.write(buf), (packets, [opc]))
+        # The first packet header, as it has always been sent
+        self.assertEqual(packets[1][:4], b'S\x00\x1e\x00')
+
+    def test_invalidate_plan_rebuilds_plan(self):
+        buf = random_buffer(0)
+        plan = self.net._get_plan()
+        self.write(buf)
+        self.assertIs(self.net._get_plan(), plan)
+
+        # Changes only take effect once the plan is invalidated
+        self.strand_settings[0]["enabled"] = False
+        self.app.settings['networking']['clients'][1]["enabled"] = False
+        self.assertEqual(len(self.write(buf)[0]), 5)
+        self.net.invalidate_plan()
+        self.assertIsNot(self.net._get_plan(), plan)
+
+        legacy, opc = self.write(buf)
+        self.assertEqual(legacy, self.expected(buf)[0])
+        self.assertEqual(opc, [])
+
+
+class TestOpcLayout(unittest.TestCase):
+    def setUp(self):
+        print(divider)
+        print('Starting test: ' + self.id().split('.')[-2] + ' ' + self.id().split('.')[-1])
+        print(divider)
+        self.app = FakeApp()
+        self.extents = [lib.buffer_utils.BufferUtils.get_strand_extents(s) for s in range(3)]
+        self.frame = np.arange(90, dtype=np.int8)
+
+    def tearDown(self):
+        print(divider)
+        print('Ending test: ' + self.id().split('.')[-2] + ' ' + self.id().split('.')[-1])
+        print(divider)
+
+    def layout(self, opc_map, enabled=(0, 1, 2)):
+        client = {"host": "127.0.0.1", "port": 7890, "protocol": "OPC"}
+        if opc_map is not None:
+            client["opc-map"] = opc_map
+        layout = core.networking.OpcLayout(
+            core.networking._opc_messages(client, self.extents, list(enabled)))
+        layout.fill(self.frame)
+        return [message.tobytes() for message in layout.messages]
+
+    def test_strand_channels(self):
+        self.assertEqual(self.layout(None), [b'\x00\x00\x00\x5a' + self.frame.tobytes()])
+        self.assertEqual(self.layout("strands", enabled=(0, 2)),
+                         [b'\x01\x00\x00\x1e' + self.frame[:30].tobytes(),
+                          b'\x03\x00\x00\x1e' + self.frame[60:].tobytes()])
+
+    def test_pixel_ranges(self):
+        messages = self.layout([{"channel": 1, "strands": [2, 0]},
+                                {"channel": 2, "pixels": [5, 15]},
+                                {"channel": 3, "pixels": [25, 40]}])
+        self.assertEqual(messages, [
+            b'\x01\x00\x00\x3c' + self.frame[60:].tobytes() + self.frame[:30].tobytes(),
+            b'\x02\x00\x00\x1e' + self.frame[15:45].tobytes(),
+            # Clipped to the end of the buffer
+            b'\x03\x00\x00\x0f' + self.frame[75:].tobytes()])
+
+    def test_truncated_at_max_pixels(self):
+        limit = core.networking.OpcLayout.MAX_PIXELS
+        with self.assertLogs('firemix.core.networking', 'WARNING'):
+            layout = core.networking.OpcLayout([(1, [(0, limit - 10), (limit, limit + 20)]),
+                                                (2, [(0, 10)])])
+        self.assertEqual(layout.messages[0][:4].view(np.uint8).tolist(), [1, 0, 0xFF, 0xFF])
+        self.assertEqual(len(layout.messages[0]), 4 + 3 * limit)
+        self.assertEqual([(start, end) for dst, start, end in layout.copies],
+                         [(0, 3 * (limit - 10)), (3 * limit, 3 * (limit + 10)), (0, 30)])
+
+
+class TestOutputPipeline(unittest.TestCase):
+    def setUp(self):
+        print(divider)
+        print('Starting test: ' + self.id().split('.')[-2] + ' ' + self.id().split('.')[-1])
+        print(divider)
+        FakeApp()
+        self.received = []
+        self.started = threading.Event()
+        self.gate = threading.Event()
+        self.pipeline = core.output_pipeline.OutputPipeline(self.sink, depth=3)
+
+    def tearDown(self):
+        self.gate.set()
+        self.pipeline.stop()
+        print(divider)
+        print('Ending test: ' + self.id().split('.')[-2] + ' ' + self.id().split('.')[-1])
+        print(divider)
+
+    def sink(self, frame, dirty):
+        # Holds up the first frame until the test opens the gate
+        self.started.set()
+        self.gate.wait()
+        self.received.append((frame['hue'][0], dirty))
+
+    def submit(self, i, dirty=None):
+        buf = lib.buffer_utils.BufferUtils.create_buffer()
+        buf['hue'] = i
+        self.pipeline.submit(buf, None if dirty is None else np.array(dirty))
+
+    def wait_for_sent(self, count):
+        for i in range(100):
+            if self.pipeline.sent >= count:
+                break
+            time.sleep(0.01)
+
+    def test_frames_are_sent_in_order(self):
+        self.pipeline.start()
+        self.submit(0)
+        self.started.wait()
+        self.submit(1)
+        self.submit(2)
+        self.gate.set()
+        self.wait_for_sent(3)
+        self.assertEqual([hue for hue, dirty in self.received], [0, 1, 2])
+        self.assertEqual(self.pipeline.dropped, 0)
+
+    def test_oldest_waiting_frame_is_dropped(self):
+        self.pipeline.start()
+        self.submit(0)
+        self.started.wait()
+        masks = [[True, False, False], [False, True, False], [False, False, False],
+                 [False, False, True]]
+        for i, mask in enumerate(masks):
+            self.submit(i + 1, mask)
+        self.assertEqual(self.pipeline.dropped, 2)
+
+        self.gate.set()
+        self.wait_for_sent(3)
+        self.assertEqual([hue for hue, dirty in self.received], [0, 3, 4])
+        self.assertIsNone(self.received[0][1])
+        self.assertEqual(self.received[1][1].tolist(), [True, True, False])
+        self.assertEqual(self.received[2][1].tolist(), [False, False, True])
+        # Masks are kept in the ring rather than copied for every frame
+        for hue, dirty in self.received[1:]:
+            self.assertTrue(any(dirty is mask for mask in self.pipeline._masks))
+
+    def test_stop_waits_for_frame_in_progress(self):
+        self.pipeline.start()
+        self.submit(0)
+        self.started.wait()
+        self.submit(1)
+
+        stopper = threading.Thread(target=self.pipeline.stop)
+        stopper.start()
+        while self.pipeline.running:
+            time.sleep(0.001)
+        self.assertTrue(stopper.is_alive())
+        self.gate.set()
+        stopper.join(1.0)
+
+        self.assertFalse(stopper.is_alive())
+        # The frame in progress is finished; the waiting one is not sent
+        self.assertEqual([hue for hue, dirty in self.received], [0])
+        self.assertIsNone(self.pipeline._thread)
+
+
+class RampPattern(lib.pattern.Pattern):
+    """
+    A hue ramp that moves at the 'speed' parameter, rewriting strand 1 only
+    """
+
+    dirty_tracking = True
+
+    def setup(self):
+        self.add_parameter(lib.parameters.FloatParameter('speed', 1.0))
+
+    def reset(self):
+        self.offset = 0.0
+
+    def tick(self, dt):
+        lib.pattern.Pattern.tick(self, dt)
+        self.offset += dt * self.parameter('speed').get()
+
+    def render(self, out):
+        out['hue'][10:20] = np.linspace(0.0, 1.0, 10) + self.offset
+        out['light'][10:20] = 0.5
+        out['sat'][10:20] = 1.0
+        self.mark_dirty(np.arange(10, 20))
+
+
+class TestPresetWorkerPool(unittest.TestCase):
+    def setUp(self):
+        print(divider)
+        print('Starting test: ' + self.id().split('.')[-2] + ' ' + self.id().split('.')[-1])
+        print(divider)
+        self.cwd = os.getcwd()
+        self.tempdir = tempfile.mkdtemp()
+        os.chdir(self.tempdir)
+        os.makedirs(os.path.join("data", "presets"))
+        self.app = FakeApp()
+        self.app.mixer.audio = types.SimpleNamespace(
+            fft=[np.zeros(4)], smoothed=0.0, gain=1.0, smoothEnergy=0.0, fader=0.0,
+            pitch=0.0, pitch_confidence=0.0)
+        self.pool = core.preset_workers.PresetWorkerPool(self.app.mixer)
+
+    def tearDown(self):
+        self.pool.stop()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tempdir)
+        print(divider)
+        print('Ending test: ' + self.id().split('.')[-2] + ' ' + self.id().split('.')[-1])
+        print(divider)
+
+    @unittest.skipUnless(core.preset_workers.fork_available(), "needs fork()")
+    def test_matches_in_process_rendering(self):
+        local = RampPattern(self.app, "local")
+        pooled = RampPattern(self.app, "pooled")
+        expected = lib.buffer_utils.BufferUtils.create_buffer()
+        for frame in range(5):
+            if frame == 3:
+                # Parameter changes are forwarded to the worker
+                for preset in (local, pooled):
+                    preset.parameter('speed').set(-2.5)
+            local.tick(0.1)
+            local.render(expected)
+            dirty = local.take_dirty_strands()
+
+            [(buf, error)] = self.pool.render([pooled], 0.1, frame * 0.1, [])
+            self.assertIsNone(error)
+            np.testing.assert_array_equal(buf, expected)
+            if dirty is None:
+                self.assertIsNone(self.pool.dirty_strands(pooled))
+            else:
+                self.assertEqual(self.pool.dirty_strands(pooled).tolist(), dirty.tolist())
+        self.assertEqual(self.pool.dirty_strands(pooled).tolist(), [False, True, False])
+
+    @unittest.skipUnless(core.preset_workers.fork_available(), "needs fork()")
+    def test_dead_worker_is_replaced(self):
+        preset = RampPattern(self.app, "ramp")
+        [(buf, error)] = self.pool.render([preset], 0.1, 0.0, [])
+        self.assertIsNone(error)
+        process = self.pool.worker(preset)._process
+        process.kill()
+        process.join()
+
+        for frame in range(2):
+            [(buf, error)] = self.pool.render([preset], 0.1, 0.1, [])
+            self.assertIn("exited unexpectedly", error)
+            # The next frame goes to a new worker
+            [(buf, error)] = self.pool.render([preset], 0.1, 0.2, [])
+            self.assertIsNone(error)
+            self.assertIsNot(self.pool.worker(preset)._process, process)
+            self.assertTrue(self.pool.worker(preset)._process.is_alive())
+            process = self.pool.worker(preset)._process
+            process.kill()
+            process.join()
+
+    @unittest.skipUnless(core.preset_workers.fork_available(), "needs fork()")
+    def test_stop_ends_workers(self):
+        presets = [RampPattern(self.app, "first"), RampPattern(self.app, "second")]
+        self.pool.render(presets, 0.1, 0.0, [])
+        workers = [self.pool.worker(preset) for preset in presets]
+        processes = [worker._process for worker in workers]
+        names = [worker._shm.name for worker in workers]
+
+        # Presets that stop playing lose their worker
+        self.pool.render(presets[1:], 0.1, 0.1, [])
+        self.assertFalse(processes[0].is_alive())
+
+        self.pool.stop()
+        for process, name in zip(processes, names):
+            self.assertFalse(process.is_alive())
+            self.assertEqual(process.exitcode, 0)
+            self.assertRaises(FileNotFoundError, core.preset_workers.shared_memory.SharedMemory,
+                              name)
+
+
+class FadeTransition(object):
+    """
+    Mixes the flat HLS values of two frames
+    """
+
+    resets = 0
+
+    def reset(self):
+        self.resets += 1
+
+    def render(self, start, end, progress, out):
+        flat = lib.buffer_utils.struct_flat
+        np.add(flat(start) * (1.0 - progress), flat(end) * progress, flat(out))
+
+
+class TestShowPlayer(unittest.TestCase):
+    def setUp(self):
+        print(divider)
+        print('Starting test: ' + self.id().split('.')[-2] + ' ' + self.id().split('.')[-1])
+        print(divider)
+        self.tempdir = tempfile.mkdtemp()
+        self.sent = []
+        self.app = FakeApp()
+        self.app.net = types.SimpleNamespace(
+            write_rgb8=lambda frame: self.sent.append(frame.view(np.uint8).reshape((-1, 3)).copy()))
+        self.segments = []
+        for i in range(2):
+            path = os.path.join(self.tempdir, '%d.npy' % i)
+            frames = np.random.RandomState(i).randint(0, 256, (20, 30, 3)).astype(np.uint8)
+            np.save(path, frames)
+            self.segments.append((path, frames))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+        print(divider)
+        print('Ending test: ' + self.id().split('.')[-2] + ' ' + self.id().split('.')[-1])
+        print(divider)
+
+    def player(self, **kwargs):
+        return core.show_player.ShowPlayer(self.app, [path for path, frames in self.segments],
+                                           10.0, **kwargs)
+
+    def test_seek_to_exact_frame(self):
+        player = self.player()
+        # (seconds, segment to seek in, segment played, frame played)
+        for seconds, segment, playing, frame in ((0.5, None, 0, 5), (0.26, None, 0, 3),
+                                                 (1.2, 1, 1, 12), (0.0, None, 1, 0),
+                                                 (5.0, 0, 0, 19)):
+            player.seek(seconds, segment)
+            self.assertTrue(player.step())
+            np.testing.assert_array_equal(self.sent[-1], self.segments[playing][1][frame])
+        self.assertRaises(ValueError, player.seek, 0.0, 2)
+
+    def test_crossfade_endpoints(self):
+        first, second = self.segments[0][1], self.segments[1][1]
+        for gamma in (1.0, 2.2):
+            self.app.settings['networking']['gamma'] = gamma
+            player = self.player(crossfade=0.5, transition=FadeTransition())
+            player.seek(1.4)
+            del self.sent[:]
+            while player.step():
+                pass
+            # Frames 15-19 of the first segment fade into frames 0-4 of the
+            # second, starting from progress 0
+            self.assertEqual(len(self.sent), 1 + 5 + 15)
+            np.testing.assert_array_equal(self.sent[0], first[14])
+            np.testing.assert_array_equal(self.sent[1], first[15])
+            np.testing.assert_array_equal(self.sent[6], second[5])
+
+            # Progress 1 is the second segment's frame
+            player._write_crossfade(first[19], second[4], 1.0)
+            np.testing.assert_array_equal(self.sent[-1], second[4])
+
+    def test_crossfade_longer_than_segment(self):
+        short = np.random.RandomState(2).randint(0, 256, (6, 30, 3)).astype(np.uint8)
+        np.save(os.path.join(self.tempdir, 'short.npy'), short)
+        self.segments.insert(1, (os.path.join(self.tempdir, 'short.npy'), short))
+
+        transition = FadeTransition()
+        with self.assertLogs('firemix.core.show_player', 'WARNING'):
+            player = self.player(crossfade=2.0, transition=transition)
+        while player.step():
+            pass
+        # Shortened to 3 frames, so the short segment fades in and then
+        # straight out again
+        self.assertEqual(len(self.sent), 17 + 3 + 3 + 17)
+        self.assertEqual(transition.resets, 2)
+        np.testing.assert_array_equal(self.sent[17], self.segments[0][1][17])
+        np.testing.assert_array_equal(self.sent[-1], self.segments[2][1][19])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,147 @@
+# This file is part of Firemix.
+#
+# Copyright 2013-2020 Jonathan Evans <jon@craftyjon.com>
+#
+# Firemix is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Firemix is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Firemix.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Measures Legacy-protocol packet throughput to local UDP sinks, sending each
+frame one datagram at a time with sendto() and then as a single sendmmsg()
+batch.
+
+    python udp_benchmark.py --strands 20 --clients 3 --frames 2000
+"""
+
+import argparse
+import multiprocessing
+import socket
+import time
+
+import numpy as np
+
+from core.udp_batch import UdpBatchSender, sendmmsg_available
+
+
+class UdpSink(object):
+    """
+    Counts the datagrams arriving on a local port.  The sink runs in its own
+    process so that receiving doesn't compete with the sender for the GIL.
+    """
+
+    def __init__(self, port):
+        self._received = multiprocessing.Value('l', 0)
+        self._running = multiprocessing.Event()
+        self._running.set()
+        ready = multiprocessing.Event()
+        self._process = multiprocessing.Process(target=self._receive_loop,
+                                                args=(port, ready))
+        self._process.start()
+        ready.wait()
+
+    def _receive_loop(self, port, ready):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+        sock.bind(("127.0.0.1", port))
+        sock.settimeout(0.2)
+        ready.set()
+        while self._running.is_set():
+            try:
+                sock.recv(65536)
+            except socket.timeout:
+                continue
+            with self._received.get_lock():
+                self._received.value += 1
+        sock.close()
+
+    @property
+    def received(self):
+        return self._received.value
+
+    def reset(self):
+        with self._received.get_lock():
+            self._received.value = 0
+
+    def stop(self):
+        self._running.clear()
+        self._process.join()
+
+
+def legacy_frame(strands, pixels):
+    """
+    Returns the datagrams of one Legacy frame: begin marker, one packet per
+    strand and end marker
+    """
+    packets = [np.array([ord('B')], dtype=np.int8)]
+    for strand in range(strands):
+        packet = np.zeros(4 + 3 * pixels, dtype=np.int8)
+        packet[0] = ord('S')
+        packet[1] = strand
+        packet[2] = (3 * pixels) & 0xFF
+        packet[3] = ((3 * pixels) & 0xFF00) >> 8
+        packets.append(packet)
+    packets.append(np.array([ord('E')], dtype=np.int8))
+    return packets
+
+
+def run(name, sender, batch, frames, sinks):
+    for sink in sinks:
+        sink.reset()
+    start = time.perf_counter()
+    syscalls = sender.syscalls
+    sent = 0
+    for i in range(frames):
+        sent += sender.send(batch)
+    elapsed = time.perf_counter() - start
+    # Let the sinks catch up before counting
+    time.sleep(0.5)
+    received = sum(sink.received for sink in sinks)
+    print("%-9s %8.0f packets/s sent, %6.1f us/frame, %5.1f syscalls/frame, %d/%d received" %
+          (name, sent / elapsed, 1e6 * elapsed / frames,
+           float(sender.syscalls - syscalls) / frames, received, sent))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Legacy UDP output benchmark")
+    parser.add_argument("--strands", type=int, default=20)
+    parser.add_argument("--pixels", type=int, default=240, help="Pixels per strand")
+    parser.add_argument("--clients", type=int, default=3)
+    parser.add_argument("--frames", type=int, default=2000)
+    parser.add_argument("--port", type=int, default=13020, help="First sink port")
+    args = parser.parse_args()
+
+    sinks = [UdpSink(args.port + i) for i in range(args.clients)]
+    addresses = [("127.0.0.1", args.port + i) for i in range(args.clients)]
+    packets = legacy_frame(args.strands, args.pixels)
+
+    print("%d strands x %d pixels, %d clients: %d datagrams/frame" %
+          (args.strands, args.pixels, args.clients, len(packets) * args.clients))
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sender = UdpBatchSender(sock, use_sendmmsg=False)
+        run("sendto", sender, sender.prepare(packets, addresses), args.frames, sinks)
+
+        if sendmmsg_available():
+            sender = UdpBatchSender(sock)
+            run("sendmmsg", sender, sender.prepare(packets, addresses), args.frames, sinks)
+        else:
+            print("sendmmsg is not available on this platform")
+    finally:
+        for sink in sinks:
+            sink.stop()
+        sock.close()
+
+
+if __name__ == "__main__":
+    main()
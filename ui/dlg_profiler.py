@@ -0,0 +1,99 @@
+# This file is part of Firemix.
+#
+# Copyright 2013-2020 Jonathan Evans <jon@craftyjon.com>
+#
+# Firemix is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Firemix is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Firemix.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+
+from PyQt5 import QtCore, QtGui, QtWidgets
+
+
+class DlgProfiler(QtWidgets.QDialog):
+    """
+    Live view of the mixer's tick profiler.  Each row is one stage of one
+    preset or transition class; the budget column is its p95 as a fraction of
+    the frame period.
+    """
+
+    COLUMNS = ["Stage", "Class", "Count", "Mean (ms)", "p50 (ms)",
+               "p95 (ms)", "p99 (ms)", "Max (ms)", "Budget"]
+
+    def __init__(self, parent=None):
+        super(DlgProfiler, self).__init__(parent)
+        self.app = parent.app
+        self.profiler = self.app.mixer.profiler
+        self.setWindowTitle("FireMix - Tick Profiler")
+        self.resize(760, 420)
+
+        self.cb_enabled = QtWidgets.QCheckBox("Enable profiling")
+        self.cb_enabled.setChecked(self.profiler.enabled)
+        self.cb_enabled.toggled.connect(self.on_enabled_toggled)
+        self.btn_reset = QtWidgets.QPushButton("Reset")
+        self.btn_reset.clicked.connect(self.on_btn_reset)
+        self.btn_save = QtWidgets.QPushButton("Save JSON...")
+        self.btn_save.clicked.connect(self.on_btn_save)
+
+        toolbar = QtWidgets.QHBoxLayout()
+        toolbar.addWidget(self.cb_enabled)
+        toolbar.addStretch()
+        toolbar.addWidget(self.btn_reset)
+        toolbar.addWidget(self.btn_save)
+
+        self.tbl_stats = QtWidgets.QTableWidget(0, len(self.COLUMNS))
+        self.tbl_stats.setHorizontalHeaderLabels(self.COLUMNS)
+        self.tbl_stats.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+        self.tbl_stats.verticalHeader().setVisible(False)
+        self.tbl_stats.horizontalHeader().setStretchLastSection(True)
+
+        layout = QtWidgets.QVBoxLayout(self)
+        layout.addLayout(toolbar)
+        layout.addWidget(self.tbl_stats)
+
+        self.update_timer = QtCore.QTimer(self)
+        self.update_timer.setInterval(500)
+        self.update_timer.timeout.connect(self.update_stats)
+        self.update_timer.start()
+        self.update_stats()
+
+    def on_enabled_toggled(self, enabled):
+        self.profiler.enabled = enabled
+
+    def on_btn_reset(self):
+        self.profiler.reset()
+        self.update_stats()
+
+    def on_btn_save(self):
+        filename, _ = QtWidgets.QFileDialog.getSaveFileName(self, 'Save tick profile',
+                                                            os.path.join(os.getcwd(), "profile.json"),
+                                                            filter="JSON (*.json)")
+        if len(filename) > 0:
+            self.profiler.dump(filename)
+
+    def update_stats(self):
+        budget = 1000.0 / self.app.mixer.get_tick_rate()
+        rows = self.profiler.rows()
+        self.tbl_stats.setRowCount(len(rows))
+        for row, (stage, key, stats) in enumerate(rows):
+            fraction = stats['p95'] / budget
+            values = [stage, key, "%d" % stats['count']]
+            values += ["%0.3f" % stats[k] for k in ('mean', 'p50', 'p95', 'p99', 'max')]
+            values.append("%0.1f%%" % (100.0 * fraction))
+            for col, value in enumerate(values):
+                item = QtWidgets.QTableWidgetItem(value)
+                if fraction >= 1.0:
+                    item.setBackground(QtGui.QColor(255, 160, 160))
+                elif fraction >= 0.5:
+                    item.setBackground(QtGui.QColor(255, 230, 160))
+                self.tbl_stats.setItem(row, col, item)
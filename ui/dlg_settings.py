@@ -23,7 +23,7 @@ from ui.ui_dlg_settings import Ui_DlgSettings
 from lib import color_modes
 
 # TODO: This is a hack
-PROTOCOLS = ["Legacy", "OPC"]
+PROTOCOLS = ["Legacy", "OPC", "OPC-UDP", "E1.31", "Art-Net"]
 
 
 class DlgSettings(QtWidgets.QDialog, Ui_DlgSettings):
@@ -51,7 +51,8 @@ class DlgSettings(QtWidgets.QDialog, Ui_DlgSettings):
 
         # Setup validation and acceptance methods for all panes
         self.validators = [self.validate_networking, self.validate_mixer]
-        self.acceptors = [self.accept_networking, self.accept_strands, self.accept_mixer, self.save_settings]
+        self.acceptors = [self.accept_networking, self.accept_strands, self.accept_mixer,
+                          self.update_network_plan, self.save_settings]
 
         # Initialize settings panes
         self.populate_mixer_settings()
@@ -116,8 +117,9 @@ class DlgSettings(QtWidgets.QDialog, Ui_DlgSettings):
             proto = self.tbl_networking_clients.cellWidget(i, 4).currentText()
             ignore_dimming = (self.tbl_networking_clients.cellWidget(i, 5).checkState() == QtCore.Qt.Checked)
 
-            client = {"host": host, "port": port, "enabled": enabled, "color-mode": color_mode,
-                      "protocol": proto, "ignore-dimming": ignore_dimming}
+            client = dict(self.tbl_networking_clients.item(i, 0).data(QtCore.Qt.UserRole) or {})
+            client.update({"host": host, "port": port, "enabled": enabled, "color-mode": color_mode,
+                           "protocol": proto, "ignore-dimming": ignore_dimming})
             if client not in clients:
                 clients.append(client)
         self.app.settings['networking']['clients'] = clients
@@ -132,6 +134,10 @@ class DlgSettings(QtWidgets.QDialog, Ui_DlgSettings):
             strands.append(strand)
         self.app.scene.set_strand_settings(strands)
 
+    def update_network_plan(self):
+        if self.app.net is not None:
+            self.app.net.invalidate_plan()
+
     def save_settings(self):
         self.app.settings.save()
         self.app.scene.save()
@@ -141,6 +147,8 @@ class DlgSettings(QtWidgets.QDialog, Ui_DlgSettings):
         self.tbl_networking_clients.setRowCount(len(clients))
         for i, client in enumerate(clients):
             item_host = QtWidgets.QTableWidgetItem(client["host"])
+            # Keep the settings that can't be edited here (e.g. "opc-map")
+            item_host.setData(QtCore.Qt.UserRole, client)
             item_port = QtWidgets.QTableWidgetItem(str(client["port"]))
             item_enabled = QtWidgets.QCheckBox()
             item_ignore_dimming = QtWidgets.QCheckBox()
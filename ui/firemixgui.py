@@ -29,6 +29,7 @@ from PyQt5.QtWidgets import (QMainWindow, QFileDialog, QAbstractItemView,
 from ui.ui_firemix import Ui_FireMixMain
 from ui.dlg_add_preset import DlgAddPreset
 from ui.dlg_settings import DlgSettings
+from ui.dlg_profiler import DlgProfiler
 
 from lib.colors import hsv_float_to_rgb_uint8
 
@@ -90,6 +91,10 @@ class FireMixGUI(QMainWindow, Ui_FireMixMain):
 
         # Tools menu
         self.action_file_generate_default_playlist.triggered.connect(self.on_file_generate_default_playlist)
+        self.action_tools_profiler = QAction("Tick Profiler...", self)
+        self.action_tools_profiler.triggered.connect(self.on_tools_profiler)
+        self.menuTools.addAction(self.action_tools_profiler)
+        self.dlg_profiler = None
 
         # Pattern list
         self.lst_presets.itemDoubleClicked.connect(self.on_preset_double_clicked)
@@ -209,7 +214,10 @@ class FireMixGUI(QMainWindow, Ui_FireMixMain):
             self.slider_transition.setValue(p * 100)
 
     def update_mixer(self):
-        self.setWindowTitle("FireMix - %s - %0.2f FPS" % (self.app.playlist.name, self.mixer.fps()))
+        title = "FireMix - %s - %0.2f FPS" % (self.app.playlist.name, self.mixer.fps())
+        if self.mixer.quality_level() > 0:
+            title += " (reduced quality %d)" % self.mixer.quality_level()
+        self.setWindowTitle(title)
 
         # Update wibblers
         # TODO (jon) this is kinda inefficient
@@ -303,7 +311,7 @@ class FireMixGUI(QMainWindow, Ui_FireMixMain):
     def on_btn_reset_preset(self):
         paused = self.app.mixer.is_paused()
         self.app.mixer.pause()
-        self.app.playlist.get_active_preset()._reset()
+        self.app.mixer.reset_preset(self.app.playlist.get_active_preset())
         self.app.mixer.pause(paused)
 
     def on_btn_add_preset(self):
@@ -629,6 +637,12 @@ class FireMixGUI(QMainWindow, Ui_FireMixMain):
     def on_edit_settings(self):
         DlgSettings(self).exec_()
 
+    def on_tools_profiler(self):
+        if self.dlg_profiler is None:
+            self.dlg_profiler = DlgProfiler(self)
+        self.dlg_profiler.show()
+        self.dlg_profiler.raise_()
+
     def on_btn_shuffle_playlist(self):
         shuffle = self.btn_shuffle_playlist.isChecked()
         self.app.settings['mixer']['shuffle'] = shuffle